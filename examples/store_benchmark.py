@@ -0,0 +1,98 @@
+"""
+pynet chunked store benchmark
+=============================
+
+The fetchers write the datasets in monolithic '.npy' files that are
+memory-mapped by the DataManager. The chunked store compresses each sample
+(or each group of samples) in its own file: a random access reads only the
+requested chunk, and the quantization options reduce further the size of
+the data. This example compares the disk footprint and the random access
+time of the two layouts on synthetic brain-like volumes.
+
+Generate the data
+-----------------
+
+We generate smooth volumes with a null background, as the skull-stripped
+MRI images.
+"""
+
+import os
+import sys
+if "CI_MODE" in os.environ:
+    sys.exit()
+
+import time
+import shutil
+import tempfile
+import numpy as np
+from scipy import ndimage
+from pynet.datasets.store import create_array, open_array, available_codecs
+
+n_samples = 16
+shape = (1, 96, 112, 96)
+rng = np.random.default_rng(0)
+grid = np.indices(shape[1:]).astype(np.float32)
+center = (np.asarray(shape[1:]) - 1)[:, np.newaxis, np.newaxis, np.newaxis]
+mask = (((grid - center / 2) / (center / 2.5)) ** 2).sum(axis=0) < 1
+data = np.empty((n_samples, ) + shape, dtype=np.float32)
+for idx in range(n_samples):
+    volume = ndimage.gaussian_filter(
+        rng.standard_normal(shape[1:]).astype(np.float32), sigma=2)
+    data[idx, 0] = (volume - volume.min()) * mask
+print("Data: {0} - {1:.1f} MB".format(data.shape, data.nbytes / 1024 ** 2))
+
+#############################################################################
+# Write the layouts
+# -----------------
+#
+# The reference '.npy' file, and one store per codec and quantization. Each
+# store is written sample by sample, as a fetcher does.
+
+workdir = tempfile.mkdtemp()
+layouts = {"npy": os.path.join(workdir, "data.npy")}
+start = time.time()
+np.save(layouts["npy"], data)
+timings = {"npy": time.time() - start}
+configurations = [(codec, None) for codec in available_codecs()]
+configurations += [("zlib", "float16"), ("zlib", "uint8")]
+for codec, quantize in configurations:
+    name = "{0}-{1}".format(codec, quantize or "lossless")
+    layouts[name] = os.path.join(workdir, name + ".chunks")
+    start = time.time()
+    store = create_array(layouts[name], data.shape, data.dtype, codec=codec,
+                         quantize=quantize)
+    for idx, arr in enumerate(data):
+        store[idx] = arr
+    timings[name] = time.time() - start
+
+
+def disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+#############################################################################
+# Random access
+# -------------
+#
+# We read the samples in a random order, as a random sampler does. Note
+# that the '.npy' file is likely in the page cache here: on a network
+# filesystem or with a dataset larger than the memory, the smaller store
+# is read faster.
+
+order = rng.permutation(n_samples)
+print("{0:<20}{1:>12}{2:>12}{3:>12}{4:>12}".format(
+    "layout", "size (MB)", "write (s)", "read (ms)", "max error"))
+for name, path in layouts.items():
+    arr = open_array(path)
+    start = time.time()
+    error = 0
+    for idx in order:
+        sample = np.asarray(arr[idx])
+        error = max(error, float(np.abs(sample - data[idx]).max()))
+    duration = (time.time() - start) / n_samples * 1000
+    print("{0:<20}{1:>12.2f}{2:>12.3f}{3:>12.2f}{4:>12.4f}".format(
+        name, disk_size(path) / 1024 ** 2, timings[name], duration, error))
+shutil.rmtree(workdir)
@@ -13,12 +13,16 @@ Module that privides common spatial and intensity data augmentation tools.
 
 # Import
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import logging
 import numpy as np
 from .spatial import affine
 from .spatial import flip
 from .spatial import deformation
+from .spatial import affine_matrix
+from .spatial import flip_matrix
+from .spatial import resample
 from .intensity import add_blur
 from .intensity import add_noise
 from .intensity import add_ghosting
@@ -26,6 +30,19 @@ from .intensity import add_spike
 from .intensity import add_biasfield
 from .intensity import add_motion
 from .intensity import add_offset
+from .utils import get_rng
+from .utils import seed_sequence
+from .utils import derive_seed
+from .batch import BatchTransformer
+from .batch import batch_affine
+from .batch import batch_flip
+from .batch import batch_deformation
+from .batch import batch_add_noise
+from .batch import batch_add_blur
+from .batch import batch_add_ghosting
+from .batch import batch_add_spike
+from .batch import batch_add_biasfield
+from .batch import batch_add_motion
 
 
 # Global parameters
@@ -34,11 +51,22 @@ logger = logging.getLogger("pynet")
 
 class Transformer(object):
     """ Class that can be used to register a sequence of transformations.
+
+    The random draws of the registered transforms are derived from the
+    'seed' attribute (an int, a numpy SeedSequence or None) and the
+    transform position, so that all the channels, and the input and output
+    data transformed with the same seed, share the same random parameters.
     """
     Transform = namedtuple("Transform", ["transform", "params", "probability",
                                          "apply_to"])
+    # The affine-type transforms and the functions that draw their matrices
+    AFFINE_MATRICES = {
+        affine: affine_matrix,
+        flip: flip_matrix
+    }
 
-    def __init__(self, with_channel=True, output_label=False):
+    def __init__(self, with_channel=True, output_label=False,
+                 fuse_affine=True, executor=None):
         """ Initialize the class.
 
         Parameters
@@ -50,12 +78,50 @@ class Transformer(object):
         output_label: bool, default False
             if output data are labels, automatically force the interpolation
             to nearest neighboor via the 'order' transform parameter.
+        fuse_affine: bool, default True
+            if set, the consecutive affine-type transforms (see
+            'AFFINE_MATRICES') are composed and the data are resampled
+            only once, with the highest requested interpolation order.
+            The other transforms break the chain.
+        executor: int or concurrent.futures.Executor, default None
+            if set, the channels of a sample, or the samples of a batch (see
+            'map'), are transformed in a thread pool: either a shared
+            executor, or the number of threads of a pool owned by the
+            transformer. The heavy kernels release the GIL, and the random
+            draws only depend on the sample seed, so the results are the
+            same as the sequential ones.
         """
         self.transforms = []
         self.seed = None
         self.dtype = "all"
         self.with_channel = with_channel
         self.output_label = output_label
+        self.fuse_affine = fuse_affine
+        self.executor = executor
+        self._pool = None
+
+    def __getstate__(self):
+        """ The thread pools are not shared with other processes.
+        """
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        if not isinstance(self.executor, int):
+            state["executor"] = None
+        return state
+
+    def get_executor(self):
+        """ Return the executor used to transform the data in parallel.
+
+        Returns
+        -------
+        executor: concurrent.futures.Executor
+            the executor or None if the data are transformed sequentially.
+        """
+        if isinstance(self.executor, int):
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.executor)
+            return self._pool
+        return self.executor
 
     def register(self, transform, probability=1, apply_to=None, **kwargs):
         """ Register a new transformation.
@@ -92,23 +158,110 @@ class Transformer(object):
         transformed: array
             the transformed input data.
         """
+        return self._transform(arr, self.seed, self.get_executor())
+
+    def map(self, arrs, seeds=None):
+        """ Apply the registered transformations to independent samples.
+
+        Parameters
+        ----------
+        arrs: list of array
+            the input data.
+        seeds: list of int or SeedSequence, default None
+            the seed of each sample, default seeds derived from the
+            transformer seed and the sample position.
+
+        Returns
+        -------
+        transformed: list of array
+            the transformed input data.
+        """
+        if seeds is None:
+            sequence = seed_sequence(self.seed)
+            seeds = [derive_seed(sequence, idx) for idx in range(len(arrs))]
+        if len(seeds) != len(arrs):
+            raise ValueError("One seed per sample is expected.")
+        executor = self.get_executor()
+        if executor is None:
+            return [self._transform(arr, seed, None)
+                    for arr, seed in zip(arrs, seeds)]
+        # The channels of each sample are processed sequentially in order
+        # not to wait for nested tasks in the pool
+        futures = [executor.submit(self._transform, arr, seed, None)
+                   for arr, seed in zip(arrs, seeds)]
+        return [future.result() for future in futures]
+
+    def _transform(self, arr, seed, executor):
+        """ Apply the registered transformations to one sample.
+        """
         transformed = arr.copy()
         if not self.with_channel:
             transformed = np.expand_dims(transformed, axis=0)
-        for trf in self.transforms:
+        sequence = seed_sequence(seed)
+        chain = []
+        for idx, trf in enumerate(self.transforms):
             if self.dtype not in trf.apply_to:
                 continue
             kwargs = copy.deepcopy(trf.params)
             if (self.output_label and self.dtype == "output" and
                     "order" in kwargs):
                 kwargs["order"] = 0
-            np.random.seed(self.seed)
-            if np.random.rand() < trf.probability:
-                logger.debug("Applying {0}...".format(trf.transform))
-                for channel_id in range(transformed.shape[0]):
-                    transformed[channel_id] = trf.transform(
-                        transformed[channel_id], seed=self.seed, **kwargs)
-                logger.debug("Done.")
+            if get_rng(derive_seed(sequence, idx, 0)).random() >= (
+                    trf.probability):
+                continue
+            # The channels draw the same parameters from a fresh generator
+            trf_seed = derive_seed(sequence, idx, 1)
+            if self.fuse_affine and trf.transform in self.AFFINE_MATRICES:
+                chain.append((trf.transform, kwargs, trf_seed))
+                continue
+            self._apply_chain(transformed, chain, executor)
+            chain = []
+            self._apply(transformed, trf.transform, kwargs, trf_seed,
+                        executor)
+        self._apply_chain(transformed, chain, executor)
         if not self.with_channel:
             transformed = transformed[0]
         return transformed
+
+    def _apply(self, transformed, transform, kwargs, seed, executor):
+        """ Apply a transformation to each channel inplace.
+        """
+        logger.debug("Applying {0}...".format(transform))
+        self._map_channels(
+            transformed, lambda channel: transform(
+                channel, seed=seed, **kwargs), executor)
+        logger.debug("Done.")
+
+    @staticmethod
+    def _map_channels(transformed, function, executor):
+        """ Apply a function to each channel inplace.
+        """
+        if executor is None or len(transformed) == 1:
+            results = [function(channel) for channel in transformed]
+        else:
+            results = list(executor.map(function, transformed))
+        for channel_id, result in enumerate(results):
+            transformed[channel_id] = result
+
+    def _apply_chain(self, transformed, chain, executor):
+        """ Compose a chain of affine-type transformations and resample each
+        channel once inplace.
+        """
+        orders = [kwargs.get("order", 3) for transform, kwargs, _ in chain
+                  if transform is not flip]
+        if len(chain) == 1 or len(orders) == 0:
+            for transform, kwargs, seed in chain:
+                self._apply(transformed, transform, kwargs, seed, executor)
+            return
+        logger.debug("Applying fused {0}...".format(
+            [transform for transform, _, _ in chain]))
+        matrix = np.eye(transformed.ndim)
+        for transform, kwargs, seed in chain:
+            kwargs = dict((key, val) for key, val in kwargs.items()
+                          if key != "order")
+            matrix = np.dot(matrix, self.AFFINE_MATRICES[transform](
+                transformed[0], seed=seed, **kwargs))
+        self._map_channels(
+            transformed, lambda channel: resample(
+                channel, matrix, order=max(orders)), executor)
+        logger.debug("Done.")
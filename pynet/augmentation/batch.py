@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Module that provides data augmentation tools working on whole mini-batches
+of (N, C, *) tensors on any device: the random parameters are drawn per
+sample, the sampling grids of all the samples are resampled at once with
+'torch.nn.functional.grid_sample', and the intensity artifacts are
+simulated with separable convolutions and 'torch.fft'.
+"""
+
+# Import
+from collections import namedtuple
+import logging
+import torch
+import torch.nn.functional as func
+from scipy.spatial.transform import Rotation
+from .utils import interval
+from .transform import polynomial_basis
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+class BatchTransformer(object):
+    """ Class that can be used to register a sequence of batch
+    transformations.
+
+    The registered transforms are applied to the input mini-batch and, with
+    the same random parameters, to the output mini-batch.
+    """
+    Transform = namedtuple("Transform", ["transform", "params", "probability",
+                                         "apply_to"])
+
+    def __init__(self, output_label=False, seed=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        output_label: bool, default False
+            if output data are labels, automatically force the interpolation
+            to nearest neighboor via the 'order' transform parameter.
+        seed: int, default None
+            seed to control the random number generator.
+        """
+        self.transforms = []
+        self.output_label = output_label
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def register(self, transform, probability=1, apply_to=None, **kwargs):
+        """ Register a new transformation.
+
+        Parameters
+        ----------
+        transform: callable
+            the batch transformation function.
+        probability: float, default 1
+            the transform is applied to each sample with the specified
+            probability.
+        apply_to: list of str, default None
+            the registered transform will be only applied on specified
+            data - 'all', 'input' or 'output'.
+        kwargs
+            the transformation function parameters.
+        """
+        if apply_to is None:
+            apply_to = ["all"]
+        trf = self.Transform(
+            transform=transform, params=kwargs, probability=probability,
+            apply_to=apply_to)
+        self.transforms.append(trf)
+
+    def __call__(self, inputs, outputs=None):
+        """ Apply the registered transformations.
+
+        Parameters
+        ----------
+        inputs: Tensor (N, C, *)
+            the input mini-batch.
+        outputs: Tensor (N, C', *), default None
+            the output mini-batch.
+
+        Returns
+        -------
+        inputs, outputs: Tensor
+            the transformed mini-batches.
+        """
+        data = {"input": inputs, "output": outputs}
+        for trf in self.transforms:
+            keys = [key for key, tensor in data.items()
+                    if tensor is not None and
+                    ("all" in trf.apply_to or key in trf.apply_to)]
+            if len(keys) == 0:
+                continue
+            mask = torch.rand(len(inputs), generator=self.generator)
+            indices = torch.nonzero(mask < trf.probability).squeeze(1)
+            if len(indices) == 0:
+                continue
+            logger.debug("Applying {0} to {1} samples...".format(
+                trf.transform, len(indices)))
+            kwargs = dict(trf.params)
+            # The bias field order is a polynomial order
+            order = None
+            if trf.transform is not batch_add_biasfield:
+                order = kwargs.pop("order", None)
+            if order is not None:
+                kwargs["order"] = [
+                    0 if self.output_label and key == "output" else order
+                    for key in keys]
+            transformed = trf.transform(
+                [data[key][indices.to(data[key].device)] for key in keys],
+                generator=self.generator, **kwargs)
+            for key, tensor in zip(keys, transformed):
+                if len(indices) == len(inputs):
+                    data[key] = tensor
+                else:
+                    data[key] = data[key].clone()
+                    data[key][indices.to(tensor.device)] = tensor
+            logger.debug("Done.")
+        return data["input"], data["output"]
+
+
+def batch_affine(tensors, rotation=10, translation=10, zoom=0.2, order=1,
+                 dist="uniform", generator=None):
+    """ Random affine transformation of mini-batches.
+
+    The parameters are drawn independently for each sample, and are shared
+    by the different tensors.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the 2d or 3d mini-batches to be transformed.
+    rotation: float or 2-uplet, default 10
+        the rotation in degrees of the simulated movements. Larger
+        values generate more distorted images.
+    translation: float or 2-uplet, default 10
+        the translation in voxel of the simulated movements. Larger
+        values generate more distorted images.
+    zoom: float, default 0.2
+        the zooming magnitude. Larger values generate more distorted images.
+    order: int or list of int, default 1
+        the interpolation order of each tensor: 0 (nearest), 1 (linear) or
+        3 (cubic, 2d only, linear is used in 3d).
+    dist: str, default 'uniform'
+        the sampling distribution: 'uniform' or 'lognormal'.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    n_samples, shape = len(tensors[0]), tuple(tensors[0].shape[2:])
+    ndim = len(shape)
+    n_rotations = 3 if ndim == 3 else 1
+    rotations = _random(
+        interval(rotation), (n_samples, n_rotations), dist, generator)
+    translations = _random(
+        interval(translation), (n_samples, ndim), dist, generator)
+    zooms = _random(
+        (1 - zoom, 1 + zoom), (n_samples, ndim), "uniform", generator)
+    grid = _affine_grid(shape, rotations, translations, zooms)
+    return _resample(tensors, grid, order)
+
+
+def batch_flip(tensors, axis=None, generator=None):
+    """ Apply a random mirror flip to mini-batches.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the mini-batches to be transformed.
+    axis: int, default None
+        apply flip on the specified spatial axis. If not specified,
+        randomize the flip axis of each sample.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    n_samples, ndim = len(tensors[0]), tensors[0].ndim - 2
+    if axis is None:
+        axes = torch.randint(0, ndim, (n_samples, ), generator=generator)
+    else:
+        axes = torch.full((n_samples, ), axis, dtype=torch.int64)
+    transformed = []
+    for tensor in tensors:
+        tensor = tensor.clone()
+        for _axis in torch.unique(axes).tolist():
+            indices = torch.nonzero(axes == _axis).squeeze(1).to(
+                tensor.device)
+            tensor[indices] = tensor[indices].flip(_axis + 2)
+        transformed.append(tensor)
+    return transformed
+
+
+def batch_deformation(tensors, max_displacement=4, alpha=3, order=1,
+                      generator=None):
+    """ Apply dense random elastic deformations to mini-batches.
+
+    One gaussian random field is drawn per sample and per spatial axis
+    in the Fourier domain with a power-law amplitude spectrum.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the 2d or 3d mini-batches to be transformed.
+    max_displacement: float, default 4
+        the maximum displacement in voxel along each dimension. Larger
+        values generate more distorted images.
+    alpha: float, default 3
+        the power of the power-law momentum distribution. Larger values
+        genrate smoother fields.
+    order: int or list of int, default 1
+        the interpolation order of each tensor: see 'batch_affine'.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    n_samples, shape = len(tensors[0]), tuple(tensors[0].shape[2:])
+    ndim = len(shape)
+    noise = torch.randn((n_samples, ndim) + shape, generator=generator)
+    freqs = [torch.fft.fftfreq(size) * size for size in shape[:-1]]
+    freqs.append(torch.fft.rfftfreq(shape[-1]) * shape[-1])
+    norm = sum(item ** 2 for item in torch.meshgrid(*freqs, indexing="ij"))
+    amplitude = torch.pow(norm + 1e-10, -alpha / 4.)
+    amplitude.view(-1)[0] = 0
+    dims = tuple(range(2, ndim + 2))
+    fields = torch.fft.irfftn(
+        torch.fft.rfftn(noise, dim=dims) * amplitude, s=shape, dim=dims)
+    fields = fields.view(n_samples, ndim, -1)
+    fields = fields - fields.mean(dim=2, keepdim=True)
+    fields = fields / fields.std(dim=2, keepdim=True)
+    fields = fields / fields.max(dim=2, keepdim=True)[0]
+    half = (torch.tensor(shape, dtype=torch.float32) - 1) / 2
+    fields = fields * max_displacement / half.view(1, -1, 1)
+    fields = fields.view((n_samples, ndim) + shape).flip(1)
+    theta = torch.eye(ndim, ndim + 1).expand(n_samples, ndim, ndim + 1)
+    grid = func.affine_grid(
+        theta, (n_samples, 1) + shape, align_corners=True)
+    grid = grid + fields.permute((0, ) + dims + (1, ))
+    return _resample(tensors, grid, order)
+
+
+def batch_add_noise(tensors, snr=None, sigma=None, noise_type="gaussian",
+                    generator=None):
+    """ Add random Gaussian or Rician noise to mini-batches: see
+    'pynet.augmentation.add_noise'.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the mini-batches to be transformed.
+    snr: float, default None
+        the desired signal-to noise ratio used to infer the standard deviation
+        for the noise distribution.
+    sigma: float or 2-uplet, default None
+        the standard deviation for the noise distribution.
+    noise_type: str, default 'gaussian'
+        the distribution of added noise - can be either 'gaussian' for
+        Gaussian distributed noise, or 'rician' for Rice-distributed noise.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    if noise_type not in ("gaussian", "rician"):
+        raise ValueError("Unsupported noise type.")
+    sigmas = _random_sigmas(tensors[0], snr, sigma, generator)
+    transformed = []
+    for tensor in tensors:
+        tensor = _floating(tensor)
+        scale = sigmas.view((-1, ) + (1, ) * (tensor.ndim - 1)).to(tensor)
+        if noise_type == "gaussian":
+            noise = _randn(tensor.shape, generator, tensor.device)
+            transformed.append(tensor + noise.to(tensor) * scale)
+        else:
+            noise = _randn((2, ) + tensor.shape, generator, tensor.device)
+            noise = noise.to(tensor) * scale
+            transformed.append(torch.sqrt(
+                torch.square(tensor + noise[0]) + torch.square(noise[1])))
+    return transformed
+
+
+def batch_add_blur(tensors, snr=None, sigma=None, generator=None):
+    """ Add random blur to mini-batches using a Gaussian filter: see
+    'pynet.augmentation.add_blur'.
+
+    The filter is applied as a separable convolution, the borders being
+    handled as in 'scipy.ndimage.gaussian_filter' (reflect mode).
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the mini-batches to be transformed.
+    snr: float, default None
+        the desired signal-to noise ratio used to infer the standard deviation
+        for the noise distribution.
+    sigma: float or 2-uplet
+        the standard deviation for Gaussian kernel.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    sigmas = _random_sigmas(tensors[0], snr, sigma, generator)
+    radius = int(4 * float(sigmas.max()) + 0.5)
+    coords = torch.arange(-radius, radius + 1, dtype=torch.float32)
+    kernels = torch.exp(
+        -0.5 * (coords.view(1, -1) / sigmas.clamp(min=1e-6).view(-1, 1)) ** 2)
+    kernels /= kernels.sum(dim=1, keepdim=True)
+    transformed = []
+    for tensor in tensors:
+        tensor = _floating(tensor)
+        n_samples, n_channels = tensor.shape[:2]
+        weight = kernels.repeat_interleave(n_channels, dim=0).unsqueeze(1)
+        weight = weight.to(tensor)
+        for axis in range(2, tensor.ndim):
+            size = tensor.shape[axis]
+            moved = tensor.movedim(axis, -1)
+            moved_shape = moved.shape
+            # The other spatial axes are stacked in the conv batch axis
+            moved = moved.reshape(n_samples * n_channels, -1, size)
+            moved = _reflect(moved.transpose(0, 1), radius)
+            moved = func.conv1d(moved, weight, groups=n_samples * n_channels)
+            tensor = moved.transpose(0, 1).reshape(moved_shape).movedim(
+                -1, axis)
+        transformed.append(tensor)
+    return transformed
+
+
+def batch_add_ghosting(tensors, axis, n_ghosts=10, intensity=1,
+                       generator=None):
+    """ Add random MRI ghosting artifact to mini-batches: see
+    'pynet.augmentation.add_ghosting'.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the mini-batches to be transformed.
+    axis: int
+        the spatial axis along which the ghosts artifact will be created.
+    n_ghosts: int or 2-uplet, default 10
+        the number of ghosts in the image. Larger values generate more
+        distorted images.
+    intensity: float or list of float, default 1
+        a number between 0 and 1 representing the artifact strength. Larger
+        values generate more distorted images.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    # Leave first 5% of frequencies untouched.
+    n_ghosts = interval(n_ghosts, lower=0)
+    intensity = interval(intensity, lower=0)
+    n_samples, ndim = len(tensors[0]), tensors[0].ndim - 2
+    ghosts = torch.randint(
+        int(n_ghosts[0]), int(n_ghosts[1]), (n_samples, ),
+        generator=generator)
+    intensities = _random(intensity, (n_samples, ), "uniform", generator)
+    percentage_to_avoid = 0.05
+    dims = tuple(dim + 2 for dim in range(ndim) if dim != axis)
+    size = tensors[0].shape[dims[0]]
+    rows = torch.arange(size)
+    mask = ((rows.view(1, -1) % ghosts.view(-1, 1) == 0) &
+            (torch.abs(rows / size - 0.5) >= percentage_to_avoid / 2))
+    factors = 1 - mask * intensities.view(-1, 1)
+    view_shape = [n_samples] + [1] * (ndim + 1)
+    view_shape[dims[0]] = size
+    factors = factors.view(view_shape)
+    transformed = []
+    for tensor in tensors:
+        tensor = _floating(tensor)
+        spectrum = torch.fft.fftshift(
+            torch.fft.fftn(tensor, dim=dims), dim=dims)
+        spectrum *= factors.to(tensor)
+        transformed.append(torch.abs(torch.fft.ifftn(
+            torch.fft.ifftshift(spectrum, dim=dims), dim=dims)).to(
+                tensor.dtype))
+    return transformed
+
+
+def batch_add_spike(tensors, n_spikes=1, intensity=(0.1, 1), generator=None):
+    """ Add random MRI spike artifacts to mini-batches: see
+    'pynet.augmentation.add_spike'.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the mini-batches to be transformed.
+    n_spikes: int, default 1
+        the number of spikes presnet in k-space. Larger values generate more
+        distorted images.
+    intensity: float or 2-uplet, default (0.1, 1)
+        Ratio between the spike intensity and the maximum of the spectrum
+        magnitude. Larger values generate more distorted images.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    intensity = interval(intensity, lower=0)
+    n_samples = len(tensors[0])
+    positions = torch.rand((n_samples, n_spikes), generator=generator)
+    factors = _random(intensity, (n_samples, ), "uniform", generator)
+    transformed = []
+    for tensor in tensors:
+        tensor = _floating(tensor)
+        dims = tuple(range(2, tensor.ndim))
+        spectrum = torch.fft.fftshift(
+            torch.fft.fftn(tensor, dim=dims), dim=dims)
+        flat = spectrum.reshape(n_samples, tensor.shape[1], -1)
+        indices = (positions * flat.shape[2]).round().long().clamp(
+            max=flat.shape[2] - 1)
+        indices = indices.unsqueeze(1).expand(-1, flat.shape[1], -1)
+        peaks = flat.abs().max(dim=2)[0] * factors.view(-1, 1).to(
+            tensor.device)
+        flat = flat.scatter(
+            2, indices.to(tensor.device),
+            peaks.unsqueeze(2).expand(-1, -1, n_spikes).to(flat.dtype))
+        transformed.append(torch.abs(torch.fft.ifftn(
+            torch.fft.ifftshift(flat.view(spectrum.shape), dim=dims),
+            dim=dims)).to(tensor.dtype))
+    return transformed
+
+
+def batch_add_biasfield(tensors, coefficients=0.5, order=3, generator=None):
+    """ Add random MRI bias field artifact to mini-batches: see
+    'pynet.augmentation.add_biasfield'.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the mini-batches to be transformed.
+    coefficients: float, default 0.5
+        the magnitude of polynomial coefficients.
+    order: int, default 3
+        the order of the basis polynomial functions.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    coefficients = interval(coefficients)
+    n_samples, shape = len(tensors[0]), tuple(tensors[0].shape[2:])
+    terms, factors = polynomial_basis(shape, order)
+    terms = torch.from_numpy(terms.copy())
+    random_coefficients = torch.zeros((n_samples, ) + tuple(terms.shape))
+    random_coefficients[:, terms] = _random(
+        coefficients, (n_samples, int(terms.sum())), "uniform", generator)
+    transformed = []
+    for tensor in tensors:
+        tensor = _floating(tensor)
+        fields = random_coefficients.to(tensor)
+        for powers in factors:
+            fields = torch.tensordot(
+                fields, torch.tensor(powers).to(tensor), dims=([1], [0]))
+        transformed.append(tensor * torch.exp(fields).unsqueeze(1))
+    return transformed
+
+
+def batch_add_motion(tensors, rotation=10, translation=10, n_transforms=2,
+                     perturbation=0.3, axis=None, generator=None):
+    """ Add random MRI motion artifact to mini-batches: see
+    'pynet.augmentation.add_motion'.
+
+    The moved images are resampled with a linear interpolation.
+
+    Parameters
+    ----------
+    tensors: list of Tensor (N, C, *)
+        the 2d or 3d mini-batches to be transformed.
+    rotation: float or 2-uplet, default 10
+        the rotation in degrees of the simulated movements. Larger
+        values generate more distorted images.
+    translation: floatt or 2-uplet, default 10
+        the translation in voxel of the simulated movements. Larger
+        values generate more distorted images.
+    n_transforms: int, default 2
+        the number of simulated movements. Larger values generate more
+        distorted images.
+    perturbation: float, default 0.3
+        control the intervals between movements. If perturbation is 0, time
+        intervals between movements are constant.
+    axis: int, default None
+        the k-space filling spatial axis. If not specified, randomize the
+        k-space filling axis of each sample.
+    generator: torch.Generator, default None
+        the random number generator.
+
+    Returns
+    -------
+    transformed: list of Tensor
+        the transformed mini-batches.
+    """
+    rotation = interval(rotation)
+    translation = interval(translation)
+    n_samples, shape = len(tensors[0]), tuple(tensors[0].shape[2:])
+    ndim = len(shape)
+    if axis is None:
+        axes = torch.randint(
+            0, ndim, (n_samples, ), generator=generator).tolist()
+    else:
+        axes = [axis] * n_samples
+    step = 1. / (n_transforms + 1)
+    times = torch.arange(1, n_transforms + 1) * step
+    times = times + _random(
+        (-step * perturbation, step * perturbation),
+        (n_samples, n_transforms), "uniform", generator)
+    n_rotations = 3 if ndim == 3 else 1
+    grids = []
+    for _ in range(n_transforms):
+        rotations = _random(
+            rotation, (n_samples, n_rotations), "uniform", generator)
+        translations = _random(
+            translation, (n_samples, ndim), "uniform", generator)
+        grids.append(_affine_grid(
+            shape, rotations, translations, torch.ones(n_samples, ndim)))
+    # The k-space center is filled with the spectrum of the original image
+    orders = []
+    for sample_times in times:
+        after = torch.nonzero(sample_times > 0.5).squeeze(1).tolist()
+        index = after[0] if len(after) > 0 else n_transforms
+        order = list(range(n_transforms + 1))
+        order[0], order[index] = order[index], order[0]
+        orders.append(order)
+    dims = tuple(range(2, ndim + 2))
+    transformed = []
+    for tensor in tensors:
+        tensor = _floating(tensor)
+        images = [tensor] + [_resample([tensor], grid, 1)[0]
+                             for grid in grids]
+        spectra = [torch.fft.fftshift(torch.fft.fftn(image, dim=dims),
+                                      dim=dims) for image in images]
+        result = torch.empty_like(spectra[0])
+        for idx, (sample_axis, order) in enumerate(zip(axes, orders)):
+            size = shape[sample_axis]
+            ends = (size * times[idx]).long().tolist() + [size]
+            start = 0
+            for spectrum_idx, end in zip(order, ends):
+                if end > start:
+                    result[idx].narrow(
+                        sample_axis + 1, start, end - start).copy_(
+                            spectra[spectrum_idx][idx].narrow(
+                                sample_axis + 1, start, end - start))
+                start = max(start, end)
+        transformed.append(torch.abs(torch.fft.ifftn(
+            torch.fft.ifftshift(result, dim=dims), dim=dims)).to(
+                tensor.dtype))
+    return transformed
+
+
+def _affine_grid(shape, rotations, translations, zooms):
+    """ Generate the sampling grids of random affine transformations.
+    """
+    n_samples, ndim = len(rotations), len(shape)
+    if ndim == 3:
+        matrices = Rotation.from_euler(
+            "xyz", rotations.numpy(), degrees=True).as_matrix()
+    else:
+        matrices = Rotation.from_euler(
+            "z", rotations.numpy(), degrees=True).as_matrix()[:, :2, :2]
+    matrices = torch.from_numpy(matrices).float() * zooms.unsqueeze(1)
+    # The affines map the centered output voxel coordinates to the centered
+    # input voxel coordinates: express them in the normalized grid_sample
+    # coordinates (in reversed axis order)
+    half = (torch.tensor(shape, dtype=torch.float32) - 1) / 2
+    theta = matrices * half.view(1, 1, -1) / half.view(1, -1, 1)
+    offset = translations / half
+    theta = torch.cat((theta, offset.unsqueeze(2)), dim=2)
+    theta = theta.flip(1)
+    theta[:, :, :ndim] = theta[:, :, :ndim].flip(2)
+    return func.affine_grid(
+        theta, (n_samples, 1) + tuple(shape), align_corners=True)
+
+
+def _random_sigmas(tensor, snr, sigma, generator):
+    """ Draw the standard deviation of each sample from the desired
+    signal-to-noise ratio or from the standard deviation interval.
+    """
+    if snr is None and sigma is None:
+        raise ValueError("You must define either the desired signal-to noise "
+                         "ratio or the standard deviation for the noise "
+                         "distribution.")
+    n_samples = len(tensor)
+    if snr is not None:
+        s0 = tensor.reshape(n_samples, -1).max(dim=1)[0].float().cpu()
+        return torch.rand(n_samples, generator=generator) * s0 / snr
+    return _random(
+        interval(sigma, lower=0), (n_samples, ), "uniform", generator)
+
+
+def _reflect(tensor, pad):
+    """ Pad the last axis of a tensor by reflection about the edges of the
+    first and last elements.
+    """
+    size = tensor.shape[-1]
+    indices = torch.arange(-pad, size + pad) % (2 * size)
+    indices = torch.where(indices >= size, 2 * size - 1 - indices, indices)
+    return tensor.index_select(-1, indices.to(tensor.device))
+
+
+def _floating(tensor):
+    """ Cast integer tensors to float.
+    """
+    if tensor.dtype.is_floating_point:
+        return tensor
+    return tensor.float()
+
+
+def _randn(size, generator, device):
+    """ Draw normally distributed values with a generator that may live on
+    another device.
+    """
+    if generator is None:
+        return torch.randn(size, device=device)
+    return torch.randn(
+        size, generator=generator, device=generator.device).to(device)
+
+
+def _random(bounds, size, dist, generator):
+    """ Draw random variables from a uniform or lognormal distribution:
+    see 'pynet.augmentation.spatial.random_generator'.
+    """
+    if dist == "uniform":
+        return bounds[0] + (bounds[1] - bounds[0]) * torch.rand(
+            size, generator=generator)
+    elif dist == "lognormal":
+        sign = torch.randint(0, 2, size, generator=generator) * 2 - 1
+        values = torch.exp(torch.randn(size, generator=generator)) / 12.5
+        return values * sign * bounds[1]
+    raise ValueError("Unsupported sampling distribution.")
+
+
+def _resample(tensors, grid, order):
+    """ Resample the mini-batches on the sampling grid.
+    """
+    if not isinstance(order, (list, tuple)):
+        order = [order] * len(tensors)
+    transformed = []
+    for tensor, _order in zip(tensors, order):
+        if _order == 0:
+            mode = "nearest"
+        elif _order > 1 and tensor.ndim == 4:
+            mode = "bicubic"
+        else:
+            mode = "bilinear"
+        dtype = tensor.dtype
+        if not dtype.is_floating_point:
+            tensor = tensor.float()
+        tensor = func.grid_sample(
+            tensor, grid.to(device=tensor.device, dtype=tensor.dtype),
+            mode=mode, padding_mode="zeros", align_corners=True)
+        transformed.append(tensor.to(dtype))
+    return transformed
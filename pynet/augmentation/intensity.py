@@ -20,7 +20,9 @@ from scipy.spatial.transform import Rotation
 from scipy.ndimage import map_coordinates
 from .transform import compose
 from .transform import affine_flow
+from .transform import polynomial_basis
 from .utils import interval
+from .utils import get_rng
 
 
 def add_offset(arr, factor, seed=None):
@@ -32,7 +34,7 @@ def add_offset(arr, factor, seed=None):
         the input data.
     factor: float or 2-uplet
         the offset scale factor [0, 1] for the standard deviation and the mean.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -43,12 +45,13 @@ def add_offset(arr, factor, seed=None):
     factor = interval(factor, lower=factor)
     sigma = interval(factor[0], lower=0)
     mean = interval(factor[1])
-    np.random.seed(seed)
-    sigma_random = np.random.uniform(low=sigma[0], high=sigma[1], size=1)[0]
-    np.random.seed(seed)
-    mean_random = np.random.uniform(low=mean[0], high=mean[1], size=1)[0]
-    np.random.seed(seed)
-    offset = np.random.normal(mean_random, sigma_random, arr.shape)
+    rng = get_rng(seed)
+    sigma_random = rng.uniform(
+        low=sigma[0], high=sigma[1], size=1)[0]
+    mean_random = rng.uniform(
+        low=mean[0], high=mean[1], size=1)[0]
+    offset = rng.normal(
+        mean_random, sigma_random, arr.shape)
     offset += 1
     transformed = arr * offset
     return transformed
@@ -66,7 +69,7 @@ def add_blur(arr, snr=None, sigma=None, seed=None):
         for the noise distribution.
     sigma: float or 2-uplet
         the standard deviation for Gaussian kernel.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -82,8 +85,8 @@ def add_blur(arr, snr=None, sigma=None, seed=None):
         s0 = np.max(arr)
         sigma = s0 / snr
     sigma = interval(sigma, lower=0)
-    np.random.seed(seed)
-    sigma_random = np.random.uniform(low=sigma[0], high=sigma[1], size=1)[0]
+    sigma_random = get_rng(seed).uniform(
+        low=sigma[0], high=sigma[1], size=1)[0]
     return gaussian_filter(arr, sigma_random)
 
 
@@ -111,7 +114,7 @@ def add_noise(arr, snr=None, sigma=None, noise_type="gaussian", seed=None):
     noise_type: str, default 'gaussian'
         the distribution of added noise - can be either 'gaussian' for
         Gaussian distributed noise, or 'rician' for Rice-distributed noise.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -127,10 +130,11 @@ def add_noise(arr, snr=None, sigma=None, noise_type="gaussian", seed=None):
         s0 = np.max(arr)
         sigma = s0 / snr
     sigma = interval(sigma, lower=0)
-    np.random.seed(seed)
-    sigma_random = np.random.uniform(low=sigma[0], high=sigma[1], size=1)[0]
-    np.random.seed(seed)
-    noise = np.random.normal(0, sigma_random, [2] + list(arr.shape))
+    rng = get_rng(seed)
+    sigma_random = rng.uniform(
+        low=sigma[0], high=sigma[1], size=1)[0]
+    noise = rng.normal(
+        0, sigma_random, [2] + list(arr.shape))
     if noise_type == "gaussian":
         transformed = arr + noise[0]
     elif noise_type == "rician":
@@ -157,7 +161,7 @@ def add_ghosting(arr, axis, n_ghosts=10, intensity=1, seed=None):
     intensity: float or list of float, default 1
         a number between 0 and 1 representing the artifact strength. Larger
         values generate more distorted images.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -168,11 +172,10 @@ def add_ghosting(arr, axis, n_ghosts=10, intensity=1, seed=None):
     # Leave first 5% of frequencies untouched.
     n_ghosts = interval(n_ghosts, lower=0)
     intensity = interval(intensity, lower=0)
-    np.random.seed(seed)
-    n_ghosts_random = np.random.randint(
+    rng = get_rng(seed)
+    n_ghosts_random = rng.integers(
         low=n_ghosts[0], high=n_ghosts[1], size=1)[0]
-    np.random.seed(seed)
-    intensity_random = np.random.uniform(
+    intensity_random = rng.uniform(
         low=intensity[0], high=intensity[1], size=1)[0]
     percentage_to_avoid = 0.05
     values = arr.copy()
@@ -206,7 +209,7 @@ def add_spike(arr, n_spikes=1, intensity=(0.1, 1), seed=None):
     intensity: float or 2-uplet, default (0.1, 1)
         Ratio between the spike intensity and the maximum of the spectrum.
         Larger values generate more distorted images.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -215,10 +218,9 @@ def add_spike(arr, n_spikes=1, intensity=(0.1, 1), seed=None):
         the transformed input data.
     """
     intensity = interval(intensity, lower=0)
-    np.random.seed(seed)
-    spikes_positions = np.random.rand(n_spikes)
-    np.random.seed(seed)
-    intensity_factor = np.random.uniform(
+    rng = get_rng(seed)
+    spikes_positions = rng.random(n_spikes)
+    intensity_factor = rng.uniform(
         low=intensity[0], high=intensity[1], size=1)[0]
     spectrum = np.fft.fftshift(np.fft.fftn(arr)).ravel()
     indices = (spikes_positions * len(spectrum)).round().astype(int)
@@ -240,7 +242,7 @@ def add_biasfield(arr, coefficients=0.5, order=3, seed=None):
         the magnitude of polynomial coefficients.
     order: int, default 3
         the order of the basis polynomial functions.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -249,27 +251,16 @@ def add_biasfield(arr, coefficients=0.5, order=3, seed=None):
         the transformed input data.
     """
     coefficients = interval(coefficients)
-    shape = np.array(arr.shape)
-    ranges = [np.arange(-size, size) for size in (shape / 2.)]
-    bias_field = np.zeros(shape)
-    x_mesh, y_mesh, z_mesh = np.asarray(np.meshgrid(*ranges))
-    x_mesh /= x_mesh.max()
-    y_mesh /= y_mesh.max()
-    z_mesh /= z_mesh.max()
-    cnt = 0
-    np.random.seed(seed)
-    random_coefficients = np.random.uniform(
-        low=coefficients[0], high=coefficients[1], size=(order + 1)**3)
-    for x_order in range(order + 1):
-        for y_order in range(order + 1 - x_order):
-            for z_order in range(order + 1 - (x_order + y_order)):
-                random_coefficient = random_coefficients[cnt]
-                new_map = (
-                    random_coefficient * x_mesh ** x_order * y_mesh ** y_order
-                    * z_mesh ** z_order)
-                bias_field += new_map.transpose(1, 0, 2)
-                cnt += 1
-    bias_field = np.exp(bias_field).astype(np.float32)
+    shape = tuple(int(size) for size in arr.shape)
+    terms, factors = polynomial_basis(shape, order)
+    random_coefficients = get_rng(seed).uniform(
+        low=coefficients[0], high=coefficients[1], size=terms.size)
+    # The field is contracted axis by axis with the cached basis factors
+    bias_field = np.zeros(terms.shape, dtype=np.float32)
+    bias_field[terms] = random_coefficients[:np.sum(terms)]
+    for powers in factors:
+        bias_field = np.tensordot(bias_field, powers, axes=(0, 0))
+    bias_field = np.exp(bias_field, out=bias_field)
     return arr * bias_field
 
 
@@ -299,7 +290,7 @@ def add_motion(arr, rotation=10, translation=10, n_transforms=2,
     axis: int, default None
         the k-space filling axis. If not specified, randomize the k-space
         filling axis.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -309,22 +300,20 @@ def add_motion(arr, rotation=10, translation=10, n_transforms=2,
     """
     rotation = interval(rotation)
     translation = interval(translation)
+    rng = get_rng(seed)
     if axis is None:
-        np.random.seed(seed)
-        axis = np.random.randint(low=0, high=arr.ndim, size=1)[0]
+        axis = rng.integers(low=0, high=arr.ndim, size=1)[0]
     step = 1. / (n_transforms + 1)
     times = np.arange(0, 1, step)[1:]
     shape = arr.shape
-    noise = np.random.uniform(
+    noise = rng.uniform(
         low=(-step * perturbation), high=(step * perturbation),
         size=n_transforms)
     times += noise
     arrays = [arr]
-    np.random.seed(seed)
-    random_rotations = np.random.uniform(
+    random_rotations = rng.uniform(
         low=rotation[0], high=rotation[1], size=(n_transforms, arr.ndim))
-    np.random.seed(seed)
-    random_translations = np.random.uniform(
+    random_translations = rng.uniform(
         low=translation[0], high=translation[1], size=(n_transforms, arr.ndim))
     for cnt in range(n_transforms):
         random_rotations = Rotation.from_euler(
@@ -17,9 +17,11 @@ import numpy as np
 from scipy.spatial.transform import Rotation
 from scipy.ndimage import map_coordinates
 from .transform import compose
-from .transform import gaussian_random_field
+from .transform import identity_grid
+from .transform import random_deformation_field
 from .transform import affine_flow
 from .utils import interval
+from .utils import get_rng
 
 
 def affine(arr, rotation=10, translation=10, zoom=0.2, order=3, dist="uniform",
@@ -46,7 +48,7 @@ def affine(arr, rotation=10, translation=10, zoom=0.2, order=3, dist="uniform",
         the order of the spline interpolation in the range [0, 5].
     dist: str, default 'uniform'
         the sampling distribution: 'uniform' or 'lognormal'.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -54,19 +56,62 @@ def affine(arr, rotation=10, translation=10, zoom=0.2, order=3, dist="uniform",
     transformed: array
         the transformed input data.
     """
+    affine = affine_matrix(
+        arr, rotation=rotation, translation=translation, zoom=zoom,
+        dist=dist, seed=seed)
+    return resample(arr, affine, order=order)
+
+
+def affine_matrix(arr, rotation=10, translation=10, zoom=0.2,
+                  dist="uniform", seed=None):
+    """ Draw the random affine matrix used by the 'affine' transform.
+
+    Parameters
+    ----------
+    arr: array
+        the input data.
+    rotation, translation, zoom, dist, seed
+        see the 'affine' transform.
+
+    Returns
+    -------
+    affine: array (N+1, N+1)
+        the affine matrix that maps the centered output voxel coordinates
+        to the centered input voxel coordinates.
+    """
     rotation = interval(rotation)
     translation = interval(translation)
+    rng = get_rng(seed)
     random_rotations = random_generator(
-        rotation, arr.ndim, dist=dist, seed=seed)
+        rotation, arr.ndim, dist=dist, seed=rng)
     random_translations = random_generator(
-        translation, arr.ndim, dist=dist, seed=seed)
-    np.random.seed(seed)
-    random_zooms = np.random.uniform(
+        translation, arr.ndim, dist=dist, seed=rng)
+    random_zooms = rng.uniform(
         low=(1 - zoom), high=(1 + zoom), size=arr.ndim)
     random_rotations = Rotation.from_euler(
         "xyz", random_rotations, degrees=True)
     random_rotations = random_rotations.as_matrix()
-    affine = compose(random_translations, random_rotations, random_zooms)
+    return compose(random_translations, random_rotations, random_zooms)
+
+
+def resample(arr, affine, order=3):
+    """ Resample an array with an affine transformation.
+
+    Parameters
+    ----------
+    arr: array
+        the input data.
+    affine: array (N+1, N+1)
+        the affine matrix that maps the centered output voxel coordinates
+        to the centered input voxel coordinates.
+    order: int, default 3
+        the order of the spline interpolation in the range [0, 5].
+
+    Returns
+    -------
+    transformed: array
+        the transformed input data.
+    """
     shape = arr.shape
     flow = affine_flow(affine, shape)
     locs = flow.reshape(len(shape), -1)
@@ -84,7 +129,7 @@ def flip(arr, axis=None, seed=None):
     axis: int, default None
         apply flip on the specified axis. If not specified, randomize the
         flip axis.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -93,12 +138,35 @@ def flip(arr, axis=None, seed=None):
         the transformed input data.
     """
     if axis is None:
-        np.random.seed(seed)
-        axis = np.random.randint(low=0, high=arr.ndim, size=1)[0]
+        axis = get_rng(seed).integers(low=0, high=arr.ndim, size=1)[0]
     return np.flip(arr, axis=axis)
 
 
-def deformation(arr, max_displacement=4, alpha=3, order=3, seed=None):
+def flip_matrix(arr, axis=None, seed=None):
+    """ Draw the affine matrix equivalent to the 'flip' transform.
+
+    Parameters
+    ----------
+    arr: array
+        the input data.
+    axis, seed
+        see the 'flip' transform.
+
+    Returns
+    -------
+    affine: array (N+1, N+1)
+        the affine matrix that maps the centered output voxel coordinates
+        to the centered input voxel coordinates.
+    """
+    if axis is None:
+        axis = get_rng(seed).integers(low=0, high=arr.ndim, size=1)[0]
+    affine = np.eye(arr.ndim + 1)
+    affine[axis, axis] = -1
+    return affine
+
+
+def deformation(arr, max_displacement=4, alpha=3, order=3, downsampling=1,
+                seed=None):
     """ Apply dense random elastic deformation.
 
     Reference: Khanal B, Ayache N, Pennec X., Simulating Longitudinal
@@ -117,7 +185,10 @@ def deformation(arr, max_displacement=4, alpha=3, order=3, seed=None):
         genrate smoother fields.
     order: int, default 3
         the order of the spline interpolation in the range [0, 5].
-    seed: int, default None
+    downsampling: int, default 1
+        if greater than one, draw the displacement field on a grid
+        downsampled by this factor and upsample it.
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -125,28 +196,10 @@ def deformation(arr, max_displacement=4, alpha=3, order=3, seed=None):
     transformed: array
         the transformed input data.
     """
-    kwargs = {"seed": seed}
-    flow_x = gaussian_random_field(
-        arr.shape[:2], alpha=alpha, normalize=True, **kwargs)
-    flow_x /= flow_x.max()
-    flow_x = np.asarray([flow_x] * arr.shape[-1]).transpose(1, 2, 0)
-    if seed is not None:
-        kwargs = {"seed": seed + 2}
-    flow_y = gaussian_random_field(
-        arr.shape[:2], alpha=alpha, normalize=True, **kwargs)
-    flow_y /= flow_y.max()
-    flow_y = np.asarray([flow_y] * arr.shape[-1]).transpose(1, 2, 0)
-    if seed is not None:
-        kwargs = {"seed": seed + 4}
-    flow_z = gaussian_random_field(
-        arr.shape[:2], alpha=alpha, normalize=True, **kwargs)
-    flow_z /= flow_z.max()
-    flow_z = np.asarray([flow_z] * arr.shape[-1]).transpose(1, 2, 0)
-    flow = np.asarray([flow_x, flow_y, flow_z])
-    flow *= max_displacement
-    ranges = [np.arange(size) for size in arr.shape]
-    locs = np.asarray(np.meshgrid(*ranges)).transpose(0, 2, 1, 3).astype(float)
-    locs += flow
+    flow = random_deformation_field(
+        arr.shape, max_displacement=max_displacement, alpha=alpha,
+        downsampling=downsampling, seed=seed)
+    locs = identity_grid(arr.shape) + flow
     locs = locs.reshape(len(locs), -1)
     transformed = map_coordinates(arr, locs, order=order, cval=0)
     return transformed.reshape(arr.shape)
@@ -164,7 +217,7 @@ def random_generator(interval, size, dist="uniform", seed=None):
         distribution.
     dist: str, default 'uniform'
         the sampling distribution: 'uniform' or 'lognormal'.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -172,20 +225,19 @@ def random_generator(interval, size, dist="uniform", seed=None):
     random_variables: array
         the generated random variable.
     """
+    rng = get_rng(seed)
     if dist == "uniform":
-        np.random.seed(seed)
-        random_variables = np.random.uniform(
+        random_variables = rng.uniform(
             low=interval[0], high=interval[1], size=size)
     # max height occurs at x = exp(mean - sigma**2)
     # FWHM is found by finding the values of x at 1/2 the max height =
     # exp((mean - sigma**2) + sqrt(2*sigma**2*ln(2))) - exp((mean - sigma**2)
     # - sqrt(2*sigma**2*ln(2)))
     elif dist == "lognormal":
-        np.random.seed(seed)
-        sign = np.random.randint(0, 2, size=size) * 2 - 1
-        sign = sign.astype(np.float)
-        np.random.seed(seed)
-        random_variables = np.random.lognormal(mean=0., sigma=1., size=size)
+        sign = rng.integers(0, 2, size=size) * 2 - 1
+        sign = sign.astype(float)
+        random_variables = rng.lognormal(
+            mean=0., sigma=1., size=size)
         random_variables /= 12.5
         random_variables *= (sign * interval[1])
     else:
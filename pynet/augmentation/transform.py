@@ -15,8 +15,11 @@ Code: https://github.com/bsciolla/gaussian-random-fields
 
 # Import
 import math
+import functools
 import numpy as np
+import scipy.fft
 import scipy.fftpack
+from .utils import get_rng
 
 
 # Caching dictionary for common shear Ns, indices
@@ -159,7 +162,7 @@ def gaussian_random_field(shape, alpha=3.0, normalize=True, seed=None):
     normalize: bool, default True
         normalizes the Gaussian field to have an average of 0.0 and a standard
         deviation of 1.0.
-    seed: int, default None
+    seed: int, SeedSequence or Generator, default None
         seed to control random number generator.
 
     Returns
@@ -175,12 +178,9 @@ def gaussian_random_field(shape, alpha=3.0, normalize=True, seed=None):
     amplitude[0, 0] = 0
 
     # Draws a complex gaussian random noise with normal (circular) distribution
-    if seed is not None:
-        np.random.seed(seed)
-    noise = np.random.normal(size=shape) + 0j
-    if seed is not None:
-        np.random.seed(seed + 1)
-    noise += 1j * np.random.normal(size=shape)
+    rng = get_rng(seed)
+    noise = rng.normal(size=shape) + 0j
+    noise += 1j * rng.normal(size=shape)
 
     # To real space
     gfield = np.fft.ifft2(noise * amplitude).real
@@ -191,3 +191,158 @@ def gaussian_random_field(shape, alpha=3.0, normalize=True, seed=None):
         gfield = gfield / np.std(gfield)
 
     return gfield
+
+
+@functools.lru_cache(maxsize=32)
+def amplitude_spectrum(shape, alpha=3.0):
+    """ Returns the power-law amplitude spectrum 1/|k|^(alpha/2) of a real
+    gaussian random field on the half-spectrum computed by 'rfftn'.
+
+    The spectrum is cached per shape: the returned array is read-only.
+
+    Parameters
+    ----------
+    shape: uplet
+        the shape of the gaussian random field.
+    alpha: float, default 3
+        the power of the power-law momentum distribution.
+
+    Returns
+    -------
+    amplitude: array
+        the float32 amplitude spectrum with a null mean component.
+    """
+    freqs = [scipy.fft.fftfreq(size, d=(1. / size)) for size in shape[:-1]]
+    freqs.append(scipy.fft.rfftfreq(shape[-1], d=(1. / shape[-1])))
+    norm = np.zeros([len(item) for item in freqs], dtype=np.float32)
+    for axis, item in enumerate(freqs):
+        view = [1] * len(freqs)
+        view[axis] = -1
+        norm += (item.astype(np.float32) ** 2).reshape(view)
+    amplitude = np.power(norm + 1e-10, -alpha / 4.)
+    amplitude.flat[0] = 0
+    amplitude.setflags(write=False)
+    return amplitude
+
+
+@functools.lru_cache(maxsize=32)
+def polynomial_basis(shape, order=3):
+    """ Returns the polynomial basis of a bias field as separable factors:
+    the powers of the normalized coordinates along each axis.
+
+    A basis function is the product of one power per axis, the sum of the
+    powers being at most 'order'. The basis is cached per shape and order:
+    the returned arrays are read-only.
+
+    Parameters
+    ----------
+    shape: uplet
+        the shape of the bias field.
+    order: int, default 3
+        the order of the basis polynomial functions.
+
+    Returns
+    -------
+    terms: array (order + 1, ) * N
+        the boolean mask of the powers that define a basis function.
+    factors: tuple of array (order + 1, size)
+        the float32 powers of the coordinates along each axis.
+    """
+    terms = np.indices((order + 1, ) * len(shape)).sum(axis=0) <= order
+    terms.setflags(write=False)
+    factors = []
+    for size in shape:
+        coords = np.arange(-size / 2., size / 2.)
+        coords /= coords.max()
+        powers = coords[np.newaxis] ** np.arange(order + 1)[:, np.newaxis]
+        powers = powers.astype(np.float32)
+        powers.setflags(write=False)
+        factors.append(powers)
+    return terms, tuple(factors)
+
+
+@functools.lru_cache(maxsize=32)
+def identity_grid(shape):
+    """ Returns the voxel coordinates of an image.
+
+    The grid is cached per shape: the returned array is read-only.
+
+    Parameters
+    ----------
+    shape: uplet
+        the image shape.
+
+    Returns
+    -------
+    grid: array (N, *shape)
+        the float32 voxel coordinates.
+    """
+    grid = np.stack(np.meshgrid(
+        *[np.arange(size, dtype=np.float32) for size in shape],
+        indexing="ij"))
+    grid.setflags(write=False)
+    return grid
+
+
+def random_deformation_field(shape, max_displacement=4, alpha=3.0,
+                             downsampling=1, seed=None):
+    """ Generates a dense random displacement field: one 2D or 3D gaussian
+    random field per axis is drawn in the Fourier domain in float32, using
+    a cached amplitude spectrum.
+
+    Parameters
+    ----------
+    shape: uplet
+        the shape of the displacement field.
+    max_displacement: float, default 4
+        the maximum displacement in voxel along each dimension.
+    alpha: float, default 3
+        the power of the power-law momentum distribution. Larger values
+        genrate smoother fields.
+    downsampling: int, default 1
+        if greater than one, the fields are drawn on a grid downsampled
+        by this factor and linearly upsampled: as the fields are smooth,
+        this reduces the cost of the FFTs without visible effect.
+    seed: int, SeedSequence or Generator, default None
+        seed to control random number generator.
+
+    Returns
+    -------
+    flow: array (N, *shape)
+        the float32 displacement field in voxel.
+    """
+    shape = tuple(int(size) for size in shape)
+    draw_shape = tuple(
+        max(int(math.ceil(size / downsampling)), 2) for size in shape)
+    axes = tuple(range(1, len(shape) + 1))
+    rng = get_rng(seed)
+    noise = rng.standard_normal(
+        (len(shape), ) + draw_shape, dtype=np.float32)
+    spectrum = scipy.fft.rfftn(noise, axes=axes)
+    spectrum *= amplitude_spectrum(draw_shape, alpha)
+    flow = scipy.fft.irfftn(spectrum, s=draw_shape, axes=axes)
+    flow = flow.reshape(len(shape), -1)
+    flow -= flow.mean(axis=1, keepdims=True)
+    flow /= flow.std(axis=1, keepdims=True)
+    flow /= flow.max(axis=1, keepdims=True)
+    flow *= max_displacement
+    flow = flow.reshape((len(shape), ) + draw_shape)
+    for axis, size in enumerate(shape):
+        flow = _upsample(flow, size, axis + 1)
+    return flow
+
+
+def _upsample(arr, size, axis):
+    """ Linearly resample an array along one axis, the first and last
+    samples being aligned.
+    """
+    if arr.shape[axis] == size:
+        return arr
+    locs = np.linspace(0, arr.shape[axis] - 1, size, dtype=np.float32)
+    lower = np.minimum(locs.astype(int), arr.shape[axis] - 2)
+    weights = (locs - lower).astype(np.float32)
+    view = [1] * arr.ndim
+    view[axis] = -1
+    weights = weights.reshape(view)
+    return (np.take(arr, lower, axis=axis) * (1 - weights) +
+            np.take(arr, lower + 1, axis=axis) * weights)
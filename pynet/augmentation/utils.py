@@ -14,6 +14,7 @@ A module with common functions.
 
 # Import
 import numbers
+import numpy as np
 
 
 def interval(obj, lower=None):
@@ -44,3 +45,69 @@ def interval(obj, lower=None):
     if min_val > max_val:
         raise ValueError("Wrong interval boudaries.")
     return tuple(obj)
+
+
+def get_rng(seed=None):
+    """ Create a random number generator.
+
+    Parameters
+    ----------
+    seed: int, SeedSequence or Generator, default None
+        seed to control random number generator. A generator is returned
+        as it is, so that the successive draws of a function share it.
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+        the random number generator.
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def seed_sequence(seed=None):
+    """ Create a seed sequence.
+
+    Parameters
+    ----------
+    seed: int, SeedSequence or Generator, default None
+        seed to control random number generator. If not specified, fresh
+        entropy is drawn from the operating system.
+
+    Returns
+    -------
+    sequence: numpy.random.SeedSequence
+        the seed sequence.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        seed = int(seed.integers(2 ** 63))
+    return np.random.SeedSequence(seed)
+
+
+def derive_seed(seed, *keys):
+    """ Derive an independent seed sequence identified by a set of keys,
+    for instance an epoch and a sample index.
+
+    Contrary to 'SeedSequence.spawn', the input sequence is not modified,
+    so that the same keys always give the same child sequence.
+
+    Parameters
+    ----------
+    seed: int, SeedSequence or Generator
+        the parent seed (see 'seed_sequence').
+    keys: int
+        the positive integers that identify the child sequence.
+
+    Returns
+    -------
+    sequence: numpy.random.SeedSequence
+        the child seed sequence.
+    """
+    sequence = seed_sequence(seed)
+    return np.random.SeedSequence(
+        sequence.entropy, pool_size=sequence.pool_size,
+        spawn_key=(tuple(sequence.spawn_key) +
+                   tuple(int(key) for key in keys)))
@@ -16,13 +16,18 @@ import re
 import os
 import copy
 import types
+import queue
 import warnings
 import logging
-from collections import OrderedDict
+import traceback
+import contextlib
+import multiprocessing
+from collections import namedtuple, OrderedDict
 
 # Third party import
 import torch
 import torch.nn.functional as func
+from torch.nn.parallel import DistributedDataParallel
 import progressbar
 import numpy as np
 
@@ -31,18 +36,29 @@ from pynet.utils import checkpoint
 from pynet.history import History
 from pynet.observable import Observable
 from pynet.utils import Metrics
+from pynet.metrics import MetricsAccumulator
+from pynet.sinks import get_sink
+from pynet.distributed import is_distributed, is_main_process
 
 
 # Global parameters
+PredictItem = namedtuple("PredictItem", ["y", "inputs", "targets"])
 logger = logging.getLogger("pynet")
 
 
 class Base(Observable):
     """ Base class for perform Deep Learning training.
     """
+    PRECISIONS = {
+        "fp32": torch.float32,
+        "bf16": torch.bfloat16,
+        "fp16": torch.float16
+    }
+
     def __init__(self, optimizer_name="Adam", learning_rate=1e-3,
                  loss_name="NLLLoss", metrics=None, use_cuda=False,
-                 pretrained=None, resume=False, add_labels=False, **kwargs):
+                 pretrained=None, resume=False, add_labels=False,
+                 precision="fp32", distributed=False, **kwargs):
         """ Class instantiation.
 
         Observers will be notified, allowed signals are:
@@ -73,6 +89,18 @@ class Base(Observable):
         add_labels: bool, default False
             if set and labels are specified in the data manager, add the labels
             to the forward function parameters.
+        precision: str, default 'fp32'
+            the floating point precision used during the forward pass:
+            'fp32' (full precision), 'bf16' (bfloat16 mixed precision,
+            available on both CPU and GPU) or 'fp16' (float16 mixed
+            precision with dynamic loss scaling, GPU only).
+        distributed: bool, default False
+            if set, train the model with distributed data parallelism: the
+            default process group must be initialized (see
+            'pynet.distributed.launch'), each process loads its own shard of
+            the data, the gradients, loss and metrics are averaged over the
+            processes, and only the rank 0 process writes the checkpoints
+            and histories.
         kwargs: dict
             specify directly a custom 'model', 'optimizer' or 'loss'. Can also
             be used to set specific optimizer parameters.
@@ -119,6 +147,16 @@ class Base(Observable):
             self.metrics[obj_or_name] = Metrics.get_registry()[obj_or_name]
         if use_cuda and not torch.cuda.is_available():
             raise ValueError("No GPU found: unset 'use_cuda' parameter.")
+        if precision not in self.PRECISIONS:
+            raise ValueError("Unsupported precision '{0}': available "
+                             "precisions are {1}.".format(
+                                 precision, list(self.PRECISIONS)))
+        if precision == "fp16" and not use_cuda:
+            raise ValueError("The 'fp16' precision requires a GPU: use the "
+                             "'bf16' precision on CPU.")
+        self.precision = precision
+        self.scaler = torch.amp.GradScaler(
+            "cuda", enabled=(precision == "fp16"))
         self.checkpoint = None
         if pretrained is not None:
             kwargs = {}
@@ -133,14 +171,43 @@ class Base(Observable):
                 if self.resume and "optimizer" in self.checkpoint:
                     self.optimizer.load_state_dict(
                         self.checkpoint["optimizer"])
+                if self.resume and "scaler" in self.checkpoint:
+                    self.scaler.load_state_dict(self.checkpoint["scaler"])
             else:
                 self.model.load_state_dict(self.checkpoint)
         self.device = torch.device("cuda" if use_cuda else "cpu")
         self.model = self.model.to(self.device)
+        self.distributed = distributed
+        self.parallel_model = None
+        if distributed:
+            if not is_distributed():
+                raise ValueError("The distributed mode requires an "
+                                 "initialized process group.")
+            kwargs = {}
+            if use_cuda:
+                kwargs["device_ids"] = [self.device.index or 0]
+            self.parallel_model = DistributedDataParallel(
+                self.model, **kwargs)
+
+    def autocast(self):
+        """ Context manager that runs the enclosed forward pass with the
+        requested floating point precision.
+
+        Returns
+        -------
+        context: torch.autocast
+            the autocast context, disabled in full precision.
+        """
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=self.PRECISIONS[self.precision],
+            enabled=(self.precision != "fp32"))
 
     def training(self, manager, nb_epochs, checkpointdir=None, fold_index=None,
                  scheduler=None, with_validation=True, save_after_epochs=1,
-                 add_labels=False):
+                 add_labels=False, accumulation_steps=1,
+                 micro_batch_size=None, prefetch=0, sync_steps=None,
+                 n_jobs=1):
         """ Train the model.
 
         Parameters
@@ -162,6 +229,26 @@ class Base(Observable):
         save_after_epochs: int, default 1
             determines when the model is saved and represents the number of
             epochs before saving.
+        accumulation_steps: int, default 1
+            the number of mini-batches over which the gradients are
+            accumulated before updating the model weights.
+        micro_batch_size: int, default None
+            if set, split each mini-batch into micro-batches of this size
+            in order to bound the memory footprint.
+        prefetch: int, default 0
+            if set, the number of mini-batches loaded and transfered to the
+            device in advance in a background thread.
+        sync_steps: int, default None
+            if set, the running training loss and metrics are synchronized
+            and logged every 'sync_steps' mini-batches, otherwise only at the
+            end of each epoch.
+        n_jobs: int, default 1
+            the number of folds trained in parallel (CPU only). Each fold
+            runs in its own process pinned to a subset of the available
+            CPUs, and saves its checkpoints in a 'fold_<index>' sub-folder
+            of the checkpoint directory. The fold histories are merged at
+            the end, and the epoch signals are relayed to the observers of
+            the calling process. Not available in distributed mode.
 
         Returns
         -------
@@ -170,18 +257,38 @@ class Base(Observable):
         """
         if self.resume and "scheduler" in self.checkpoint:
             scheduler.load_state_dict(self.checkpoint["scheduler"])
-        if checkpointdir is not None and not os.path.isdir(checkpointdir):
+        if (checkpointdir is not None and is_main_process() and
+                not os.path.isdir(checkpointdir)):
             os.mkdir(checkpointdir)
-        train_history = History(name="train")
-        if with_validation is not None:
-            valid_history = History(name="validation")
-        else:
-            valid_history = None
         logger.info("Loss function {0}.".format(self.loss))
         logger.info("Optimizer function {0}.".format(self.optimizer))
         folds = range(manager.number_of_folds)
         if fold_index is not None:
             folds = [fold_index]
+        fold_kwargs = dict(
+            nb_epochs=nb_epochs, scheduler=scheduler,
+            with_validation=with_validation,
+            save_after_epochs=save_after_epochs,
+            accumulation_steps=accumulation_steps,
+            micro_batch_size=micro_batch_size, prefetch=prefetch,
+            sync_steps=sync_steps)
+        if n_jobs > 1 and self.distributed:
+            raise ValueError("The folds can't be trained in parallel in "
+                             "distributed mode.")
+        if n_jobs > 1 and len(folds) > 1:
+            histories = self._parallel_folds(
+                manager, folds, n_jobs=n_jobs, checkpointdir=checkpointdir,
+                **fold_kwargs)
+            train_history = History.merge(
+                [item[0] for item in histories], name="train")
+            valid_history = History.merge(
+                [item[1] for item in histories], name="validation")
+            return train_history, valid_history
+        train_history = History(name="train")
+        if with_validation is not None:
+            valid_history = History(name="validation")
+        else:
+            valid_history = None
         init_optim_state = copy.deepcopy(self.optimizer.state_dict())
         init_model_state = copy.deepcopy(self.model.state_dict())
         if scheduler is not None:
@@ -192,72 +299,219 @@ class Base(Observable):
             self.model.load_state_dict(init_model_state)
             if scheduler is not None:
                 scheduler.load_state_dict(init_scheduler_state)
-            loaders = manager.get_dataloader(
-                train=True,
-                validation=with_validation,
-                fold_index=fold)
-            for epoch in range(nb_epochs):
-                logger.debug("Running epoch {0}:".format(fold))
-                logger.debug("  notify observers with signal 'before_epoch'.")
-                self.notify_observers("before_epoch", epoch=epoch, fold=fold)
-                observers_kwargs = {}
-                logger.debug("  train.")
-                loss, values = self.train(loaders.train)
-                observers_kwargs["loss"] = loss
-                observers_kwargs.update(values)
-                if scheduler is not None:
-                    logger.debug("  update scheduler.")
-                    scheduler.step(loss)
-                    logger.debug("  - lr: {0}".format(scheduler.get_lr()))
-                logger.debug("  update train history.")
-                train_history.log((fold, epoch), loss=loss, **values)
+            self._train_fold(
+                manager, fold, train_history, valid_history,
+                checkpointdir=checkpointdir, **fold_kwargs)
+        return train_history, valid_history
+
+    def _train_fold(self, manager, fold, train_history, valid_history,
+                    nb_epochs, checkpointdir=None, scheduler=None,
+                    with_validation=True, save_after_epochs=1,
+                    accumulation_steps=1, micro_batch_size=None, prefetch=0,
+                    sync_steps=None):
+        """ Train the model on one fold: see 'training' for a description of
+        the parameters.
+        """
+        loaders = manager.get_dataloader(
+            train=True,
+            validation=with_validation,
+            fold_index=fold,
+            prefetch=prefetch,
+            device=self.device,
+            distributed=self.distributed)
+        save_checkpoint = checkpointdir is not None and is_main_process()
+        for epoch in range(nb_epochs):
+            logger.debug("Running epoch {0}:".format(fold))
+            logger.debug("  notify observers with signal 'before_epoch'.")
+            self.notify_observers("before_epoch", epoch=epoch, fold=fold)
+            observers_kwargs = {}
+            if hasattr(loaders.train.sampler, "set_epoch"):
+                loaders.train.sampler.set_epoch(epoch)
+            if hasattr(loaders.train.dataset, "set_epoch"):
+                loaders.train.dataset.set_epoch(epoch)
+            logger.debug("  train.")
+            loss, values = self.train(
+                loaders.train, accumulation_steps=accumulation_steps,
+                micro_batch_size=micro_batch_size, sync_steps=sync_steps)
+            observers_kwargs["loss"] = loss
+            observers_kwargs.update(values)
+            if scheduler is not None:
+                logger.debug("  update scheduler.")
+                scheduler.step(loss)
+                logger.debug("  - lr: {0}".format(scheduler.get_lr()))
+            logger.debug("  update train history.")
+            train_history.log((fold, epoch), loss=loss, **values)
+            if is_main_process():
                 train_history.summary()
-                if (checkpointdir is not None and
-                        epoch % save_after_epochs == 0):
+            if save_checkpoint and epoch % save_after_epochs == 0:
+                logger.debug("  create checkpoint.")
+                kwargs = {}
+                if self.scaler.is_enabled():
+                    kwargs["scaler"] = self.scaler.state_dict()
+                checkpoint(
+                    model=self.model,
+                    epoch=epoch,
+                    fold=fold,
+                    outdir=checkpointdir,
+                    optimizer=self.optimizer,
+                    scheduler=scheduler,
+                    **kwargs)
+                train_history.save(
+                    outdir=checkpointdir,
+                    epoch=epoch,
+                    fold=fold)
+            if with_validation:
+                logger.debug("  validation.")
+                y_pred, loss, values = self.test(loaders.validation)
+                observers_kwargs["val_loss"] = loss
+                observers_kwargs.update(dict(
+                    ("val_{0}".format(key), val)
+                    for key, val in values.items()))
+                observers_kwargs["val_pred"] = y_pred
+                logger.debug("  update validation history.")
+                valid_history.log((fold, epoch), loss=loss, **values)
+                if is_main_process():
+                    valid_history.summary()
+                if save_checkpoint and epoch % save_after_epochs == 0:
                     logger.debug("  create checkpoint.")
-                    checkpoint(
-                        model=self.model,
-                        epoch=epoch,
-                        fold=fold,
-                        outdir=checkpointdir,
-                        optimizer=self.optimizer,
-                        scheduler=scheduler)
-                    train_history.save(
+                    valid_history.save(
                         outdir=checkpointdir,
                         epoch=epoch,
                         fold=fold)
-                if with_validation:
-                    logger.debug("  validation.")
-                    y_pred, loss, values = self.test(loaders.validation)
-                    observers_kwargs["val_loss"] = loss
-                    observers_kwargs.update(dict(
-                        ("val_{0}".format(key), val)
-                        for key, val in values.items()))
-                    observers_kwargs["val_pred"] = y_pred
-                    logger.debug("  update validation history.")
-                    valid_history.log((fold, epoch), loss=loss, **values)
-                    valid_history.summary()
-                    if (checkpointdir is not None and
-                            epoch % save_after_epochs == 0):
-                        logger.debug("  create checkpoint.")
-                        valid_history.save(
-                            outdir=checkpointdir,
-                            epoch=epoch,
-                            fold=fold)
-                logger.debug("  notify observers with signal 'after_epoch'.")
-                self.notify_observers("after_epoch", epoch=epoch, fold=fold,
-                                      **observers_kwargs)
-                logger.debug("End epoch.".format(fold))
-            logger.debug("End fold.")
-        return train_history, valid_history
+            logger.debug("  notify observers with signal 'after_epoch'.")
+            self.notify_observers("after_epoch", epoch=epoch, fold=fold,
+                                  **observers_kwargs)
+            logger.debug("End epoch.".format(fold))
+        logger.debug("End fold.")
+
+    def _parallel_folds(self, manager, folds, n_jobs, checkpointdir=None,
+                        **kwargs):
+        """ Train the folds in parallel in spawned processes, one process per
+        fold, each process being pinned to its own subset of CPUs.
+
+        The workers are started with the 'spawn' method: forking a process
+        whose torch/OpenMP thread pools are running may deadlock. The
+        interface and the manager are thus pickled: the memory-mapped
+        arrays are sent by reference. The 'before_epoch' and 'after_epoch'
+        signals of the workers are relayed to the observers of this
+        process, while the 'regularizer' observers run in the workers on
+        their own copies.
+
+        Returns
+        -------
+        histories: list of 2-uplet
+            the train/validation histories of each fold.
+        """
+        if self.device.type != "cpu":
+            raise ValueError("The parallel folds are only supported on CPU.")
+        n_jobs = min(n_jobs, len(folds))
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count()))
+        cpu_subsets = [
+            [int(cpu) for cpu in subset] or cpus
+            for subset in np.array_split(cpus, n_jobs)]
+        logger.info("Running {0} folds on {1} workers.".format(
+            len(folds), n_jobs))
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        pending = list(folds)
+        free_slots = list(range(n_jobs))
+        running = {}
+        histories = {}
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(free_slots) > 0:
+                    fold, slot = pending.pop(0), free_slots.pop(0)
+                    fold_checkpointdir = None
+                    if checkpointdir is not None:
+                        fold_checkpointdir = os.path.join(
+                            checkpointdir, "fold_{0}".format(fold))
+                    process = context.Process(
+                        target=self._fold_worker,
+                        args=(results, manager, fold, cpu_subsets[slot],
+                              fold_checkpointdir),
+                        kwargs=kwargs)
+                    process.start()
+                    running[fold] = (slot, process)
+                try:
+                    fold, status, payload = results.get(timeout=1)
+                except queue.Empty:
+                    for fold, (slot, process) in running.items():
+                        if not process.is_alive():
+                            raise RuntimeError(
+                                "The worker of fold {0} died unexpectedly "
+                                "with exit code {1}.".format(
+                                    fold, process.exitcode))
+                    continue
+                if status == "signal":
+                    signal, signal_kwargs = payload
+                    self.notify_observers(signal, **signal_kwargs)
+                    continue
+                slot, process = running.pop(fold)
+                process.join()
+                free_slots.append(slot)
+                if status == "error":
+                    raise RuntimeError("The training of fold {0} failed:\n"
+                                       "{1}".format(fold, payload))
+                histories[fold] = payload
+        finally:
+            for slot, process in running.values():
+                process.terminate()
+                process.join()
+        return [histories[fold] for fold in folds]
+
+    def _fold_worker(self, results, manager, fold, cpus, checkpointdir,
+                     **kwargs):
+        """ Train one fold in a worker process and send back the histories.
+        """
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cpus)
+            torch.set_num_threads(len(cpus))
+            notify_observers = self.notify_observers
 
-    def train(self, loader):
+            def relay_observers(signal, **signal_kwargs):
+                if signal in ("before_epoch", "after_epoch"):
+                    results.put((fold, "signal", (signal, signal_kwargs)))
+                    return []
+                return notify_observers(signal, **signal_kwargs)
+
+            self.notify_observers = relay_observers
+            if checkpointdir is not None and not os.path.isdir(checkpointdir):
+                os.mkdir(checkpointdir)
+            train_history = History(name="train")
+            valid_history = None
+            if kwargs["with_validation"] is not None:
+                valid_history = History(name="validation")
+            self._train_fold(
+                manager, fold, train_history, valid_history,
+                checkpointdir=checkpointdir, **kwargs)
+            results.put((fold, "done", (train_history, valid_history)))
+        except Exception:
+            results.put((fold, "error", traceback.format_exc()))
+
+    def train(self, loader, accumulation_steps=1, micro_batch_size=None,
+              sync_steps=None):
         """ Train the model on the trained data.
 
         Parameters
         ----------
         loader: a pytorch Dataset
             the data laoder.
+        accumulation_steps: int, default 1
+            the number of mini-batches over which the gradients are
+            accumulated before updating the model weights: the logical
+            batch size is 'accumulation_steps' times the loader batch size.
+        micro_batch_size: int, default None
+            if set, split each mini-batch into micro-batches of this size
+            that are forwarded/backwarded one after another, so that the
+            memory footprint is bounded by the micro-batch size.
+        sync_steps: int, default None
+            the loss and metrics are accumulated on the device and only
+            synchronized at the end of the epoch. If set, the running values
+            are also synchronized and logged every 'sync_steps' mini-batches.
 
         Returns
         -------
@@ -266,73 +520,159 @@ class Base(Observable):
         values: dict
             the values of the metrics.
         """
+        if accumulation_steps < 1:
+            raise ValueError("The number of accumulation steps must be a "
+                             "positive integer.")
         logger.debug("Update model for training.")
-        self.model.train()
+        model = self.parallel_model if self.distributed else self.model
+        model.train()
         nb_batch = len(loader)
-        values = {}
-        loss = 0
+        accumulator = MetricsAccumulator(
+            device=self.device, distributed=self.distributed)
         pbar = progressbar.ProgressBar(
-            max_value=nb_batch, redirect_stdout=True, prefix="Mini-batch ")
+            max_value=nb_batch, max_error=False, redirect_stdout=True,
+            prefix="Mini-batch ")
         pbar.start()
+        self.optimizer.zero_grad()
+        window_samples = 0
         for iteration, dataitem in enumerate(loader):
             logger.debug("Mini-batch {0}:".format(iteration))
             pbar.update(iteration + 1)
-            logger.debug("  transfer inputs to {0}.".format(self.device))
-            inputs = dataitem.inputs.to(self.device)
-            logger.debug("  transfer targets to {0}.".format(self.device))
-            targets = []
-            for item in (dataitem.outputs, dataitem.labels):
-                if item is not None:
-                    targets.append(item.to(self.device))
-            args = ()
-            if self.add_labels and dataitem.labels is not None:
-                args = (targets[-1], )
-            logger.debug("  evaluate model.")
-            self.optimizer.zero_grad()
-            output_items = self.model(inputs, *args)
-            if (not isinstance(output_items, tuple) and
-                    not isinstance(output_items, list)):
-                outputs = output_items
-                layer_outputs = None
-            elif len(output_items) == 1:
-                outputs = output_items[0]
-                layer_outputs = None
-            elif len(output_items) == 2:
-                outputs, layer_outputs = output_items
-            else:
-                raise ValueError(
-                    "The forward method can only return one or "
-                    "two parameters: the forward output, and "
-                    "as an option specific layer outputs dict.")
-            logger.debug("  update loss.")
-            logger.debug("  outputs: {0} - {1}".format(
-                outputs.shape, outputs.dtype))
-            logger.debug("  targets: {0}".format(len(targets)))
-            if hasattr(self.loss, "layer_outputs"):
-                self.loss.layer_outputs = layer_outputs
-            batch_loss = self.loss(outputs, *targets)
-            regularizations = self.notify_observers(
-                "regularizer", layer_outputs=layer_outputs)
-            for reg in regularizations:
-                batch_loss += reg
-            logger.debug("  update model weights.")
-            batch_loss.backward()
-            self.optimizer.step()
-            loss += batch_loss.item() / nb_batch
-            for name, metric in self.metrics.items():
-                logger.debug("  compute metric '{0}'.".format(name))
-                if hasattr(metric, "layer_outputs"):
-                    metric.layer_outputs = layer_outputs
-                if name not in values:
-                    values[name] = 0
-                values[name] += float(metric(outputs, *targets)) / nb_batch
+            # The last window is flushed after the loop: an iterable
+            # dataset split over several workers may yield more mini-batches
+            # than the loader length
+            update = (iteration + 1) % accumulation_steps == 0
+            microitems = list(self.split_dataitem(dataitem, micro_batch_size))
+            for cnt, microitem in enumerate(microitems):
+                # The gradients of the per-sample losses are summed and
+                # divided by the number of samples of the logical batch
+                # before the update (the last batches may be smaller)
+                weight = len(microitem.inputs)
+                window_samples += weight
+                logger.debug("  transfer inputs to {0}.".format(self.device))
+                inputs = microitem.inputs.to(self.device)
+                logger.debug("  transfer targets to {0}.".format(
+                    self.device))
+                targets = []
+                for item in (microitem.outputs, microitem.labels):
+                    if item is not None:
+                        targets.append(item.to(self.device))
+                args = ()
+                if self.add_labels and microitem.labels is not None:
+                    args = (targets[-1], )
+                # In distributed mode, the gradients are only all-reduced
+                # during the last backward pass before the weights update
+                # (the distributed loader length is exact)
+                sync = ((update or iteration + 1 == nb_batch) and
+                        cnt + 1 == len(microitems))
+                no_sync = contextlib.suppress()
+                if self.distributed and not sync:
+                    no_sync = model.no_sync()
+                logger.debug("  evaluate model.")
+                with no_sync:
+                    with self.autocast():
+                        output_items = model(inputs, *args)
+                        if (not isinstance(output_items, tuple) and
+                                not isinstance(output_items, list)):
+                            outputs = output_items
+                            layer_outputs = None
+                        elif len(output_items) == 1:
+                            outputs = output_items[0]
+                            layer_outputs = None
+                        elif len(output_items) == 2:
+                            outputs, layer_outputs = output_items
+                        else:
+                            raise ValueError(
+                                "The forward method can only return one or "
+                                "two parameters: the forward output, and "
+                                "as an option specific layer outputs dict.")
+                        logger.debug("  update loss.")
+                        logger.debug("  outputs: {0} - {1}".format(
+                            outputs.shape, outputs.dtype))
+                        logger.debug("  targets: {0}".format(len(targets)))
+                        if hasattr(self.loss, "layer_outputs"):
+                            self.loss.layer_outputs = layer_outputs
+                        batch_loss = self.loss(outputs, *targets)
+                        regularizations = self.notify_observers(
+                            "regularizer", layer_outputs=layer_outputs)
+                        for reg in regularizations:
+                            batch_loss += reg
+                    logger.debug("  accumulate gradients.")
+                    self.scaler.scale(batch_loss * weight).backward()
+                accumulator.update(
+                    {"loss": batch_loss}, weight=len(microitem.inputs))
+                for name, metric in self.metrics.items():
+                    logger.debug("  compute metric '{0}'.".format(name))
+                    if hasattr(metric, "layer_outputs"):
+                        metric.layer_outputs = layer_outputs
+                    accumulator.update_metric(
+                        name, metric, outputs, *targets,
+                        weight=len(microitem.inputs))
+            if update:
+                self._update_weights(window_samples)
+                window_samples = 0
+            if sync_steps is not None and (iteration + 1) % sync_steps == 0:
+                logger.info("Mini-batch {0}: {1}".format(
+                    iteration + 1, dict(accumulator.compute())))
             logger.debug("Mini-batch done.")
+        if window_samples > 0:
+            self._update_weights(window_samples)
         pbar.finish()
+        values = accumulator.compute()
+        loss = values.pop("loss")
         logger.debug("Loss {0} ({1})".format(loss, type(loss)))
-        return loss, values
+        return loss, dict(values)
+
+    def _update_weights(self, window_samples):
+        """ Update the model weights with the accumulated gradients.
+
+        Parameters
+        ----------
+        window_samples: int
+            the number of samples over which the gradients of the per-sample
+            losses were summed.
+        """
+        logger.debug("  update model weights.")
+        for group in self.optimizer.param_groups:
+            for param in group["params"]:
+                if param.grad is not None:
+                    param.grad.div_(window_samples)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+
+    @staticmethod
+    def split_dataitem(dataitem, micro_batch_size=None):
+        """ Split a mini-batch into micro-batches.
+
+        Parameters
+        ----------
+        dataitem: DataItem
+            a mini-batch containing 'inputs', 'outputs', and 'labels' data.
+        micro_batch_size: int, default None
+            the size of the generated micro-batches, the last one being
+            possibly smaller. If not set, the mini-batch is returned as it is.
+
+        Returns
+        -------
+        microitem: DataItem
+            the successive micro-batches.
+        """
+        if micro_batch_size is None:
+            yield dataitem
+            return
+        if micro_batch_size < 1:
+            raise ValueError("The micro-batch size must be a positive "
+                             "integer.")
+        for start in range(0, len(dataitem.inputs), micro_batch_size):
+            yield type(dataitem)(*[
+                None if item is None else
+                item[start: start + micro_batch_size]
+                for item in dataitem])
 
     def testing(self, manager, with_logit=False, logit_function="softmax",
-                predict=False, concat_layer_outputs=None):
+                predict=False, concat_layer_outputs=None, prefetch=0,
+                sink=None, sliding_window=None):
         """ Evaluate the model.
 
         Parameters
@@ -348,48 +688,87 @@ class Base(Observable):
         concat_layer_outputs: list of str, default None
             the outputs of the intermediate layers to be merged with the
             predicted data (must be the same size).
+        prefetch: int, default 0
+            if set, the number of mini-batches loaded and transfered to the
+            device in advance in a background thread.
+        sink: str or ArraySink, default None
+            if set, the predicted data are not kept in memory but written
+            one mini-batch at a time in a preallocated on-disk array: a
+            '.npy' (memory-mapped) or '.h5'/'.hdf5' file path, or a sink
+            from the 'pynet.sinks' module. The input and true data are then
+            not collected either: use 'iter_test' to stream them.
+        sliding_window: SlidingWindow, default None
+            if set, evaluate the model on overlapping patches and stitch the
+            patch predictions back together (see 'pynet.inference').
 
         Returns
         -------
         y: array-like
-            the predicted data.
+            the predicted data, a read-only on-disk array if a sink is
+            specified (None if there are no test data).
         X: array-like
-            the input data.
+            the input data, None if a sink is specified.
         y_true: array-like
-            the true data if available.
+            the true data if available, None if a sink is specified.
         loss: float
             the value of the loss function if true data availble.
         values: dict
             the values of the metrics if true data availble.
         """
-        loaders = manager.get_dataloader(test=True)
-        y, loss, values = self.test(
-            loaders.test, with_logit=with_logit, logit_function=logit_function,
-            predict=predict, concat_layer_outputs=concat_layer_outputs)
+        loaders = manager.get_dataloader(
+            test=True, prefetch=prefetch, device=self.device)
+        if isinstance(sink, str):
+            sink = get_sink(sink)
+        accumulator = MetricsAccumulator(device=self.device)
+        y, X, targets = [], [], OrderedDict()
+        offset = 0
+        for predictitem in self.iter_test(
+                loaders.test, with_logit=with_logit,
+                logit_function=logit_function, predict=predict,
+                concat_layer_outputs=concat_layer_outputs,
+                accumulator=accumulator, sliding_window=sliding_window):
+            if sink is None:
+                y.append(predictitem.y)
+            else:
+                if offset == 0:
+                    shape = ((len(loaders.test.dataset), ) +
+                             predictitem.y.shape[1:])
+                    sink.allocate(shape=shape, dtype=predictitem.y.dtype)
+                sink.write(predictitem.y, offset=offset)
+            offset += len(predictitem.y)
+            if sink is not None:
+                continue
+            X.append(predictitem.inputs)
+            for cnt, item in enumerate(predictitem.targets):
+                targets.setdefault(cnt, []).append(item)
+        if sink is None:
+            y = np.concatenate(y, axis=0)
+        else:
+            y = sink.close()
+        values = accumulator.compute()
+        loss = values.pop("loss", 0)
         if loss == 0:
             loss, values, y_true, X = (None, None, None, None)
+        elif sink is not None:
+            y_true, X = (None, None)
+            values = dict(values)
         else:
-            y_true = []
-            X = []
-            targets = OrderedDict()
-            for dataitem in loaders.test:
-                for cnt, item in enumerate((dataitem.outputs,
-                                            dataitem.labels)):
-                    if item is not None:
-                        targets.setdefault(cnt, []).append(
-                            item.cpu().detach().numpy())
-                X.append(dataitem.inputs.cpu().detach().numpy())
             X = np.concatenate(X, axis=0)
+            y_true = []
             for key, _values in targets.items():
                 y_true.append(np.concatenate(_values, axis=0))
             if len(y_true) == 1:
                 y_true = y_true[0]
+            values = dict(values)
         return y, X, y_true, loss, values
 
     def test(self, loader, with_logit=False, logit_function="softmax",
-             predict=False, concat_layer_outputs=None):
+             predict=False, concat_layer_outputs=None, sliding_window=None):
         """ Evaluate the model on the test or validation data.
 
+        In distributed mode, the loss and metrics are averaged over the
+        processes, while the predicted data are those of the local shard.
+
         Parameters
         ----------
         loader: a pytorch Dataset
@@ -403,6 +782,9 @@ class Base(Observable):
         concat_layer_outputs: list of str, default None
             the outputs of the intermediate layers to be merged with the
             predicted data (must be the same size).
+        sliding_window: SlidingWindow, default None
+            if set, evaluate the model on overlapping patches and stitch the
+            patch predictions back together (see 'pynet.inference').
 
         Returns
         -------
@@ -413,88 +795,155 @@ class Base(Observable):
         values: dict
             the values of the metrics.
         """
+        accumulator = MetricsAccumulator(
+            device=self.device, distributed=self.distributed)
+        y = [predictitem.y for predictitem in self.iter_test(
+            loader, with_logit=with_logit, logit_function=logit_function,
+            predict=predict, concat_layer_outputs=concat_layer_outputs,
+            accumulator=accumulator, sliding_window=sliding_window)]
+        y = np.concatenate(y, axis=0)
+        values = accumulator.compute()
+        loss = values.pop("loss", 0)
+        return y, loss, dict(values)
+
+    def iter_test(self, loader, with_logit=False, logit_function="softmax",
+                  predict=False, concat_layer_outputs=None, accumulator=None,
+                  sliding_window=None):
+        """ Evaluate the model on the test or validation data one mini-batch
+        at a time.
+
+        The predictions are streamed: they are never concatenated in memory,
+        and the inputs and targets are returned during the same pass over
+        the data.
+
+        Parameters
+        ----------
+        loader: a pytorch Dataset
+            the data laoder.
+        with_logit: bool, default False
+            apply the logit function to the result.
+        logit_funtction: str, default 'softmax'
+            choose the logit function.
+        predict: bool, default False
+            take the argmax over the channels.
+        concat_layer_outputs: list of str, default None
+            the outputs of the intermediate layers to be merged with the
+            predicted data (must be the same size).
+        accumulator: MetricsAccumulator, default None
+            if set, accumulate the loss and metrics when true data are
+            available.
+        sliding_window: SlidingWindow, default None
+            if set, evaluate the model on overlapping patches and stitch the
+            patch predictions back together (see 'pynet.inference').
+
+        Returns
+        -------
+        predictitem: PredictItem
+            the mini-batch predicted data 'y', input data 'inputs', and
+            list of true data 'targets' as numpy arrays.
+        """
+        if logit_function not in ("softmax", "sigmoid"):
+            raise ValueError("Unsupported logit function.")
         logger.debug("Update model for testing.")
         self.model.eval()
         nb_batch = len(loader)
-        loss = 0
-        values = {}
-        with torch.no_grad():
-            y = []
-            pbar = progressbar.ProgressBar(
-                max_value=nb_batch, redirect_stdout=True, prefix="Mini-batch ")
-            pbar.start()
-            for iteration, dataitem in enumerate(loader):
-                logger.debug("Mini-batch {0}:".format(iteration))
-                pbar.update(iteration + 1)
-                logger.debug("  transfer inputs to {0}.".format(self.device))
-                inputs = dataitem.inputs.to(self.device)
-                logger.debug("  transfer targets to {0}.".format(self.device))
-                targets = []
-                for item in (dataitem.outputs, dataitem.labels):
-                    if item is not None:
-                        targets.append(item.to(self.device))
-                args = ()
-                if self.add_labels and dataitem.labels is not None:
-                    args = (targets[-1], )
-                elif len(targets) == 0:
-                    targets = None
-                logger.debug("  evaluate model.")
+        pbar = progressbar.ProgressBar(
+            max_value=nb_batch, redirect_stdout=True, prefix="Mini-batch ")
+        pbar.start()
+        for iteration, dataitem in enumerate(loader):
+            logger.debug("Mini-batch {0}:".format(iteration))
+            pbar.update(iteration + 1)
+            # Do not yield inside the no_grad context: the grad mode would
+            # leak in the caller code.
+            with torch.no_grad():
+                y = self._predict_batch(
+                    dataitem, with_logit=with_logit,
+                    logit_function=logit_function, predict=predict,
+                    concat_layer_outputs=concat_layer_outputs,
+                    accumulator=accumulator, sliding_window=sliding_window)
+            targets = [
+                item.cpu().numpy()
+                for item in (dataitem.outputs, dataitem.labels)
+                if item is not None]
+            logger.debug("Mini-batch done.")
+            yield PredictItem(
+                y=y, inputs=dataitem.inputs.cpu().numpy(), targets=targets)
+        pbar.finish()
+
+    def _predict_batch(self, dataitem, with_logit=False,
+                       logit_function="softmax", predict=False,
+                       concat_layer_outputs=None, accumulator=None,
+                       sliding_window=None):
+        """ Evaluate the model on one mini-batch.
+        """
+        logger.debug("  transfer inputs to {0}.".format(self.device))
+        inputs = dataitem.inputs.to(self.device)
+        logger.debug("  transfer targets to {0}.".format(self.device))
+        targets = []
+        for item in (dataitem.outputs, dataitem.labels):
+            if item is not None:
+                targets.append(item.to(self.device))
+        args = ()
+        if self.add_labels and dataitem.labels is not None:
+            args = (targets[-1], )
+        elif len(targets) == 0:
+            targets = None
+        logger.debug("  evaluate model.")
+        with self.autocast():
+            if sliding_window is not None:
+                output_items = sliding_window(self.model, inputs, *args)
+            else:
                 output_items = self.model(inputs, *args)
-                extra_outputs = []
-                if (not isinstance(output_items, tuple) and
-                        not isinstance(output_items, list)):
-                    outputs = output_items
-                    layer_outputs = None
-                elif len(output_items) == 1:
-                    outputs = output_items[0]
-                    layer_outputs = None
-                elif len(output_items) == 2:
-                    outputs, layer_outputs = output_items
-                    if concat_layer_outputs is not None:
-                        for name in concat_layer_outputs:
-                            if name not in layer_outputs:
-                                raise ValueError(
-                                    "Unknown layer output '{0}'. Check the "
-                                    "network forward method.".format(name))
-                            extra_outputs.append(layer_outputs[name])
-                else:
-                    raise ValueError(
-                        "The forward method can only return one or "
-                        "two parameters: the forward output, and "
-                        "as an option specific layer outputs in a dict.")
-                if targets is not None:
-                    logger.debug("  update loss.")
-                    logger.debug("  layer outputs: {0}".format(layer_outputs))
-                    if hasattr(self.loss, "layer_outputs"):
-                        self.loss.layer_outputs = layer_outputs
-                    batch_loss = self.loss(outputs, *targets)
-                    loss += float(batch_loss) / nb_batch
-                    for name, metric in self.metrics.items():
-                        logger.debug("  compute metric '{0}'.".format(name))
-                        if hasattr(metric, "layer_outputs"):
-                            metric.layer_outputs = layer_outputs
-                        if name not in values:
-                            values[name] = 0
-                        values[name] += metric(outputs, *targets) / nb_batch
-                if len(extra_outputs) > 0:
-                    y.append(torch.cat([outputs] + extra_outputs, 1))
-                else:
-                    if isinstance(outputs, list):
-                        outputs = outputs[0]
-                    y.append(outputs)
-                logger.debug("Mini-batch done.")
-            pbar.finish()
-            y = torch.cat(y, 0)
-            if with_logit:
-                logger.debug("Apply logit.")
-                if logit_function == "softmax":
-                    y = func.softmax(y, dim=1)
-                elif logit_function == "sigmoid":
-                    y = torch.sigmoid(y)
-                else:
-                    raise ValueError("Unsupported logit function.")
-            y = y.cpu().detach().numpy()
-            if predict:
-                logger.debug("Apply predict.")
-                y = np.argmax(y, axis=1)
-        return y, loss, values
+        extra_outputs = []
+        if (not isinstance(output_items, tuple) and
+                not isinstance(output_items, list)):
+            outputs = output_items
+            layer_outputs = None
+        elif len(output_items) == 1:
+            outputs = output_items[0]
+            layer_outputs = None
+        elif len(output_items) == 2:
+            outputs, layer_outputs = output_items
+            if concat_layer_outputs is not None:
+                for name in concat_layer_outputs:
+                    if name not in layer_outputs:
+                        raise ValueError(
+                            "Unknown layer output '{0}'. Check the "
+                            "network forward method.".format(name))
+                    extra_outputs.append(layer_outputs[name])
+        else:
+            raise ValueError(
+                "The forward method can only return one or "
+                "two parameters: the forward output, and "
+                "as an option specific layer outputs in a dict.")
+        if targets is not None and accumulator is not None:
+            logger.debug("  update loss.")
+            logger.debug("  layer outputs: {0}".format(layer_outputs))
+            if hasattr(self.loss, "layer_outputs"):
+                self.loss.layer_outputs = layer_outputs
+            accumulator.update(
+                {"loss": self.loss(outputs, *targets)}, weight=len(inputs))
+            for name, metric in self.metrics.items():
+                logger.debug("  compute metric '{0}'.".format(name))
+                if hasattr(metric, "layer_outputs"):
+                    metric.layer_outputs = layer_outputs
+                accumulator.update_metric(
+                    name, metric, outputs, *targets, weight=len(inputs))
+        if len(extra_outputs) > 0:
+            y = torch.cat([outputs] + extra_outputs, 1)
+        else:
+            if isinstance(outputs, list):
+                outputs = outputs[0]
+            y = outputs
+        y = y.float()
+        if with_logit:
+            logger.debug("Apply logit.")
+            if logit_function == "softmax":
+                y = func.softmax(y, dim=1)
+            else:
+                y = torch.sigmoid(y)
+        y = y.cpu().detach().numpy()
+        if predict:
+            logger.debug("Apply predict.")
+            y = np.argmax(y, axis=1)
+        return y
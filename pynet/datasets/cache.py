@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides a shared-memory cache of preprocessed samples visible
+from all the DataLoader workers.
+"""
+
+
+# System import
+import io
+import os
+import logging
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+# Third party import
+import numpy as np
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+class SharedMemoryCache(object):
+    """ A least recently used (LRU) cache of samples stored in a shared
+    memory block.
+
+    The block is split into fixed size slots, the slot size being the
+    size of the first cached sample unless specified. The slots metadata
+    (keys, sizes and last access times) are stored in a second shared
+    memory block, and a lock shared by all the processes protects the
+    accesses. The cache can be used by forked or spawned DataLoader workers:
+    only the process that created the cache releases the shared memory.
+    """
+    MIN_SLOT_BYTES = 4096
+    _HEADER = 5
+
+    def __init__(self, max_bytes, slot_bytes=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        max_bytes: int
+            the size of the cache in bytes.
+        slot_bytes: int, default None
+            the maximum size of a cached sample in bytes, default the size of
+            the first cached sample. Larger samples are not cached.
+        """
+        if max_bytes <= 0:
+            raise ValueError("The cache size must be a positive integer.")
+        self.max_bytes = int(max_bytes)
+        self.slot_bytes = slot_bytes
+        self.max_slots = max(
+            1, self.max_bytes // (slot_bytes or self.MIN_SLOT_BYTES))
+        # A lock that can be both inherited and sent to spawned processes
+        self._lock = multiprocessing.get_context("spawn").Lock()
+        self._data = shared_memory.SharedMemory(
+            create=True, size=self.max_bytes)
+        self._meta = shared_memory.SharedMemory(
+            create=True, size=8 * (self._HEADER + 3 * self.max_slots))
+        self._owner = os.getpid()
+        self._attach()
+        self._header[:] = 0
+        self._keys[:] = -1
+        logger.debug("Shared memory cache: {0} bytes in '{1}'.".format(
+            self.max_bytes, self._data.name))
+
+    def _attach(self):
+        """ Create the metadata views on the shared memory.
+        """
+        meta = np.ndarray(
+            (self._HEADER + 3 * self.max_slots, ), dtype=np.int64,
+            buffer=self._meta.buf)
+        # header: slot size, number of slots, clock, hits, misses
+        self._header = meta[:self._HEADER]
+        self._keys, self._ticks, self._sizes = meta[self._HEADER:].reshape(
+            3, self.max_slots)
+
+    def __getstate__(self):
+        """ Share the memory blocks by name with the spawned processes.
+        """
+        state = self.__dict__.copy()
+        for name in ("_data", "_meta"):
+            state[name] = getattr(self, name).name
+        for name in ("_header", "_keys", "_ticks", "_sizes"):
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        """ Attach the shared memory blocks.
+        """
+        self.__dict__.update(state)
+        for name in ("_data", "_meta"):
+            shm = shared_memory.SharedMemory(name=state[name])
+            # The attached blocks must not be released by this process
+            resource_tracker.unregister(shm._name, "shared_memory")
+            setattr(self, name, shm)
+        self._attach()
+
+    def __len__(self):
+        """ Return the number of cached samples.
+        """
+        with self._lock:
+            return int(np.sum(self._keys[:self._header[1]] >= 0))
+
+    @property
+    def stats(self):
+        """ The number of cache hits and misses.
+        """
+        return {"hits": int(self._header[3]), "misses": int(self._header[4])}
+
+    def get(self, key):
+        """ Get a cached sample.
+
+        Parameters
+        ----------
+        key: int
+            the positive sample identifier.
+
+        Returns
+        -------
+        arrays: list of array or None
+            the cached arrays or None if the sample is not cached.
+        """
+        with self._lock:
+            slots = np.flatnonzero(self._keys[:self._header[1]] == key)
+            if len(slots) == 0:
+                self._header[4] += 1
+                return None
+            slot = slots[0]
+            self._header[2] += 1
+            self._header[3] += 1
+            self._ticks[slot] = self._header[2]
+            start = slot * self._header[0]
+            payload = bytes(self._data.buf[start: start + self._sizes[slot]])
+        return self._decode(payload)
+
+    def put(self, key, *arrays):
+        """ Cache a sample, the least recently used sample being evicted if
+        the cache is full.
+
+        Parameters
+        ----------
+        key: int
+            the positive sample identifier.
+        arrays: list of array or None
+            the sample arrays.
+
+        Returns
+        -------
+        cached: bool
+            False if the sample is too large to be cached.
+        """
+        if key < 0:
+            raise ValueError("The cache keys must be positive integers.")
+        payload = self._encode(arrays)
+        with self._lock:
+            if self._header[0] == 0:
+                slot_bytes = self.slot_bytes or len(payload)
+                self._header[0] = max(slot_bytes, 1)
+                self._header[1] = min(
+                    self.max_bytes // self._header[0], self.max_slots)
+                logger.debug("Shared memory cache: {0} slots of {1} "
+                             "bytes.".format(*self._header[[1, 0]]))
+            slot_bytes, nb_slots = self._header[:2]
+            if len(payload) > slot_bytes or nb_slots == 0:
+                return False
+            keys = self._keys[:nb_slots]
+            if np.any(keys == key):
+                return True
+            slots = np.flatnonzero(keys < 0)
+            if len(slots) > 0:
+                slot = slots[0]
+            else:
+                slot = np.argmin(self._ticks[:nb_slots])
+            start = slot * slot_bytes
+            self._data.buf[start: start + len(payload)] = payload
+            self._header[2] += 1
+            self._keys[slot] = key
+            self._ticks[slot] = self._header[2]
+            self._sizes[slot] = len(payload)
+        return True
+
+    def close(self):
+        """ Release the shared memory, the blocks being destroyed by the
+        process that created the cache.
+        """
+        if self._data is None:
+            return
+        for name in ("_header", "_keys", "_ticks", "_sizes"):
+            setattr(self, name, None)
+        for shm in (self._data, self._meta):
+            shm.close()
+            if os.getpid() == self._owner:
+                shm.unlink()
+        self._data, self._meta = (None, None)
+
+    def __del__(self):
+        """ Release the shared memory.
+        """
+        if getattr(self, "_data", None) is not None:
+            self.close()
+
+    @staticmethod
+    def _encode(arrays):
+        """ Serialize a list of arrays, None values being allowed.
+        """
+        buffer = io.BytesIO()
+        for arr in arrays:
+            if arr is None:
+                buffer.write(b"\x00")
+            else:
+                buffer.write(b"\x01")
+                np.save(buffer, np.ascontiguousarray(arr), allow_pickle=False)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _decode(payload):
+        """ Deserialize a list of arrays.
+        """
+        buffer = io.BytesIO(payload)
+        arrays = []
+        while buffer.tell() < len(payload):
+            if buffer.read(1) == b"\x00":
+                arrays.append(None)
+            else:
+                arrays.append(np.load(buffer, allow_pickle=False))
+        return arrays
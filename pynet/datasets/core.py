@@ -13,20 +13,32 @@ Module that provides core functions to load and split a dataset.
 
 # Imports
 from collections import namedtuple, OrderedDict, Counter
+import os
+import mmap
 import progressbar
+import threading
 import inspect
-import random
 import logging
+import queue
 import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import (
-    Dataset, DataLoader, WeightedRandomSampler, RandomSampler,
-    SequentialSampler, Sampler)
+    Dataset, IterableDataset, DataLoader, WeightedRandomSampler,
+    RandomSampler, SequentialSampler, Sampler, get_worker_info)
+from torch.utils.data.distributed import DistributedSampler
 from sklearn.model_selection import (
     KFold, StratifiedKFold, ShuffleSplit, StratifiedShuffleSplit)
 from skimage.util.shape import view_as_blocks
 
+# Package import
+from pynet.datasets.cache import SharedMemoryCache
+from pynet.datasets.sampler import BlockShuffleSampler
+from pynet.datasets.patch import get_index_map, index_outputs, INDEX_DIR
+from pynet.datasets.store import (
+    open_array, read_attributes, convert_array, get_fingerprint)
+from pynet.augmentation.utils import get_rng, derive_seed
+
 # Global parameters
 SetItem = namedtuple("SetItem", ["test", "train", "validation"])
 DataItem = namedtuple("DataItem", ["inputs", "outputs", "labels"])
@@ -44,6 +56,10 @@ class DataManager(object):
                  output_transforms=None, data_augmentation_transforms=None,
                  add_input=False, test_size=0.1, label_mapping=None,
                  patch_size=None, continuous_labels=False, sample_size=1,
+                 cache_size=None, buffered_collate=False,
+                 batch_augmentation=None, seed=None, storage_dtypes=None,
+                 sampler_kwargs=None, patch_sampler=None,
+                 patch_queue_kwargs=None, patch_index=False,
                  **dataloader_kwargs):
         """ Splits an input numpy array using memory-mapping into three sets:
         test, train and validation. This function can stratify the data.
@@ -58,7 +74,9 @@ class DataManager(object):
         ----------
         input_path: str
             the path to the numpy array containing the input tensor data
-            that will be splited/loaded or the dataset itself.
+            that will be splited/loaded or the dataset itself. The array
+            is a '.npy' file or a chunked store (see
+            'pynet.datasets.store').
         metadata_path: str
             the path to the metadata table in tsv format.
         output_path: str, default None
@@ -87,8 +105,9 @@ class DataManager(object):
         sampler: str or Sampler, default 'random'
             whether we use a sequential, random or weighted random sampler
             (to deal with imbalanced classes issue) during the generation of
-            the mini-batches: None, 'random', 'weighted_random' or a custom
-            Sampler class.
+            the mini-batches: None, 'random', 'weighted_random',
+            'block_random' (a locality-aware sampler for the memory-mapped
+            data, see 'BlockShuffleSampler') or a custom Sampler class.
         input_transforms, output_transforms: list of callable, default None
             transforms a list of samples with pre-defined transformations.
         data_augmentation_transforms: list of callable, default None
@@ -112,12 +131,59 @@ class DataManager(object):
             should be between 0.0 and 1.0 and represent the proportion of the
             dataset used by the manger (random selection that can be usefull
             during testing.
+        cache_size: int, default None
+            if set, the size in bytes of a shared-memory cache storing the
+            data after the input/output transforms: the cache is shared by
+            all the DataLoader workers and only the data augmentation
+            transforms are applied at each epoch. The input/output
+            transforms must then be deterministic.
+        buffered_collate: bool, default False
+            if set, the train and validation mini-batches are collated in a
+            ring of preallocated (and pinned if the 'pin_memory' DataLoader
+            parameter is set) buffers: see 'BatchCollate'.
+        batch_augmentation: callable, default None
+            transforms the training mini-batches on the fly after the
+            collate, for instance a 'pynet.augmentation.BatchTransformer'.
+            The transformation runs in the main process (or in the prefetch
+            thread) and can use all the cores with the torch intra-op
+            parallelism.
+        seed: int, default None
+            if set, the random seed of the transforms applied to each sample
+            is derived from this seed, the epoch and the sample index, so
+            that the data augmentation is reproducible whatever the number
+            of DataLoader workers (see 'ArrayDataset').
+        storage_dtypes: dict, default None
+            the storage data type of the 'inputs' and 'outputs' arrays, for
+            instance {'inputs': 'int16', 'outputs': 'uint8'}: a converted
+            copy of an array is written next to it at the first use (see
+            'pynet.datasets.store.convert_array'). The arrays stored as
+            scaled integers are decoded to float32 in the collate copy, or
+            before the transforms if any.
+        sampler_kwargs: dict, default None
+            the parameters of the 'block_random' or custom sampler.
+        patch_sampler: PatchSampler, default None
+            if set, the training batches are made of random patches drawn
+            by this sampler (see 'pynet.datasets.patch') in the volumes
+            loaded by a 'PatchQueue': the 'sampler' parameter is then
+            ignored for the training set.
+        patch_queue_kwargs: dict, default None
+            the parameters of the 'PatchQueue'.
+        patch_index: bool, default False
+            if set, the voxels of each label of the outputs are indexed in
+            the '<output_path>.index' sidecar folder, and the label patch
+            samplers draw the patch centers from this index instead of
+            scanning each loaded volume (see
+            'pynet.datasets.patch.index_outputs'). Only the rows that are
+            not yet indexed, or whose content changed, are processed. The
+            index is not used with output or data augmentation transforms
+            that may move the output voxels.
         """
         # Checks
         if stratify_label is not None and custom_stratification is not None:
             raise ValueError("You specified two stratification strategies.")
         if ((inspect.isclass(sampler) and not issubclass(sampler, Sampler)) and
-                sampler not in (None, "random", "weighted_random")):
+                sampler not in (None, "random", "weighted_random",
+                                "block_random")):
             raise ValueError("Unsupported sampler.")
         if sampler == "weighted_random" and stratify_label is None:
             raise ValueError(
@@ -132,7 +198,17 @@ class DataManager(object):
         self.number_of_folds = number_of_folds
         self.data_loader_kwargs = dataloader_kwargs
         self.sampler = sampler
+        self.sampler_kwargs = sampler_kwargs or {}
+        self.patch_sampler = patch_sampler
+        self.patch_queue_kwargs = patch_queue_kwargs or {}
+        self.index_maps = None
         self.continuous_labels = continuous_labels
+        self.buffered_collate = buffered_collate
+        self.batch_augmentation = batch_augmentation
+        self.cache = None
+        if cache_size is not None:
+            self.cache = SharedMemoryCache(cache_size)
+        self.decoding = {}
         if isinstance(input_path, dict):
             self.dataset = input_path
             return
@@ -145,12 +221,24 @@ class DataManager(object):
         logger.debug("Projection labels: {0}".format(projection_labels))
         logger.debug("Mask: {0}".format(mask))
         logger.debug("Mask indices: {0}".format(mask_indices))
-        self.inputs = np.load(input_path, mmap_mode='r')
+        storage_dtypes = storage_dtypes or {}
+        self.inputs = self._open_array(
+            input_path, "inputs", storage_dtypes.get("inputs"))
         logger.debug("Inputs: {0}".format(self.inputs.shape))
         self.outputs, self.labels = (None, None)
         if output_path is not None:
-            self.outputs = np.load(output_path, mmap_mode='r')
+            self.outputs = self._open_array(
+                output_path, "outputs", storage_dtypes.get("outputs"))
             logger.debug("Outputs: {0}".format(self.outputs.shape))
+            if patch_index:
+                if output_transforms or data_augmentation_transforms:
+                    logger.warning(
+                        "The outputs index is ignored with output or data "
+                        "augmentation transforms that may move the voxels.")
+                self.index_maps = index_outputs(
+                    self.outputs, INDEX_DIR.format(output_path),
+                    rows=mask_indices,
+                    fingerprint=get_fingerprint(output_path))
         if labels is not None:
             self.labels = df[labels].values.squeeze()
             logger.debug("Labels: {0}".format(self.labels.shape))
@@ -227,7 +315,10 @@ class DataManager(object):
                 input_transforms=self.input_transforms,
                 output_transforms=self.output_transforms,
                 label_mapping=label_mapping,
-                patch_size=patch_size)
+                patch_size=patch_size,
+                cache=self.cache,
+                seed=seed,
+                decoding=self.decoding)
         if train_indices is None:
             return
 
@@ -257,22 +348,53 @@ class DataManager(object):
             train_dataset = ArrayDataset(
                 self.inputs, fold_train_indices, labels=self.labels,
                 outputs=self.outputs, add_input=self.add_input,
-                input_transforms=(self.input_transforms +
-                                  self.data_augmentation_transforms),
-                output_transforms=(self.output_transforms +
-                                   self.data_augmentation_transforms),
+                input_transforms=self.input_transforms,
+                output_transforms=self.output_transforms,
+                data_augmentation_transforms=(
+                    self.data_augmentation_transforms),
                 label_mapping=label_mapping,
-                patch_size=patch_size)
+                patch_size=patch_size,
+                cache=self.cache,
+                seed=seed,
+                decoding=self.decoding)
             val_dataset = ArrayDataset(
                 self.inputs, fold_val_indices, labels=self.labels,
                 outputs=self.outputs, add_input=self.add_input,
                 input_transforms=self.input_transforms,
                 output_transforms=self.output_transforms,
                 label_mapping=label_mapping,
-                patch_size=patch_size)
+                patch_size=patch_size,
+                cache=self.cache,
+                seed=seed,
+                decoding=self.decoding)
             self.dataset["train"].append(train_dataset)
             self.dataset["validation"].append(val_dataset)
 
+    def _open_array(self, path, key, storage_dtype=None):
+        """ Open an array, converted to its storage data type if requested,
+        and register its decoding parameters.
+        """
+        arr = open_array(path, mode="r")
+        if storage_dtype is not None and arr.dtype != storage_dtype:
+            storage_dtype = np.dtype(storage_dtype)
+            root, ext = os.path.splitext(path)
+            storage_path = "{0}_{1}{2}".format(root, storage_dtype.name, ext)
+            # The attributes are written once the conversion is done, with
+            # the fingerprint of the converted source
+            if (read_attributes(storage_path).get("source") !=
+                    get_fingerprint(path)):
+                logger.info("Converting '{0}' to {1}...".format(
+                    key, storage_dtype))
+                convert_array(path, storage_path, storage_dtype)
+            path = storage_path
+            arr = open_array(path, mode="r")
+        attributes = read_attributes(path)
+        scale = attributes.get("scale", 1.)
+        offset = attributes.get("offset", 0.)
+        if scale != 1. or offset != 0.:
+            self.decoding[key] = (arr.dtype.str, scale, offset)
+        return arr
+
     @classmethod
     def from_numpy(cls, test_inputs=None, test_outputs=None, test_labels=None,
                    train_inputs=None, train_outputs=None, train_labels=None,
@@ -281,7 +403,10 @@ class DataManager(object):
                    input_transforms=None, output_transforms=None,
                    data_augmentation_transforms=None, add_input=False,
                    label_mapping=None, patch_size=None,
-                   continuous_labels=False):
+                   continuous_labels=False, cache_size=None,
+                   buffered_collate=False, batch_augmentation=None,
+                   seed=None, sampler_kwargs=None, patch_sampler=None,
+                   patch_queue_kwargs=None):
         """ Create a data manger from numpy arrays.
 
         Parameters
@@ -293,8 +418,9 @@ class DataManager(object):
         sampler: str or Sampler, default 'random'
             whether we use a sequential, random or weighted random sampler
             (to deal with imbalanced classes issue) during the generation of
-            the mini-batches: None, 'random', 'weighted_random' or a custom
-            Sampler class.
+            the mini-batches: None, 'random', 'weighted_random',
+            'block_random' (a locality-aware sampler for the memory-mapped
+            data, see 'BlockShuffleSampler') or a custom Sampler class.
         input_transforms, output_transforms: list of callable, default None
             transforms a list of samples with pre-defined transformations.
         data_augmentation_transforms: list of callable, default None
@@ -311,6 +437,25 @@ class DataManager(object):
         continuous_labels: bool, default False
             if set consider labels as continuous values; ie. floats otherwise
             a discrete values, ie. integer.
+        cache_size: int, default None
+            if set, the size in bytes of the shared-memory cache of each set
+            of data (see the class constructor).
+        buffered_collate: bool, default False
+            if set, collate the train and validation mini-batches in a ring
+            of preallocated buffers (see the class constructor).
+        batch_augmentation: callable, default None
+            transforms the training mini-batches on the fly after the
+            collate (see the class constructor).
+        seed: int, default None
+            the seed from which the random seed of the transforms applied
+            to each sample is derived (see the class constructor).
+        sampler_kwargs: dict, default None
+            the parameters of the 'block_random' or custom sampler.
+        patch_sampler: PatchSampler, default None
+            if set, the training batches are made of random patches drawn
+            by this sampler in the volumes loaded by a 'PatchQueue'.
+        patch_queue_kwargs: dict, default None
+            the parameters of the 'PatchQueue'.
 
         Returns
         -------
@@ -321,6 +466,12 @@ class DataManager(object):
         input_transforms = input_transforms or []
         output_transforms = output_transforms or []
         data_augmentation_transforms = data_augmentation_transforms or []
+        caches = {}
+        for key, inputs in (("test", test_inputs), ("train", train_inputs),
+                            ("validation", validation_inputs)):
+            caches[key] = None
+            if cache_size is not None and inputs is not None:
+                caches[key] = SharedMemoryCache(cache_size)
         if test_inputs is not None:
             test_dataset = ArrayDataset(
                 inputs=test_inputs, indices=range(len(test_inputs)),
@@ -329,7 +480,9 @@ class DataManager(object):
                 output_transforms=output_transforms,
                 add_input=add_input,
                 label_mapping=label_mapping,
-                patch_size=patch_size)
+                patch_size=patch_size,
+                cache=caches["test"],
+                seed=seed)
             dataset["test"] = test_dataset
         if train_inputs is not None:
             train_dataset = ArrayDataset(
@@ -337,13 +490,14 @@ class DataManager(object):
                 indices=range(len(train_inputs)),
                 labels=train_labels,
                 outputs=train_outputs,
-                input_transforms=(input_transforms +
-                                  data_augmentation_transforms),
-                output_transforms=(output_transforms +
-                                   data_augmentation_transforms),
+                input_transforms=input_transforms,
+                output_transforms=output_transforms,
+                data_augmentation_transforms=data_augmentation_transforms,
                 add_input=add_input,
                 label_mapping=label_mapping,
-                patch_size=patch_size)
+                patch_size=patch_size,
+                cache=caches["train"],
+                seed=seed)
             dataset["train"] = [train_dataset]
         if validation_inputs is not None:
             validation_dataset = ArrayDataset(
@@ -355,14 +509,31 @@ class DataManager(object):
                 output_transforms=output_transforms,
                 add_input=add_input,
                 label_mapping=label_mapping,
-                patch_size=patch_size)
+                patch_size=patch_size,
+                cache=caches["validation"],
+                seed=seed)
             dataset["validation"] = [validation_dataset]
         return cls(input_path=dataset,
                    metadata_path=None,
                    sampler=sampler,
                    batch_size=batch_size,
                    number_of_folds=1,
-                   continuous_labels=continuous_labels)
+                   continuous_labels=continuous_labels,
+                   buffered_collate=buffered_collate,
+                   batch_augmentation=batch_augmentation,
+                   sampler_kwargs=sampler_kwargs,
+                   patch_sampler=patch_sampler,
+                   patch_queue_kwargs=patch_queue_kwargs)
+
+    def __getstate__(self):
+        """ The memory-mapped arrays are pickled by reference.
+        """
+        return _get_state(self, ("inputs", "outputs"))
+
+    def __setstate__(self, state):
+        """ Map again the arrays pickled by reference.
+        """
+        self.__dict__.update(_open_state(state))
 
     def __getitem__(self, item):
         """ Return the requested item.
@@ -383,6 +554,7 @@ class DataManager(object):
         of samples into batches.
 
         A custom collate_fn is used here to apply the transformations.
+        The samples stored as scaled integers are decoded during the copy.
 
         See https://pytorch.org/docs/stable/data.html#dataloader-collate-fn.
         """
@@ -393,9 +565,10 @@ class DataManager(object):
             elif getattr(list_samples[-1], key) is None:
                 data[key] = None
             else:
-                data[key] = torch.stack([
-                    torch.as_tensor(getattr(sample, key))
-                    for sample in list_samples], dim=0).float()
+                samples = [getattr(sample, key) for sample in list_samples]
+                data[key] = _decode_batch(torch.stack([
+                    torch.as_tensor(sample) for sample in samples],
+                    dim=0).float(), samples, self.decoding.get(key))
         if data["labels"] is not None:
             if self.continuous_labels:
                 data["labels"] = data["labels"].type(torch.FloatTensor)
@@ -404,7 +577,8 @@ class DataManager(object):
         return DataItem(**data)
 
     def get_dataloader(self, train=False, validation=False, test=False,
-                       fold_index=0):
+                       fold_index=0, prefetch=0, device=None,
+                       distributed=False):
         """ Generate a pytorch DataLoader.
 
         Parameters
@@ -417,6 +591,18 @@ class DataManager(object):
             return the dataloader over the test set.
         fold_index: int, default 0
             the index of the fold to use for the training
+        prefetch: int, default 0
+            if set, the number of mini-batches prepared in advance in a
+            background thread (see 'PrefetchLoader').
+        device: str or torch.device, default None
+            the device where the prefetched mini-batches are transfered
+            (default 'cpu').
+        distributed: bool, default False
+            if set, each process of the distributed group only loads its own
+            shard of the train and validation sets. The train shards are
+            shuffled when the 'random' sampler is selected: the sampler
+            'set_epoch' method must then be called at each epoch. Not
+            supported with a patch sampler.
 
         Returns
         -------
@@ -424,15 +610,49 @@ class DataManager(object):
             the requested data loaders.
         """
         _test, _train, _validation, sampler = (None, None, None, None)
+        collate_fn = self.collate_fn
+        if self.buffered_collate:
+            # One buffer is used by the consumer, one is being filled, and
+            # the others wait in the prefetch queue
+            collate_fn = BatchCollate(
+                continuous_labels=self.continuous_labels,
+                nb_buffers=(prefetch + 2), decoding=self.decoding,
+                pin_memory=(
+                    self.data_loader_kwargs.get("pin_memory", False) and
+                    self.data_loader_kwargs.get("num_workers", 0) == 0))
         if test:
             _test = DataLoader(
                 self.dataset["test"], batch_size=self.batch_size,
                 collate_fn=self.collate_fn, **self.data_loader_kwargs)
         if train:
+            train_dataset = self.dataset["train"][fold_index]
             # weights is a list of weights per data point in the data set we
             # are drawing from, NOT a weight per class.
-            if inspect.isclass(self.sampler):
-                sampler = self.sampler(self.dataset["train"][fold_index])
+            if self.patch_sampler is not None:
+                if distributed:
+                    raise ValueError(
+                        "The patch sampler is not supported in distributed "
+                        "mode.")
+                # The queue shuffles the volumes itself
+                queue_kwargs = dict(self.patch_queue_kwargs)
+                if self.index_maps is not None:
+                    queue_kwargs.setdefault("index_maps", self.index_maps)
+                train_dataset = PatchQueue(
+                    train_dataset, self.patch_sampler, **queue_kwargs)
+            elif distributed:
+                if self.sampler not in (None, "random"):
+                    raise ValueError(
+                        "Only the 'random' sampler is supported in "
+                        "distributed mode.")
+                sampler = DistributedSampler(
+                    self.dataset["train"][fold_index],
+                    shuffle=(self.sampler == "random"))
+            elif inspect.isclass(self.sampler):
+                sampler = self.sampler(
+                    self.dataset["train"][fold_index], **self.sampler_kwargs)
+            elif self.sampler == "block_random":
+                sampler = BlockShuffleSampler(
+                    self.dataset["train"][fold_index], **self.sampler_kwargs)
             elif self.sampler == "weighted_random":
                 if self.sampler_weights is None:
                     raise ValueError(
@@ -447,14 +667,24 @@ class DataManager(object):
                 sampler = RandomSampler(
                     self.dataset["train"][fold_index], replacement=False)
             _train = DataLoader(
-                self.dataset["train"][fold_index], batch_size=self.batch_size,
-                sampler=sampler, collate_fn=self.collate_fn,
-                **self.data_loader_kwargs)
+                train_dataset, batch_size=self.batch_size, sampler=sampler,
+                collate_fn=collate_fn, **self.data_loader_kwargs)
+            if self.batch_augmentation is not None:
+                _train = AugmentationLoader(_train, self.batch_augmentation)
         if validation:
+            sampler = None
+            if distributed:
+                sampler = DistributedSampler(
+                    self.dataset["validation"][fold_index], shuffle=False)
             _validation = DataLoader(
                 self.dataset["validation"][fold_index],
-                batch_size=self.batch_size, collate_fn=self.collate_fn,
-                **self.data_loader_kwargs)
+                batch_size=self.batch_size, sampler=sampler,
+                collate_fn=collate_fn, **self.data_loader_kwargs)
+        if prefetch > 0:
+            _test, _train, _validation = [
+                None if loader is None else
+                PrefetchLoader(loader, depth=prefetch, device=device)
+                for loader in (_test, _train, _validation)]
         return SetItem(test=_test, train=_train, validation=_validation)
 
     @staticmethod
@@ -495,13 +725,312 @@ class DataManager(object):
         return np.arange(len(mask))[mask]
 
 
+class PrefetchLoader(object):
+    """ Wrap a DataLoader in order to load the next mini-batches in a
+    background thread while the current one is processed.
+
+    On CPU, the collate and data augmentation of the next mini-batches
+    overlap with the computations. On GPU, the mini-batches are also pinned
+    and transfered asynchronously to the device on a side stream.
+    """
+    _END = object()
+
+    def __init__(self, loader, depth=1, device=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        loader: DataLoader
+            the wrapped data loader that generates DataItem.
+        depth: int, default 1
+            the maximum number of mini-batches loaded in advance.
+        device: str or torch.device, default None
+            the device where the mini-batches are transfered (default 'cpu').
+        """
+        if depth < 1:
+            raise ValueError("The prefetch depth must be a positive integer.")
+        self.loader = loader
+        self.depth = depth
+        self.device = torch.device(device or "cpu")
+
+    def __len__(self):
+        """ Return the number of mini-batches.
+        """
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        """ Give access to the wrapped loader attributes.
+        """
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        """ Generate the ready to use mini-batches.
+        """
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce, args=(buffer, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                dataitem = buffer.get()
+                if dataitem is self._END:
+                    break
+                if isinstance(dataitem, Exception):
+                    raise dataitem
+                if self.device.type == "cuda":
+                    current_stream = torch.cuda.current_stream(self.device)
+                    for item in dataitem:
+                        if item is not None:
+                            item.record_stream(current_stream)
+                yield dataitem
+        finally:
+            stop.set()
+            thread.join()
+
+    def _produce(self, buffer, stop):
+        """ Load, transfer and store the mini-batches in the buffer.
+        """
+        stream = None
+        if self.device.type == "cuda":
+            stream = torch.cuda.Stream(self.device)
+        try:
+            for dataitem in self.loader:
+                if stop.is_set():
+                    return
+                if stream is not None:
+                    dataitem = self._transfer(dataitem, stream)
+                if not self._put(buffer, stop, dataitem):
+                    return
+        except Exception as exc:
+            self._put(buffer, stop, exc)
+        finally:
+            self._put(buffer, stop, self._END)
+
+    def _transfer(self, dataitem, stream):
+        """ Transfer asynchronously a mini-batch on the device.
+        """
+        with torch.cuda.stream(stream):
+            data = [
+                None if item is None else
+                item.pin_memory().to(self.device, non_blocking=True)
+                for item in dataitem]
+        stream.synchronize()
+        return type(dataitem)(*data)
+
+    @staticmethod
+    def _put(buffer, stop, obj):
+        """ Store an object in the buffer unless the iteration is stopped.
+        """
+        while not stop.is_set():
+            try:
+                buffer.put(obj, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class AugmentationLoader(object):
+    """ Wrap a DataLoader in order to transform the input and output
+    mini-batches after the collate.
+    """
+    def __init__(self, loader, transform):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        loader: DataLoader
+            the wrapped data loader that generates DataItem.
+        transform: callable
+            the transformation with signature transform(inputs, outputs)
+            that returns the transformed inputs and outputs.
+        """
+        self.loader = loader
+        self.transform = transform
+
+    def __len__(self):
+        """ Return the number of mini-batches.
+        """
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        """ Give access to the wrapped loader attributes.
+        """
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        """ Iterate over the transformed mini-batches.
+        """
+        for dataitem in self.loader:
+            inputs, outputs = self.transform(
+                dataitem.inputs, dataitem.outputs)
+            yield DataItem(inputs=inputs, outputs=outputs,
+                           labels=dataitem.labels)
+
+
+class BatchCollate(object):
+    """ Collate the samples in a ring of preallocated batch buffers.
+
+    Each sample is copied once in its slot of the current buffer, the
+    conversion to the batch data type being done during this copy. The
+    buffers are reused in turn: a mini-batch is only valid until
+    'nb_buffers' other mini-batches have been collated, so it must be copied
+    to be kept. The default path that allocates new tensors is used when
+    the samples shapes vary, or in the DataLoader worker processes where
+    the batches are moved to a shared memory.
+    """
+    def __init__(self, continuous_labels=False, nb_buffers=2,
+                 pin_memory=False, decoding=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        continuous_labels: bool, default False
+            if set consider labels as continuous values; ie. floats otherwise
+            a discrete values, ie. integer.
+        nb_buffers: int, default 2
+            the number of buffers in the ring.
+        pin_memory: bool, default False
+            if set and a GPU is available, allocate the buffers in page
+            locked memory.
+        decoding: dict, default None
+            the (storage dtype, scale, offset) of the data stored as scaled
+            integers: these samples are decoded, 'arr * scale + offset',
+            in the batch buffer.
+        """
+        if nb_buffers < 1:
+            raise ValueError("The number of buffers must be a positive "
+                             "integer.")
+        self.continuous_labels = continuous_labels
+        self.nb_buffers = nb_buffers
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.decoding = decoding or {}
+        self.buffers = [{} for _ in range(nb_buffers)]
+        self.index = -1
+
+    def __call__(self, list_samples):
+        """ Collate a list of samples.
+
+        Parameters
+        ----------
+        list_samples: list of DataItem
+            the samples to be collated.
+
+        Returns
+        -------
+        dataitem: DataItem
+            the mini-batch.
+        """
+        self.index = (self.index + 1) % self.nb_buffers
+        data = OrderedDict()
+        for key in ("inputs", "outputs", "labels"):
+            if (len(list_samples) == 0 or
+                    getattr(list_samples[-1], key) is None):
+                data[key] = None
+                continue
+            dtype = torch.float32
+            if key == "labels" and not self.continuous_labels:
+                dtype = torch.int64
+            data[key] = self._collate(
+                key, [getattr(sample, key) for sample in list_samples],
+                dtype)
+        return DataItem(**data)
+
+    def _collate(self, key, samples, dtype):
+        """ Collate the samples associated to a key.
+        """
+        shapes = set(tuple(sample.shape) if hasattr(sample, "shape")
+                     else np.shape(sample) for sample in samples)
+        if (len(shapes) > 1 or
+                torch.utils.data.get_worker_info() is not None):
+            return _decode_batch(torch.stack([
+                torch.as_tensor(sample) for sample in samples],
+                dim=0).float().type(dtype), samples, self.decoding.get(key))
+        shape = (len(samples), ) + shapes.pop()
+        buffer = self.buffers[self.index].get(key)
+        if (buffer is None or buffer.dtype != dtype or
+                tuple(buffer.shape[1:]) != shape[1:] or
+                len(buffer) < shape[0]):
+            logger.debug("Allocating a {0} - {1} buffer.".format(
+                shape, dtype))
+            buffer = torch.empty(shape, dtype=dtype,
+                                 pin_memory=self.pin_memory)
+            self.buffers[self.index][key] = buffer
+        buffer = buffer[:shape[0]]
+        arr = buffer.numpy()
+        for idx, sample in enumerate(samples):
+            if isinstance(sample, torch.Tensor):
+                buffer[idx].copy_(sample)
+            else:
+                np.copyto(arr[idx, ...], sample, casting="unsafe")
+        return _decode_batch(buffer, samples, self.decoding.get(key))
+
+
+def _decode_batch(batch, samples, decoding):
+    """ Decode in place a batch of samples stored as scaled integers: the
+    samples decoded before the transforms are left unchanged.
+    """
+    if decoding is None:
+        return batch
+    dtype, scale, offset = decoding
+    if getattr(samples[-1], "dtype", None) == np.dtype(dtype):
+        batch.mul_(scale).add_(offset)
+    return batch
+
+
+class _MappedArray(object):
+    """ A picklable reference to a memory-mapped '.npy' file, so that a
+    pickled dataset (a DataLoader or a fold worker started with the 'spawn'
+    method) maps the file instead of copying its content.
+    """
+    def __init__(self, arr):
+        self.filename = arr.filename
+        self.offset = arr.offset
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        self.order = "F" if np.isfortran(arr) else "C"
+        self.mode = "r+" if arr.mode == "w+" else arr.mode
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode=self.mode,
+                         offset=self.offset, shape=self.shape,
+                         order=self.order)
+
+
+def _get_state(obj, names):
+    """ Get the state of an object, its memory-mapped arrays being replaced
+    by references: only the arrays that map a whole file are concerned.
+    """
+    state = obj.__dict__.copy()
+    for name in names:
+        arr = state.get(name)
+        if (isinstance(arr, np.memmap) and arr.filename is not None and
+                isinstance(arr.base, mmap.mmap)):
+            state[name] = _MappedArray(arr)
+    return state
+
+
+def _open_state(state):
+    """ Map again the arrays of a state.
+    """
+    return dict(
+        (name, val.open() if isinstance(val, _MappedArray) else val)
+        for name, val in state.items())
+
+
 class ArrayDataset(Dataset):
     """ A dataset based on numpy array.
     """
     def __init__(self, inputs, indices, labels=None, outputs=None,
                  add_input=False, input_transforms=None,
                  output_transforms=None, label_mapping=None,
-                 patch_size=None):
+                 patch_size=None, data_augmentation_transforms=None,
+                 cache=None, seed=None, decoding=None, patch_cache_size=2):
         """ Initialize the class.
 
         Parameters
@@ -523,6 +1052,33 @@ class ArrayDataset(Dataset):
         patch_size: tuple, default None
             the size of the patches that will be extracted from the
             input/output images.
+        data_augmentation_transforms: list of callable, default None
+            transforms applied on the fly to both the input and output data
+            after the input/output transforms.
+        cache: SharedMemoryCache, default None
+            if set, cache the input and output data after the deterministic
+            input/output transforms: only the data augmentation transforms
+            are then applied at each access. The cache keys are the indices
+            in the input array, so a cache can be shared by the datasets
+            built from the same arrays with the same transforms.
+        seed: int, default None
+            if set, the random seed of the transforms applied to a sample is
+            derived from this seed, the epoch (see 'set_epoch') and the
+            sample index: the data augmentation is then reproducible whatever
+            the number of DataLoader workers. Otherwise, the seed is derived
+            from the seed of the DataLoader worker (see
+            'torch.utils.data.get_worker_info') or drawn from the operating
+            system entropy in the main process.
+        decoding: dict, default None
+            the (storage dtype, scale, offset) of the 'inputs' and 'outputs'
+            arrays stored as scaled integers. The samples are decoded,
+            'arr * scale + offset', before the transforms if any, otherwise
+            they are returned as stored and decoded by the collate (see
+            'DataManager').
+        patch_cache_size: int, default 2
+            the number of images whose patches are kept in memory, so that
+            the patches of an image are extracted once when they are
+            accessed close to each other.
         """
         # Checks
         if labels is not None:
@@ -538,6 +1094,11 @@ class ArrayDataset(Dataset):
         self.add_input = add_input
         self.input_transforms = input_transforms or []
         self.output_transforms = output_transforms or []
+        self.data_augmentation_transforms = data_augmentation_transforms or []
+        self.cache = cache
+        self.seed = seed
+        self.epoch = 0
+        self.decoding = decoding or {}
         self.label_mapping = label_mapping
         self.patch_size = patch_size
         self.input_size = np.asarray(self.inputs.shape[2:])
@@ -550,8 +1111,18 @@ class ArrayDataset(Dataset):
             logger.debug("Patch grid: {0}".format(self.patch_grid))
             self.nb_patches_by_img = np.prod(self.patch_grid)
             logger.debug("Number patches: {0}".format(self.nb_patches_by_img))
-            (self.input_cached, self.output_cached, self.label_cached,
-             self.image_idx_cached) = (None, None, None, None)
+        self.patch_cache_size = patch_cache_size
+        self._patches = OrderedDict()
+
+    def __getstate__(self):
+        """ The memory-mapped arrays are pickled by reference.
+        """
+        return _get_state(self, ("inputs", "outputs"))
+
+    def __setstate__(self, state):
+        """ Map again the arrays pickled by reference.
+        """
+        self.__dict__.update(_open_state(state))
 
     def __getitem__(self, item):
         """ Return the requested item.
@@ -567,80 +1138,169 @@ class ArrayDataset(Dataset):
         else:
             concat_axis = 1
 
-        # If the patches are already loaded just select the requested patch
+        # Select the requested patch in the patches of the image
         if self.patch_size is not None:
             patch_idx = item % self.nb_patches_by_img
             image_idx = item // self.nb_patches_by_img
-            indices = self.indices[image_idx]
-            if self.image_idx_cached == image_idx:
-                # Retrieve directly the input (and eventually the output)
-                idx = tuple(np.unravel_index(patch_idx, self.patch_grid))
-                logger.debug("Getting patch index item: {0}".format(idx))
-                _inputs = self.input_cached[idx]
-                if self.output_cached is not None:
-                    _outputs = self.output_cached[idx]
-                else:
-                    _outputs = None
-                _labels = self.label_cached
-                return DataItem(inputs=_inputs, outputs=_outputs,
-                                labels=_labels)
+            input_patches, output_patches, _labels = self._get_patches(
+                image_idx)
+            idx = tuple(np.unravel_index(patch_idx, self.patch_grid))
+            logger.debug("Getting patch index item: {0}".format(idx))
+            _inputs = input_patches[idx]
+            _outputs = None
+            if output_patches is not None:
+                _outputs = output_patches[idx]
         else:
-            indices = self.indices[item]
+            _inputs, _outputs, _labels = self.get_sample(item)
+
+        # Add input
+        if self.add_input:
+            if _outputs is None:
+                _outputs = _inputs
+            else:
+                _outputs = np.concatenate(
+                    (_outputs, _inputs), axis=concat_axis)
+
+        return DataItem(inputs=_inputs, outputs=_outputs, labels=_labels)
 
-        # Load the requested data
+    def get_sample(self, item):
+        """ Load and transform a whole sample, whatever the patch size.
+
+        Parameters
+        ----------
+        item: int
+            the position of the sample in the dataset indices.
+
+        Returns
+        -------
+        inputs, outputs, labels: array
+            the transformed sample data.
+        """
+        indices = self.indices[item]
         logger.debug("Precomputed indices: {0}".format(indices))
-        _inputs = self.inputs[indices]
-        _labels, _outputs = (None, None)
+        _labels = None
         if self.labels is not None:
             _labels = self.labels[indices]
+        seed = self.get_seed(indices)
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(int(indices))
+        if cached is not None:
+            _inputs, _outputs = cached
+        else:
+            _inputs, _outputs = self._load(indices)
+            if (self.input_transforms or self.output_transforms or
+                    self.data_augmentation_transforms or self.add_input):
+                _inputs = self._decode(_inputs, "inputs")
+                _outputs = self._decode(_outputs, "outputs")
+            _inputs, _outputs = self._transform(
+                _inputs, _outputs, self.input_transforms,
+                self.output_transforms, seed)
+            if self.cache is not None:
+                self.cache.put(int(indices), _inputs, _outputs)
+
+        # Apply the data augmentation transformations to the data
+        _inputs, _outputs = self._transform(
+            _inputs, _outputs, self.data_augmentation_transforms,
+            self.data_augmentation_transforms, seed)
+        if _labels is not None and self.label_mapping is not None:
+            _labels = [self.label_mapping[item] for item in _labels]
+        return _inputs, _outputs, _labels
+
+    def _get_patches(self, image_idx):
+        """ Get the patches of an image, extracted once while the image is
+        in the patches cache.
+        """
+        if image_idx in self._patches:
+            self._patches.move_to_end(image_idx)
+            return self._patches[image_idx]
+        _inputs, _outputs, _labels = self.get_sample(image_idx)
+        logger.debug("Splitting input: {0}".format(_inputs.shape))
+        patches = (ArrayDataset._create_patches(_inputs, self.patch_size),
+                   None, _labels)
+        if _outputs is not None:
+            logger.debug("Splitting output: {0}".format(_outputs.shape))
+            patches = (patches[0], ArrayDataset._create_patches(
+                _outputs, self.patch_size), _labels)
+        self._patches[image_idx] = patches
+        while len(self._patches) > self.patch_cache_size:
+            self._patches.popitem(last=False)
+        return patches
+
+    def _load(self, indices):
+        """ Load the input and output data of a sample.
+        """
+        _inputs = self.inputs[indices]
+        _outputs = None
         if self.outputs is not None:
             _outputs = self.outputs[indices]
+        return _inputs, _outputs
+
+    def _decode(self, arr, key):
+        """ Decode a sample stored as scaled integers.
+        """
+        if arr is None or key not in self.decoding:
+            return arr
+        dtype, scale, offset = self.decoding[key]
+        if arr.dtype != np.dtype(dtype):
+            return arr
+        decoded = arr.astype(np.float32)
+        decoded *= scale
+        decoded += offset
+        return decoded
+
+    def set_epoch(self, epoch):
+        """ Set the epoch from which the transforms random seeds are
+        derived.
+
+        Parameters
+        ----------
+        epoch: int
+            the epoch number.
+        """
+        self.epoch = epoch
+        self._patches.clear()
+
+    def get_seed(self, index):
+        """ Get the random seed of the transforms applied to a sample.
+
+        Parameters
+        ----------
+        index: int
+            the sample index in the input array.
+
+        Returns
+        -------
+        seed: numpy.random.SeedSequence
+            the sample seed sequence.
+        """
+        if self.seed is not None:
+            return derive_seed(self.seed, self.epoch, index)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            return derive_seed(worker_info.seed, index)
+        return np.random.SeedSequence()
 
-        # Apply the transformations to the data
-        seed = random.getrandbits(30)
-        for tf in self.input_transforms:
+    @staticmethod
+    def _transform(inputs, outputs, input_transforms, output_transforms,
+                   seed):
+        """ Apply the transformations to the input and output data with the
+        same random seed.
+        """
+        for tf in input_transforms:
             if hasattr(tf, "seed"):
                 tf.seed = seed
             if hasattr(tf, "dtype"):
                 tf.dtype = "input"
-            _inputs = tf(_inputs)
-        if _outputs is not None:
-            for tf in self.output_transforms:
+            inputs = tf(inputs)
+        if outputs is not None:
+            for tf in output_transforms:
                 if hasattr(tf, "seed"):
                     tf.seed = seed
                 if hasattr(tf, "dtype"):
                     tf.dtype = "output"
-                _outputs = tf(_outputs)
-        if _labels is not None and self.label_mapping is not None:
-            _labels = [label_mapping[item] for item in _labels]
-
-        # Cache data patches and select the requested patch
-        if self.patch_size is not None:
-            self.image_idx_cached = image_idx
-            idx = tuple(np.unravel_index(patch_idx, self.patch_grid))
-            logger.debug("Getting patch index item: {0}".format(idx))
-            logger.debug("Splitting input: {0}".format(_inputs.shape))
-            self.input_cached = ArrayDataset._create_patches(
-                _inputs, self.patch_size)
-            logger.debug("Cached: {0}".format(self.input_cached.shape))
-            if _outputs is not None:
-                logger.debug("Splitting output: {0}".format(_outputs.shape))
-                self.output_cached = ArrayDataset._create_patches(
-                    _outputs, self.patch_size)
-                logger.debug("Cached: {0}".format(self.output_cached.shape))
-            self.label_cached = _labels
-            _inputs = self.input_cached[idx]
-            _outputs = self.output_cached[idx]
-
-        # Add input
-        if self.add_input:
-            if _outputs is None:
-                _outputs = _inputs
-            else:
-                _outputs = np.concatenate(
-                    (_outputs, _inputs), axis=concat_axis)
-
-        return DataItem(inputs=_inputs, outputs=_outputs, labels=_labels)
+                outputs = tf(outputs)
+        return inputs, outputs
 
     @staticmethod
     def _create_patches(arr, patch_size):
@@ -658,3 +1318,138 @@ class ArrayDataset(Dataset):
         if self.patch_size is not None:
             return len(self.indices) * self.nb_patches_by_img
         return len(self.indices)
+
+
+class PatchQueue(IterableDataset):
+    """ A dataset of patches: each DataLoader worker loads its share of the
+    volumes a few at a time, draws many patches in each loaded volume and
+    yields them in random order.
+
+    The volumes are loaded with their transforms (see
+    'ArrayDataset.get_sample'): the data augmentation is applied once per
+    volume and the index map used by the label samplers is computed once
+    per volume. The volumes order is derived from the seed and the epoch
+    (see 'set_epoch') so that the workers process disjoint volumes.
+    """
+    def __init__(self, dataset, sampler, patches_per_volume=8,
+                 max_volumes=4, shuffle=True, seed=None, index_maps=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        dataset: ArrayDataset
+            the dataset of volumes.
+        sampler: PatchSampler
+            the patch sampler.
+        patches_per_volume: int, default 8
+            the number of patches drawn in each volume.
+        max_volumes: int, default 4
+            the number of volumes loaded at the same time in a worker: the
+            patches of these volumes are shuffled together.
+        shuffle: bool, default True
+            if set, shuffle the volumes and the patches.
+        seed: int, default None
+            the seed from which the volumes order and the patches are
+            derived, default the dataset seed or a random seed.
+        index_maps: IndexMaps, default None
+            the precomputed voxels of each label of the volumes, indexed by
+            row in the outputs array (see
+            'pynet.datasets.patch.index_outputs'). They are ignored when
+            the dataset has output transforms or data augmentation
+            transforms, that may move the output voxels.
+        """
+        if patches_per_volume < 1 or max_volumes < 1:
+            raise ValueError("The number of patches per volume and the "
+                             "number of volumes must be positive integers.")
+        self.dataset = dataset
+        self.sampler = sampler
+        self.patches_per_volume = patches_per_volume
+        self.max_volumes = max_volumes
+        self.shuffle = shuffle
+        self.index_maps = index_maps
+        if seed is None:
+            seed = getattr(dataset, "seed", None)
+        if seed is None:
+            # A common seed that is sent to all the workers
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        """ Return the number of patches.
+        """
+        return len(self.dataset.indices) * self.patches_per_volume
+
+    def set_epoch(self, epoch):
+        """ Set the epoch from which the volumes order and the patches are
+        derived.
+
+        Parameters
+        ----------
+        epoch: int
+            the epoch number.
+        """
+        self.epoch = epoch
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(epoch)
+
+    def __iter__(self):
+        """ Generate the patches of the worker volumes.
+        """
+        positions = np.arange(len(self.dataset.indices))
+        if self.shuffle:
+            positions = get_rng(derive_seed(
+                self.seed, self.epoch)).permutation(positions)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            positions = positions[worker_info.id::worker_info.num_workers]
+        for start in range(0, len(positions), self.max_volumes):
+            patches = []
+            for position in positions[start: start + self.max_volumes]:
+                patches.extend(self._get_patches(int(position)))
+            order = np.arange(len(patches))
+            if self.shuffle:
+                rng = get_rng(derive_seed(
+                    self.seed, self.epoch, int(positions[start])))
+                order = rng.permutation(order)
+            for idx in order:
+                yield patches[idx]
+
+    def _get_patches(self, position):
+        """ Load a volume and draw its patches.
+        """
+        inputs, outputs, labels = self.dataset.get_sample(position)
+        index_map = None
+        if self.sampler.uses_labels and self._use_index(outputs):
+            index_map = self.index_maps[int(self.dataset.indices[position])]
+        elif self.sampler.uses_labels:
+            index_map = get_index_map(outputs)
+        offsets = self.sampler(
+            inputs.shape[1:], self.patches_per_volume, index_map,
+            derive_seed(self.seed, self.epoch, position, 1))
+        patches = []
+        for offset in offsets:
+            _inputs = self.sampler.extract(inputs, offset)
+            _outputs = None
+            if outputs is not None:
+                _outputs = self.sampler.extract(outputs, offset)
+            if getattr(self.dataset, "add_input", False):
+                if _outputs is None:
+                    _outputs = _inputs
+                else:
+                    _outputs = np.concatenate((_outputs, _inputs), axis=0)
+            patches.append(DataItem(
+                inputs=_inputs, outputs=_outputs, labels=labels))
+        return patches
+
+    def _use_index(self, outputs):
+        """ Check if the precomputed index maps describe the loaded outputs:
+        the output transforms and the data augmentation may move the
+        voxels, the index maps are then computed from the loaded volume.
+        """
+        if self.index_maps is None:
+            return False
+        if (getattr(self.dataset, "output_transforms", None) or
+                getattr(self.dataset, "data_augmentation_transforms", None)):
+            return False
+        return tuple(outputs.shape[1:]) == tuple(self.index_maps.shape)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides a common framework to write fetchers: the subjects
+are processed in a pool of processes, the results are written
+incrementally in preallocated memory-mapped '.npy' files, the progress is
+checkpointed so that an interrupted fetcher resumes where it stopped, and
+the raw files are downloaded in a local content-addressed cache.
+"""
+
+
+# System import
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Third party import
+import progressbar
+import numpy as np
+import pandas as pd
+
+# Package import
+from pynet.datasets.store import create_array, open_array
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+class LocalStore(object):
+    """ A store that copies the raw files from a local folder: it can stand
+    in for a remote store.
+    """
+    def __init__(self, rootdir):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        rootdir: str
+            the folder containing the raw files.
+        """
+        self.rootdir = rootdir
+
+    def __call__(self, key, destfile):
+        """ Copy a raw file.
+
+        Parameters
+        ----------
+        key: str
+            the raw file path relative to the store folder.
+        destfile: str
+            the destination file.
+        """
+        shutil.copyfile(os.path.join(self.rootdir, *key.split("/")), destfile)
+
+
+class ContentCache(object):
+    """ A local content-addressed cache of raw files.
+
+    The files are stored under their SHA-256 digest, and a reference file
+    maps each key (for instance an URL or a remote object name) to a stored
+    file: identical files are stored once. The files are downloaded in a
+    temporary file and moved atomically, so that the cache can be shared by
+    concurrent processes.
+    """
+    def __init__(self, cachedir, download):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        cachedir: str
+            the cache folder.
+        download: callable
+            the function that downloads the raw file of a key in a
+            destination file: 'download(key, destfile)', for instance a
+            'LocalStore'.
+        """
+        self.cachedir = cachedir
+        self.download = download
+        for name in ("objects", "refs", "tmp"):
+            dirname = os.path.join(cachedir, name)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+
+    def get(self, key, digest=None):
+        """ Get the local path of a raw file, downloaded if needed.
+
+        Parameters
+        ----------
+        key: str
+            the raw file identifier.
+        digest: str, default None
+            the expected SHA-256 digest of the raw file.
+
+        Returns
+        -------
+        path: str
+            the cached file, with the key file extension.
+        """
+        refpath = os.path.join(
+            self.cachedir, "refs", hashlib.sha256(key.encode()).hexdigest())
+        if os.path.isfile(refpath):
+            with open(refpath, "rt") as open_file:
+                name = open_file.read().strip()
+            path = os.path.join(self.cachedir, "objects", name[:2], name)
+            if os.path.isfile(path) and (
+                    digest is None or name.startswith(digest)):
+                return path
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.join(self.cachedir, "tmp"))
+        os.close(fd)
+        try:
+            logger.info("  download: {0}".format(key))
+            self.download(key, tmppath)
+            content_digest = file_digest(tmppath)
+            if digest is not None and content_digest != digest:
+                raise ValueError("The downloaded file '{0}' is "
+                                 "corrupted.".format(key))
+            basename = key.split("/")[-1]
+            extension = ""
+            if basename.find(".") > 0:
+                extension = basename[basename.find("."):]
+            name = content_digest + extension
+            path = os.path.join(self.cachedir, "objects", name[:2], name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmppath, path)
+        finally:
+            if os.path.isfile(tmppath):
+                os.remove(tmppath)
+        _atomic_write(refpath, name, os.path.join(self.cachedir, "tmp"))
+        return path
+
+
+def file_digest(path, chunk_size=(1024 ** 2)):
+    """ Compute the SHA-256 digest of a file.
+
+    Parameters
+    ----------
+    path: str
+        the file.
+    chunk_size: int, default 1MB
+        the size of the chunks read in memory.
+
+    Returns
+    -------
+    digest: str
+        the hexadecimal digest.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as open_file:
+        for chunk in iter(lambda: open_file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def fetch_parallel(tasks, process, paths, desc_path, n_rows=None, n_jobs=1,
+                   store=None):
+    """ Process the subjects of a dataset in parallel and write the results
+    incrementally in memory-mapped '.npy' files or in chunked stores.
+
+    The files are allocated from the result of the first task. Each task
+    then writes its own rows, and the completed tasks and their metadata
+    are checkpointed in a '<desc_path>.progress' file: if the fetcher is
+    interrupted, a new call only runs the remaining tasks. The metadata
+    table is written at the end.
+
+    Parameters
+    ----------
+    tasks: list
+        the picklable description of each task, for instance a subject.
+    process: callable
+        the picklable function that processes a task, returning a
+        dictionary with one array of shape (n, *) per destination file, and
+        a list of n dictionaries with the metadata of each row:
+        'arrays, metadata = process(task)'.
+    paths: dict
+        the destination '.npy' files or chunked store folders.
+    desc_path: str
+        the destination metadata '.tsv' file.
+    n_rows: list of int, default None
+        the number of rows generated by each task, default one.
+    n_jobs: int, default 1
+        the number of processes.
+    store: dict, default None
+        if set, the destination files are chunked stores created with these
+        parameters (see 'pynet.datasets.store.create_array'). A partially
+        written chunk is read, modified and written back: the tasks are
+        only run in parallel if the rows of each task are aligned with the
+        chunks ('chunk_rows' divides the task offsets), otherwise they are
+        run serially.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the metadata table.
+    """
+    if n_rows is None:
+        n_rows = [1] * len(tasks)
+    if len(n_rows) != len(tasks) or len(tasks) == 0:
+        raise ValueError("Expect a positive number of tasks and one number "
+                         "of rows per task.")
+    offsets = np.cumsum([0] + list(n_rows))
+    if n_jobs > 1 and store is not None:
+        chunk_rows = store.get("chunk_rows", 1)
+        if any(offset % chunk_rows != 0 for offset in offsets[1: -1]):
+            logger.warning(
+                "The tasks rows are not aligned with the chunks of {0} rows: "
+                "the tasks are run serially.".format(chunk_rows))
+            n_jobs = 1
+    progress_path = desc_path + ".progress"
+    header = {"n_rows": int(offsets[-1]), "paths": paths, "store": store}
+    done = _load_progress(progress_path, header)
+    pending = [idx for idx in range(len(tasks)) if idx not in done]
+    if len(done) > 0:
+        logger.info("Resuming: {0}/{1} tasks already done.".format(
+            len(done), len(tasks)))
+    else:
+        idx = pending.pop(0)
+        arrays, metadata = _check_result(
+            process(tasks[idx]), n_rows[idx], paths)
+        for name, path in paths.items():
+            shape = (int(offsets[-1]), ) + arrays[name].shape[1:]
+            if store is not None:
+                create_array(path, shape, arrays[name].dtype, **store)
+            else:
+                np.lib.format.open_memmap(
+                    path, mode="w+", dtype=arrays[name].dtype, shape=shape)
+        _write_rows(paths, offsets[idx], arrays)
+        del arrays
+        with open(progress_path, "wt") as open_file:
+            open_file.write(json.dumps(header) + "\n")
+        _save_progress(progress_path, idx, metadata)
+        done[idx] = metadata
+    with progressbar.ProgressBar(max_value=len(tasks),
+                                 redirect_stdout=True) as bar:
+        bar.update(len(done))
+        if n_jobs > 1 and len(pending) > 0:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = dict(
+                    (executor.submit(_run_task, process, tasks[idx],
+                                     n_rows[idx], paths, offsets[idx]), idx)
+                    for idx in pending)
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    done[idx] = future.result()
+                    _save_progress(progress_path, idx, done[idx])
+                    bar.update(len(done))
+        else:
+            for idx in pending:
+                done[idx] = _run_task(
+                    process, tasks[idx], n_rows[idx], paths, offsets[idx])
+                _save_progress(progress_path, idx, done[idx])
+                bar.update(len(done))
+    df = pd.DataFrame([row for idx in range(len(tasks)) for row in done[idx]])
+    df.to_csv(desc_path, sep="\t", index=False)
+    os.remove(progress_path)
+    return df
+
+
+def _run_task(process, task, n_rows, paths, offset):
+    """ Process a task and write its rows.
+    """
+    arrays, metadata = _check_result(process(task), n_rows, paths)
+    _write_rows(paths, offset, arrays)
+    return metadata
+
+
+def _check_result(result, n_rows, paths):
+    """ Check that a task returns the expected number of rows.
+    """
+    arrays, metadata = result
+    if set(arrays.keys()) != set(paths.keys()):
+        raise ValueError("Expect one array per destination file: "
+                         "{0}.".format(sorted(paths.keys())))
+    if len(metadata) != n_rows or any(
+            len(arr) != n_rows for arr in arrays.values()):
+        raise ValueError("Expect {0} rows per task.".format(n_rows))
+    return arrays, metadata
+
+
+def _write_rows(paths, offset, arrays):
+    """ Write the rows of a task in the memory-mapped files or in the
+    chunked stores.
+    """
+    for name, path in paths.items():
+        if len(arrays[name]) == 0:
+            continue
+        arr = open_array(path, mode="r+")
+        arr[offset: offset + len(arrays[name])] = arrays[name]
+        arr.flush()
+        del arr
+
+
+def _load_progress(progress_path, header):
+    """ Load the completed tasks if the progress file matches the fetcher
+    parameters and the destination files exist.
+    """
+    done = {}
+    if not os.path.isfile(progress_path):
+        return done
+    with open(progress_path, "rt") as open_file:
+        lines = open_file.readlines()
+    try:
+        valid = json.loads(lines[0]) == header
+    except (IndexError, ValueError):
+        valid = False
+    if not valid or not all(
+            os.path.exists(path) for path in header["paths"].values()):
+        logger.info("Ignoring the incompatible progress file "
+                    "'{0}'.".format(progress_path))
+        return done
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # The last record may have been interrupted
+            continue
+        done[record["task"]] = record["metadata"]
+    return done
+
+
+def _save_progress(progress_path, idx, metadata):
+    """ Append a completed task to the progress file.
+    """
+    with open(progress_path, "at") as open_file:
+        open_file.write(json.dumps(
+            {"task": idx, "metadata": metadata}, default=_to_builtin) + "\n")
+        open_file.flush()
+        os.fsync(open_file.fileno())
+
+
+def _to_builtin(obj):
+    """ Convert the numpy scalars to python objects.
+    """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Unserializable metadata: {0}.".format(obj))
+
+
+def _atomic_write(path, content, tmpdir):
+    """ Write a text file atomically.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=tmpdir)
+    with os.fdopen(fd, "wt") as open_file:
+        open_file.write(content)
+    os.replace(tmppath, path)
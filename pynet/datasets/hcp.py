@@ -20,9 +20,9 @@ import boto3
 from botocore.exceptions import NoCredentialsError
 import nibabel as nib
 import numpy as np
-import pandas as pd
 from scipy import ndimage
 from pynet.datasets import Fetchers
+from pynet.datasets.fetcher import ContentCache, fetch_parallel
 
 
 # Global parameters
@@ -31,7 +31,8 @@ logger = logging.getLogger("pynet")
 
 
 @Fetchers.register
-def fetch_hcp_brain(datasetdir, low=False, small=True):
+def fetch_hcp_brain(datasetdir, low=False, small=True, n_jobs=1,
+                    store=None):
     """ Fetch/prepare the HCP T1/brain mask dataset for pynet.
 
     Go to 'https://db.humanconnectome.org' and get an account and log in.
@@ -50,6 +51,14 @@ def fetch_hcp_brain(datasetdir, low=False, small=True):
         set images in low resolution.
     small: bool, default True
         fetch 45 brains if true, else 1200 brains.
+    n_jobs: int, default 1
+        the number of subjects processed in parallel. The raw files are
+        cached in the 'cache' sub-folder and an interrupted fetch resumes
+        where it stopped.
+    store: dict, default None
+        if set, write the arrays in chunked compressed stores created with
+        these parameters (see 'pynet.datasets.store.create_array') instead
+        of '.npy' files.
 
     Returns
     -------
@@ -59,8 +68,11 @@ def fetch_hcp_brain(datasetdir, low=False, small=True):
     """
     logger.info("Loading HCP brain dataset...")
     desc_path = os.path.join(datasetdir, "pynet_hcp_brain.tsv")
-    input_path = os.path.join(datasetdir, "pynet_hcp_brain_inputs.npy")
-    output_path = os.path.join(datasetdir, "pynet_hcp_brain_outputs.npy")
+    extension = ".npy" if store is None else ".chunks"
+    input_path = os.path.join(
+        datasetdir, "pynet_hcp_brain_inputs" + extension)
+    output_path = os.path.join(
+        datasetdir, "pynet_hcp_brain_outputs" + extension)
 
     if not os.path.isfile(desc_path):
         client = boto3.client("s3")
@@ -86,36 +98,43 @@ def fetch_hcp_brain(datasetdir, low=False, small=True):
         if small:
             subjects_prefix = subjects_prefix[:45]
 
-        images = []
-        masks = []
-        metadata = dict((key, []) for key in ("name", "modality"))
-        for subject in subjects_prefix:
-            subject_prefix = subject["Prefix"]
-            logger.info("  subject: {0}".format(subject_prefix))
-            data = get_hcp_data(datasetdir, subject_prefix, "T1w", low)
-            metadata["name"].append(subject_prefix[11: -1])
-            metadata["modality"].append("T1w")
-            images.append(data["image"])
-            masks.append(data["mask"].astype(int))
-            data = get_hcp_data(datasetdir, subject_prefix, "MNINonLinear",
-                                low)
-            metadata["name"].append(subject_prefix[11: -1])
-            metadata["modality"].append("MNINonLinear")
-            images.append(data["image"])
-            masks.append(data["mask"].astype(int))
-        images = np.asarray(images)
-        masks = np.asarray(masks)
-        images = np.expand_dims(images, axis=1)
-        masks = np.expand_dims(masks, axis=1)
-        np.save(input_path, images)
-        np.save(output_path, masks)
-        df = pd.DataFrame.from_dict(metadata)
-        df.to_csv(desc_path, sep="\t", index=False)
+        tasks = [(datasetdir, subject["Prefix"], low)
+                 for subject in subjects_prefix]
+        fetch_parallel(
+            tasks, _process_subject,
+            {"inputs": input_path, "outputs": output_path}, desc_path,
+            n_rows=([2] * len(tasks)), n_jobs=n_jobs, store=store)
         logger.info("Done.")
     return Item(input_path=input_path, output_path=output_path,
                 metadata_path=desc_path)
 
 
+def _process_subject(task):
+    """ Load the T1 images and brain masks of a subject.
+    """
+    datasetdir, subject_prefix, low = task
+    logger.info("  subject: {0}".format(subject_prefix))
+    images, masks, metadata = [], [], []
+    for modality in ("T1w", "MNINonLinear"):
+        data = get_hcp_data(datasetdir, subject_prefix, modality, low)
+        images.append(data["image"])
+        masks.append(data["mask"].astype(np.uint8))
+        metadata.append({"name": subject_prefix[11: -1],
+                         "modality": modality})
+    arrays = {
+        "inputs": np.expand_dims(np.asarray(images), axis=1),
+        "outputs": np.expand_dims(np.asarray(masks), axis=1)}
+    return arrays, metadata
+
+
+def _download(key, destfile):
+    """ Download a raw file from the HCP bucket.
+    """
+    s3 = boto3.resource("s3")
+    bucket = s3.Bucket("hcp-openaccess")
+    bucket.download_file(key, destfile)
+
+
 def load_image(filename, low=False):
     """ Load an MRI image.
 
@@ -137,14 +156,16 @@ def load_image(filename, low=False):
     img = nib.load(filename)
     img_data = img.get_data()
     img_data = np.append(
-        img_data[2:-2, :, 2:-2], np.zeros((256, 1, 256)), axis=1)
+        img_data[2:-2, :, 2:-2], np.zeros((256, 1, 256), img_data.dtype),
+        axis=1)
     if low:
         img_data = ndimage.zoom(img_data, 1. / 8., order=0)
-        img_data = np.append(img_data, np.zeros((32, 1, 32)), axis=1)
+        img_data = np.append(
+            img_data, np.zeros((32, 1, 32), img_data.dtype), axis=1)
     return img_data
 
 
-def get_hcp_data(datasetdir, subject_prefix, modality, low):
+def get_hcp_data(datasetdir, subject_prefix, modality, low, download=None):
     """ Get the requested data.
 
     Parameters
@@ -157,14 +178,17 @@ def get_hcp_data(datasetdir, subject_prefix, modality, low):
         type of image to be extracted ('T1w' or 'MNINonLinear').
     low: bool
         set image in low resolution.
+    download: callable, default None
+        the function that downloads a raw file, default from the HCP
+        bucket: see 'pynet.datasets.fetcher.ContentCache'.
 
     Returns
     -------
     data: dict
         the loaded data.
     """
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket("hcp-openaccess")
+    cache = ContentCache(
+        os.path.join(datasetdir, "cache"), download or _download)
     mapping = {
         "T1w": {
             "image": "T1w_acpc_dc_restore.nii.gz",
@@ -179,15 +203,5 @@ def get_hcp_data(datasetdir, subject_prefix, modality, low):
     data = {}
     for key, basename in mapping[modality].items():
         url = subject_prefix + "/".join([modality, basename])
-        pattern = url.split("/")
-        destfile = os.path.join(datasetdir, *pattern)
-        if not os.path.isfile(destfile):
-            logger.info("  url: {0}".format(url))
-            logger.info("  dest: {0}".format(destfile))
-            dirname = os.path.dirname(destfile)
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
-            obj = s3.Object(bucket, url)
-            bucket.download_file(obj.key, destfile)
-        data[key] = load_image(destfile, low)
+        data[key] = load_image(cache.get(url), low)
     return data
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that precomputes augmented copies of a training set once, stores
+them in sharded memory-mapped '.npy' files, and streams them afterwards.
+"""
+
+
+# System import
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Third party import
+import numpy as np
+import pandas as pd
+
+# Package import
+from pynet.datasets.core import ArrayDataset
+from pynet.augmentation.utils import get_rng, seed_sequence, derive_seed
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+INDEX_FILE = "index.tsv"
+SHARD_FILE = "{0}_{1:05d}.npy"
+_WORKER_STATE = {}
+
+
+def materialize_augmentation(manager, outdir, transforms=None, n_copies=4,
+                             fold_index=0, shard_size=64, n_jobs=1,
+                             seed=None):
+    """ Precompute augmented copies of the training samples of a fold.
+
+    The input/output transforms of the training dataset are applied once
+    per sample, and the data augmentation transforms once per copy. The
+    copies are written in shards of 'shard_size' rows, one '.npy' file per
+    shard and per data type ('inputs' and 'outputs'), and the 'index.tsv'
+    table gives the shard and the row of each (index, copy) pair.
+
+    Parameters
+    ----------
+    manager: DataManager
+        the data manager.
+    outdir: str
+        the destination folder.
+    transforms: list of callable, default None
+        the data augmentation transforms, default the data augmentation
+        transforms of the training dataset.
+    n_copies: int, default 4
+        the number of augmented copies of each sample.
+    fold_index: int, default 0
+        the index of the training fold.
+    shard_size: int, default 64
+        the number of rows per shard.
+    n_jobs: int, default 1
+        the number of forked processes that compute the shards.
+    seed: int, default None
+        the seed from which the random seed of each copy is derived with
+        the sample index and the copy number.
+
+    Returns
+    -------
+    table: pandas.DataFrame
+        the index table with the 'index', 'copy', 'shard' and 'row' columns.
+    """
+    if n_copies < 1 or shard_size < 1:
+        raise ValueError("The number of copies and the shard size must be "
+                         "positive integers.")
+    dataset = manager["train"][fold_index]
+    if transforms is None:
+        transforms = dataset.data_augmentation_transforms
+    sequence = seed_sequence(seed)
+    items = [(int(index), copy) for index in dataset.indices
+             for copy in range(n_copies)]
+    shards = [items[start: start + shard_size]
+              for start in range(0, len(items), shard_size)]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # Allocate the shards from the shape of the first sample
+    _init_worker(dataset, transforms, sequence)
+    sample = _materialize_sample(*items[0])
+    paths = []
+    for shard, shard_items in enumerate(shards):
+        shard_paths = {}
+        for name, arr in zip(("inputs", "outputs"), sample):
+            if arr is None:
+                continue
+            shard_paths[name] = os.path.join(
+                outdir, SHARD_FILE.format(name, shard))
+            np.lib.format.open_memmap(
+                shard_paths[name], mode="w+", dtype=arr.dtype,
+                shape=(len(shard_items), ) + arr.shape)
+        paths.append(shard_paths)
+    logger.info("Materializing {0} copies of {1} samples in {2} "
+                "shards...".format(n_copies, len(dataset.indices),
+                                   len(shards)))
+
+    # Fill the shards
+    if n_jobs > 1:
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker,
+                initargs=(dataset, transforms, sequence)) as executor:
+            list(executor.map(_materialize_shard, shards, paths))
+    else:
+        for shard_items, shard_paths in zip(shards, paths):
+            _materialize_shard(shard_items, shard_paths)
+    _WORKER_STATE.clear()
+
+    # Write the index table
+    table = pd.DataFrame(
+        [(index, copy, shard, row)
+         for shard, shard_items in enumerate(shards)
+         for row, (index, copy) in enumerate(shard_items)],
+        columns=["index", "copy", "shard", "row"])
+    table.to_csv(os.path.join(outdir, INDEX_FILE), sep="\t", index=False)
+    return table
+
+
+def _init_worker(dataset, transforms, sequence):
+    """ Store the materialization parameters in the worker process.
+    """
+    _WORKER_STATE.update(
+        dataset=dataset, transforms=transforms, sequence=sequence,
+        loaded=(None, None))
+
+
+def _materialize_sample(index, copy):
+    """ Compute an augmented copy of a sample, the deterministic transforms
+    being applied once per sample.
+    """
+    dataset = _WORKER_STATE["dataset"]
+    loaded_index, data = _WORKER_STATE["loaded"]
+    if loaded_index != index:
+        inputs, outputs = dataset._load(index)
+        inputs = dataset._decode(inputs, "inputs")
+        outputs = dataset._decode(outputs, "outputs")
+        data = dataset._transform(
+            inputs, outputs, dataset.input_transforms,
+            dataset.output_transforms, derive_seed(
+                _WORKER_STATE["sequence"], index))
+        _WORKER_STATE["loaded"] = (index, data)
+    transforms = _WORKER_STATE["transforms"]
+    return dataset._transform(
+        data[0], data[1], transforms, transforms,
+        derive_seed(_WORKER_STATE["sequence"], index, copy))
+
+
+def _materialize_shard(shard_items, shard_paths):
+    """ Compute and write the rows of a shard.
+    """
+    arrays = dict(
+        (name, np.load(path, mmap_mode="r+"))
+        for name, path in shard_paths.items())
+    for row, (index, copy) in enumerate(shard_items):
+        inputs, outputs = _materialize_sample(index, copy)
+        arrays["inputs"][row] = inputs
+        if "outputs" in arrays:
+            arrays["outputs"][row] = outputs
+    for arr in arrays.values():
+        arr.flush()
+
+
+class ShardedArray(object):
+    """ A read-only array stored in sharded '.npy' files that are memory
+    mapped on demand: the shards are not pickled with the array, so that
+    the array can be sent to spawned DataLoader workers.
+    """
+    def __init__(self, paths):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        paths: list of str
+            the shard files with the same sample shape.
+        """
+        self.paths = list(paths)
+        self._arrays = {}
+        sizes = []
+        for path in self.paths:
+            arr = np.load(path, mmap_mode="r")
+            sizes.append(len(arr))
+            self.dtype = arr.dtype
+            sample_shape = arr.shape[1:]
+        self.offsets = np.cumsum([0] + sizes)
+        self.shape = (int(self.offsets[-1]), ) + sample_shape
+
+    def __getstate__(self):
+        """ The memory maps are opened again in each process.
+        """
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def __len__(self):
+        """ Return the number of rows.
+        """
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """ Return a row.
+        """
+        index = int(index)
+        if index < 0 or index >= len(self):
+            raise IndexError("Row index out of range.")
+        shard = np.searchsorted(self.offsets, index, side="right") - 1
+        if shard not in self._arrays:
+            self._arrays[shard] = np.load(self.paths[shard], mmap_mode="r")
+        return self._arrays[shard][index - self.offsets[shard]]
+
+
+class MaterializedArrayDataset(ArrayDataset):
+    """ A dataset that samples, for each sample and each epoch, one of the
+    augmented copies precomputed by 'materialize_augmentation'.
+    """
+    def __init__(self, datasetdir, indices=None, labels=None, add_input=False,
+                 label_mapping=None, patch_size=None, seed=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        datasetdir: str
+            the folder containing the index table and the shards.
+        indices: iterable of int, default None
+            the list of sample indices that is considered in this dataset,
+            default all the materialized samples.
+        labels: numpy array, default None
+            the labels indexed by the sample indices, for instance the
+            labels of the materialized dataset.
+        add_input: bool, default False
+            if set concatenate the input data to the output (useful with
+            auto-encoder).
+        label_mapping: dict, default None
+            a mapping that can be used to convert labels to be predicted
+            (string to int conversion).
+        patch_size: tuple, default None
+            the size of the patches that will be extracted from the
+            input/output images.
+        seed: int, default None
+            if set, the copy of a sample is drawn from a seed derived from
+            this seed, the epoch (see 'set_epoch') and the sample index.
+        """
+        table = pd.read_csv(os.path.join(datasetdir, INDEX_FILE), sep="\t")
+        arrays = {}
+        for name in ("inputs", "outputs"):
+            paths = [os.path.join(datasetdir, SHARD_FILE.format(name, shard))
+                     for shard in range(table["shard"].max() + 1)]
+            arrays[name] = None
+            if os.path.isfile(paths[0]):
+                arrays[name] = ShardedArray(paths)
+        if indices is None:
+            indices = np.unique(table["index"].values)
+        super(MaterializedArrayDataset, self).__init__(
+            arrays["inputs"], indices, outputs=arrays["outputs"],
+            add_input=add_input, label_mapping=label_mapping,
+            patch_size=patch_size, seed=seed)
+        self.labels = labels
+        self.n_copies = int(table["copy"].max()) + 1
+        rows = arrays["inputs"].offsets[table["shard"].values]
+        rows += table["row"].values
+        self.rows = dict(zip(zip(table["index"].values.tolist(),
+                                 table["copy"].values.tolist()),
+                             rows.tolist()))
+
+    def _load(self, indices):
+        """ Load a randomly selected copy of a sample.
+        """
+        copy = get_rng(self.get_seed(indices)).integers(self.n_copies)
+        return super(MaterializedArrayDataset, self)._load(
+            self.rows[(int(indices), int(copy))])
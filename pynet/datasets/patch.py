@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides the patch samplers that draw random patches in a
+volume, uniformly or centered on some labels: see 'PatchQueue' in
+'pynet.datasets.core' for the patch-based data loading.
+"""
+
+
+# System import
+import io
+import os
+import json
+import zlib
+import logging
+from collections.abc import Mapping
+
+# Third party import
+import numpy as np
+
+# Package import
+from pynet.augmentation.utils import get_rng
+from pynet.datasets.store import _atomic_write
+
+
+# Global parameters
+INDEX_DIR = "{0}.index"
+logger = logging.getLogger("pynet")
+
+
+def get_index_map(outputs):
+    """ Compute the voxels of each label of a volume.
+
+    Parameters
+    ----------
+    outputs: array (C, *shape)
+        the output data: a label map if there is a single channel, one
+        channel per label otherwise (the label of a voxel being the channel
+        of maximum value).
+
+    Returns
+    -------
+    index_map: dict
+        the flat indices of the voxels of each label in the spatial volume
+        (see 'get_index_dtype').
+    """
+    outputs = np.asarray(outputs)
+    if outputs.shape[0] == 1:
+        labels = outputs[0]
+    else:
+        labels = np.argmax(outputs, axis=0)
+    flat_labels = labels.ravel()
+    order = np.argsort(flat_labels, kind="stable").astype(
+        get_index_dtype(labels.shape))
+    values, starts = np.unique(flat_labels[order], return_index=True)
+    bounds = list(starts[1:]) + [len(order)]
+    return dict(
+        (value.item(), order[start: stop])
+        for value, start, stop in zip(values, starts, bounds))
+
+
+def get_index_dtype(shape):
+    """ The smallest integer type of the flat indices of a volume.
+
+    Parameters
+    ----------
+    shape: tuple
+        the spatial shape of the volume.
+
+    Returns
+    -------
+    dtype: numpy dtype
+        'uint32' if the volume has less than 2**32 voxels, 'int64'
+        otherwise.
+    """
+    if np.prod(shape, dtype=np.int64) < 2 ** 32:
+        return np.dtype(np.uint32)
+    return np.dtype(np.int64)
+
+
+def index_outputs(outputs, path, rows=None, fingerprint=None):
+    """ Index the voxels of each label of the output volumes in a sidecar
+    folder, so that the label samplers do not scan the volumes.
+
+    The index of a row is stored in a compressed '.npz' file: the sorted
+    flat indices of the voxels of each label are delta encoded with the
+    smallest unsigned integer type, together with the number of voxels of
+    each label and the CRC-32 checksum of the row to detect a modified
+    row. The indexing is incremental: only the rows without an index file
+    are indexed, and the index files are written atomically so that an
+    interrupted pass resumes where it stopped. When the fingerprint of the
+    outputs changes (for instance a re-fetched dataset), the existing
+    index files are checked against the checksum of their row and the
+    stale ones are rebuilt. The whole index is rebuilt if the spatial shape
+    of the outputs changes.
+
+    Parameters
+    ----------
+    outputs: array (N, C, *shape)
+        the output data, for instance a memory-mapped array.
+    path: str
+        the index folder, usually '<outputs path>.index' (see
+        'INDEX_DIR').
+    rows: iterable of int, default None
+        the rows to index, default all.
+    fingerprint: dict, default None
+        the fingerprint of the outputs file (see
+        'pynet.datasets.store.get_fingerprint'): if not specified, the
+        existing index files are always checked.
+
+    Returns
+    -------
+    index_maps: IndexMaps
+        the index of the output volumes.
+    """
+    shape = [int(size) for size in outputs.shape[2:]]
+    metapath = os.path.join(path, "meta.json")
+    meta = {}
+    if os.path.isfile(metapath):
+        with open(metapath, "rt") as open_file:
+            meta = json.load(open_file)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    names = [name for name in os.listdir(path) if name.endswith(".npz")]
+    if meta.get("shape", shape) != shape:
+        logger.warning("The outputs shape changed: rebuild the index "
+                       "'{0}'.".format(path))
+        for name in names:
+            os.remove(os.path.join(path, name))
+    elif fingerprint is None or meta.get("source") != fingerprint:
+        # Remove the index files of the modified rows
+        for name in names:
+            row = int(name[1: -4])
+            if (row >= len(outputs) or
+                    IndexMaps.load(os.path.join(path, name),
+                                   shape).checksum !=
+                    _checksum(outputs[row])):
+                os.remove(os.path.join(path, name))
+    index_maps = IndexMaps(path, shape)
+    if rows is None:
+        rows = range(len(outputs))
+    missing = [int(row) for row in rows if int(row) not in index_maps]
+    if len(missing) > 0:
+        logger.info("Indexing {0} output volumes in '{1}'...".format(
+            len(missing), path))
+    for row in missing:
+        index_map = get_index_map(outputs[row])
+        arrays = {
+            "checksum": np.asarray(_checksum(outputs[row])),
+            "sizes": np.asarray(
+                [(int(label), len(voxels))
+                 for label, voxels in index_map.items()],
+                dtype=np.int64).reshape(-1, 2)}
+        for label, voxels in index_map.items():
+            if label != int(label):
+                raise ValueError("The outputs of the row {0} are not "
+                                 "labels.".format(row))
+            deltas = np.diff(voxels.astype(np.int64), prepend=0)
+            arrays["l{0}".format(int(label))] = deltas.astype(
+                np.min_scalar_type(deltas.max()))
+        content = io.BytesIO()
+        np.savez_compressed(content, **arrays)
+        _atomic_write(index_maps.get_path(row), content.getvalue(), path)
+    # The fingerprint is recorded once the index is up to date
+    meta = {"shape": shape, "source": fingerprint}
+    _atomic_write(metapath, json.dumps(meta).encode(), path)
+    return index_maps
+
+
+def _checksum(arr):
+    """ The CRC-32 checksum of an array content.
+    """
+    return zlib.crc32(np.ascontiguousarray(arr).tobytes())
+
+
+class IndexMap(Mapping):
+    """ The index map of a row read from an index file (see
+    'index_outputs'): the voxels of a label are only decoded when they are
+    accessed, so that the samplers that only draw some labels (for
+    instance the foreground) do not decode the whole volume.
+    """
+    def __init__(self, content, shape):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        content: bytes
+            the content of the index file.
+        shape: tuple
+            the spatial shape of the indexed volume.
+        """
+        self.data = np.load(io.BytesIO(content))
+        self.dtype = get_index_dtype(shape)
+        self.sizes = dict(
+            (int(label), int(size)) for label, size in self.data["sizes"])
+        self.checksum = int(self.data["checksum"])
+        self._voxels = {}
+
+    def __getitem__(self, label):
+        """ Decode the voxels of a label.
+        """
+        if label not in self.sizes:
+            raise KeyError(label)
+        if label not in self._voxels:
+            self._voxels[label] = np.cumsum(
+                self.data["l{0}".format(int(label))], dtype=self.dtype)
+        return self._voxels[label]
+
+    def __iter__(self):
+        return iter(self.sizes)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def count(self, label):
+        """ The number of voxels of a label, without decoding them.
+        """
+        return self.sizes.get(label, 0)
+
+
+class IndexMaps(object):
+    """ The index of the output volumes written by 'index_outputs': the
+    index map of a row (see 'IndexMap') is loaded on access.
+    """
+    def __init__(self, path, shape=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        path: str
+            the index folder.
+        shape: tuple, default None
+            the spatial shape of the indexed volumes, default the shape
+            stored in the index.
+        """
+        self.path = path
+        if shape is None:
+            with open(os.path.join(path, "meta.json"), "rt") as open_file:
+                shape = json.load(open_file)["shape"]
+        self.shape = tuple(shape)
+
+    def get_path(self, row):
+        """ Get the index file of a row.
+        """
+        return os.path.join(self.path, "r{0:06d}.npz".format(row))
+
+    def __contains__(self, row):
+        """ Check if a row is indexed.
+        """
+        return os.path.isfile(self.get_path(row))
+
+    def __getitem__(self, row):
+        """ Load the index map of a row.
+
+        Parameters
+        ----------
+        row: int
+            the row in the outputs array.
+
+        Returns
+        -------
+        index_map: IndexMap
+            the flat indices of the voxels of each label in the spatial
+            volume, decoded on access.
+        """
+        if row not in self:
+            raise ValueError("The row {0} is not indexed in '{1}'.".format(
+                row, self.path))
+        return self.load(self.get_path(row), self.shape)
+
+    @staticmethod
+    def load(path, shape):
+        """ Load an index file.
+        """
+        with open(path, "rb") as open_file:
+            return IndexMap(open_file.read(), shape)
+
+
+class PatchSampler(object):
+    """ Draw the positions of random patches in a volume.
+    """
+    uses_labels = False
+
+    def __init__(self, patch_size):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        patch_size: tuple
+            the spatial size of the patches.
+        """
+        self.patch_size = np.asarray(patch_size, dtype=int)
+
+    def __call__(self, shape, n_patches, index_map=None, seed=None):
+        """ Draw patches in a volume.
+
+        Parameters
+        ----------
+        shape: tuple
+            the spatial shape of the volume.
+        n_patches: int
+            the number of patches.
+        index_map: dict or IndexMap, default None
+            the voxels of each label (see 'get_index_map' and
+            'IndexMap'), required by the samplers that use the labels.
+        seed: int, SeedSequence or Generator, default None
+            seed to control random number generator.
+
+        Returns
+        -------
+        offsets: array (n_patches, N)
+            the position of the first voxel of each patch.
+        """
+        shape = np.asarray(shape, dtype=int)
+        if (len(shape) != len(self.patch_size) or
+                np.any(shape < self.patch_size)):
+            raise ValueError("The volume {0} is smaller than the patch "
+                             "{1}.".format(tuple(shape),
+                                           tuple(self.patch_size)))
+        return self.sample(shape, n_patches, index_map, get_rng(seed))
+
+    def sample(self, shape, n_patches, index_map, rng):
+        """ Draw uniformly the position of the patches: to be overloaded.
+        """
+        return rng.integers(0, shape - self.patch_size + 1,
+                            size=(n_patches, len(shape)))
+
+    def extract(self, arr, offset):
+        """ Extract a patch.
+
+        Parameters
+        ----------
+        arr: array (C, *shape)
+            the volume.
+        offset: array (N, )
+            the position of the first voxel of the patch.
+
+        Returns
+        -------
+        patch: array (C, *patch_size)
+            the patch.
+        """
+        return arr[(Ellipsis, ) + tuple(
+            slice(start, start + size)
+            for start, size in zip(offset, self.patch_size))]
+
+    def centered(self, shape, centers):
+        """ Get the position of the patches centered on some voxels, the
+        patches being shifted inside the volume.
+        """
+        offsets = centers - self.patch_size // 2
+        return np.clip(offsets, 0, shape - self.patch_size)
+
+
+class RandomPatchSampler(PatchSampler):
+    """ Draw patches at uniformly random positions.
+    """
+
+
+class LabelPatchSampler(PatchSampler):
+    """ Draw patches centered on a voxel of a randomly selected label.
+
+    Either the labels are drawn with the given probabilities (label-balanced
+    sampling), or the patches are centered on a foreground voxel (any
+    non-null label) with a given probability and uniformly drawn otherwise
+    (foreground-weighted sampling). The center is uniformly drawn among the
+    voxels of the selected label using the precomputed index map of the
+    volume: when a label is absent, the probabilities are normalized over
+    the present labels.
+    """
+    uses_labels = True
+
+    def __init__(self, patch_size, label_probabilities=None,
+                 foreground_probability=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        patch_size: tuple
+            the spatial size of the patches.
+        label_probabilities: dict, default None
+            the probability to center a patch on each label.
+        foreground_probability: float, default None
+            the probability to center a patch on a foreground voxel.
+        """
+        super(LabelPatchSampler, self).__init__(patch_size)
+        if (label_probabilities is None) == (foreground_probability is None):
+            raise ValueError("Specify either the label probabilities or the "
+                             "foreground probability.")
+        if (foreground_probability is not None and
+                not 0 <= foreground_probability <= 1):
+            raise ValueError("The foreground probability must be in [0, 1].")
+        self.label_probabilities = label_probabilities
+        self.foreground_probability = foreground_probability
+
+    def sample(self, shape, n_patches, index_map, rng):
+        """ Draw the position of the patches from the labels.
+        """
+        if index_map is None:
+            raise ValueError("The label sampling requires an index map.")
+        if self.foreground_probability is not None:
+            # A foreground voxel is uniformly drawn: the labels are
+            # selected according to their number of voxels
+            labels = [label for label in index_map if label != 0]
+            weights = np.asarray(
+                [_count(index_map, label) for label in labels], dtype=float)
+            on_labels = rng.random(n_patches) < self.foreground_probability
+        else:
+            labels = [label for label in self.label_probabilities
+                      if _count(index_map, label) > 0]
+            weights = np.asarray(
+                [self.label_probabilities[label] for label in labels],
+                dtype=float)
+            on_labels = np.ones(n_patches, dtype=bool)
+        offsets = super(LabelPatchSampler, self).sample(
+            shape, n_patches, index_map, rng)
+        if weights.sum() == 0:
+            return offsets
+        n_centered = int(on_labels.sum())
+        selected = rng.choice(len(labels), size=n_centered,
+                              p=(weights / weights.sum()))
+        flat = np.empty(n_centered, dtype=int)
+        for idx, label_idx in enumerate(selected):
+            voxels = index_map[labels[label_idx]]
+            flat[idx] = voxels[rng.integers(len(voxels))]
+        centers = np.stack(np.unravel_index(flat, tuple(shape)), axis=1)
+        offsets[on_labels] = self.centered(shape, centers)
+        return offsets
+
+
+def _count(index_map, label):
+    """ The number of voxels of a label in an index map.
+    """
+    if isinstance(index_map, IndexMap):
+        return index_map.count(label)
+    return len(index_map.get(label, ()))
@@ -28,6 +28,8 @@ import nibabel
 import numpy as np
 import pandas as pd
 from pynet.datasets import Fetchers
+from pynet.datasets.fetcher import fetch_parallel
+from pynet.datasets.store import open_array
 
 
 # Global parameters
@@ -300,7 +302,8 @@ def organize_primede(datasetdir):
 
 
 @Fetchers.register
-def fetch_primede(datasetdir, maskdirname="brainmask"):
+def fetch_primede(datasetdir, maskdirname="brainmask", n_jobs=1,
+                  store=None):
     """ Fetch/prepare the PRIME-DE dataset for pynet.
 
     Parameters
@@ -309,6 +312,13 @@ def fetch_primede(datasetdir, maskdirname="brainmask"):
         the dataset destination folder.
     maskdirname: str
         name of the folder that contains the brain masks.
+    n_jobs: int, default 1
+        the number of images processed in parallel. An interrupted fetch
+        resumes where it stopped.
+    store: dict, default None
+        if set, write the arrays in chunked compressed stores created with
+        these parameters (see 'pynet.datasets.store.create_array') instead
+        of '.npy' files.
 
     Returns
     -------
@@ -321,60 +331,60 @@ def fetch_primede(datasetdir, maskdirname="brainmask"):
     if not os.path.isdir(datasetdir):
         os.mkdir(datasetdir)
     desc_path = os.path.join(datasetdir, "pynet_primede.tsv")
-    input_path = os.path.join(datasetdir, "pynet_primede_inputs.npy")
-    output_path = os.path.join(datasetdir, "pynet_primede_outputs.npy")
+    extension = ".npy" if store is None else ".chunks"
+    input_path = os.path.join(
+        datasetdir, "pynet_primede_inputs" + extension)
+    output_path = os.path.join(
+        datasetdir, "pynet_primede_outputs" + extension)
     if not os.path.isfile(desc_path):
-        metadata = OrderedDict(
-            (key, []) for key in ("participant_id", "site", "with_mask",
-                                  "valid", "session", "run"))
         anat_files = glob.glob(os.path.join(
             datasetdir, "sub-*", "ses-*", "anat", "*acq-nc1iso*.nii.gz"))
         if len(anat_files) == 0:
             raise ValueError("Your dataset directory must contain the Prime "
                              "DE data organized with the function provided in "
                              "this module and preprocessed.")
-        inputs = []
-        outputs = []
-        for path in anat_files:
-            sid = path.split(os.sep)[-4].replace("sub-", "")
-            ses = path.split(os.sep)[-3].replace("ses-", "")
-            inputs.append(nibabel.load(path).get_data())
-            mask_path = path.replace(imdirname, maskdirname).replace(
-                "acq-nc1iso", "acq-c1iso").replace(".nii.gz", "_mask.nii.gz")
-            with_mask = 0
-            if os.path.isfile(mask_path):
-                outputs.append(nibabel.load(mask_path).get_data())
-                with_mask = 1
-            else:
-                outputs.append(np.zeros((90, 90, 60), dtype=int))
-            basename = os.path.basename(path)
-            match = re.findall("run-(\d+)_", basename)
-            if len(match) == 1:
-                run = match[0]
-            else:
-                run = "nc"
-            valid = 1
-            if "{0}-{1}".format(sid, ses) in QC:
-                valid = 0
-            metadata["participant_id"].append(sid)
-            metadata["site"].append(sid[:3])
-            metadata["with_mask"].append(with_mask)
-            metadata["valid"].append(valid)
-            metadata["session"].append(ses)
-            metadata["run"].append(run)
-        inputs = np.asarray(inputs)
-        outputs = np.asarray(outputs)
-        inputs_im = nibabel.Nifti1Image(
-            inputs.transpose(1, 2, 3, 0), np.eye(4))
-        outputs_im = nibabel.Nifti1Image(
-            outputs.transpose(1, 2, 3, 0), np.eye(4))
-        inputs = np.expand_dims(inputs, axis=1)
-        outputs = np.expand_dims(outputs, axis=1)
-        np.save(input_path, inputs)
-        np.save(output_path, outputs)
-        nibabel.save(inputs_im, input_path.replace(".npy", ".nii.gz"))
-        nibabel.save(outputs_im, output_path.replace(".npy", ".nii.gz"))
-        df = pd.DataFrame.from_dict(metadata)
-        df.to_csv(desc_path, sep="\t", index=False)
+        tasks = [(path, imdirname, maskdirname) for path in anat_files]
+        fetch_parallel(
+            tasks, _process_image,
+            {"inputs": input_path, "outputs": output_path}, desc_path,
+            n_jobs=n_jobs, store=store)
+        for path in (input_path, output_path):
+            data = open_array(path, mode="r")
+            im = nibabel.Nifti1Image(
+                np.asarray(data[:, 0]).transpose(1, 2, 3, 0), np.eye(4))
+            nibabel.save(im, path.replace(".npy", ".nii.gz"))
     return Item(input_path=input_path, output_path=output_path,
                 metadata_path=desc_path)
+
+
+def _process_image(task):
+    """ Load an anatomical image and its brain mask.
+    """
+    path, imdirname, maskdirname = task
+    sid = path.split(os.sep)[-4].replace("sub-", "")
+    ses = path.split(os.sep)[-3].replace("ses-", "")
+    inputs = nibabel.load(path).get_data()
+    mask_path = path.replace(imdirname, maskdirname).replace(
+        "acq-nc1iso", "acq-c1iso").replace(".nii.gz", "_mask.nii.gz")
+    with_mask = 0
+    if os.path.isfile(mask_path):
+        outputs = nibabel.load(mask_path).get_data().astype(np.uint8)
+        with_mask = 1
+    else:
+        outputs = np.zeros((90, 90, 60), dtype=np.uint8)
+    basename = os.path.basename(path)
+    match = re.findall("run-(\d+)_", basename)
+    if len(match) == 1:
+        run = match[0]
+    else:
+        run = "nc"
+    valid = 1
+    if "{0}-{1}".format(sid, ses) in QC:
+        valid = 0
+    metadata = OrderedDict((
+        ("participant_id", sid), ("site", sid[:3]),
+        ("with_mask", with_mask), ("valid", valid), ("session", ses),
+        ("run", run)))
+    arrays = {"inputs": inputs[np.newaxis, np.newaxis],
+              "outputs": outputs[np.newaxis, np.newaxis]}
+    return arrays, [metadata]
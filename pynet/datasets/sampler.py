@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides a locality-aware sampler for the datasets stored in
+memory-mapped arrays larger than the memory.
+"""
+
+
+# System import
+import os
+import mmap
+import logging
+
+# Third party import
+import numpy as np
+from torch.utils.data import Sampler
+
+# Package import
+from pynet.augmentation.utils import get_rng, derive_seed
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+class BlockShuffleSampler(Sampler):
+    """ A sampler that shuffles blocks of contiguous rows, and then the
+    samples within a window of consecutive blocks.
+
+    The samples are sorted by their row in the input array and grouped in
+    blocks of 'block_size' samples. At each epoch, the blocks order is
+    shuffled, and the samples of each window of 'window' consecutive blocks
+    are shuffled together. A mini-batch thus reads a few contiguous regions
+    of the files instead of one random region per sample: large blocks and
+    small windows favor the locality, small blocks and large windows the
+    randomness ('block_size=1' gives a random permutation).
+
+    When a window is started, the operating system is advised to read
+    ahead the rows of the next windows ('madvise(MADV_WILLNEED)' on a
+    mapping of the '.npy' files): the DataLoader workers then find them in
+    the page cache.
+    """
+    def __init__(self, data_source, block_size=32, window=4,
+                 prefetch_windows=1, seed=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        data_source: Dataset
+            the dataset to sample from: for an 'ArrayDataset', the rows of
+            the samples in the memory-mapped inputs (and outputs) are used
+            to build the blocks and the read ahead advices.
+        block_size: int, default 32
+            the number of samples per block.
+        window: int, default 4
+            the number of blocks whose samples are shuffled together.
+        prefetch_windows: int, default 1
+            the number of windows read ahead, no advice if 0.
+        seed: int, default None
+            if set, the permutation of an epoch is derived from this seed
+            and the epoch (see 'set_epoch').
+        """
+        if block_size < 1 or window < 1 or prefetch_windows < 0:
+            raise ValueError("The block size and the window must be positive "
+                             "integers.")
+        self.data_source = data_source
+        self.block_size = block_size
+        self.window = window
+        self.prefetch_windows = prefetch_windows
+        self.seed = seed
+        self.epoch = 0
+        self.rows = self.get_rows(data_source)
+        order = np.argsort(self.rows, kind="stable")
+        self.blocks = [order[start: start + block_size]
+                       for start in range(0, len(order), block_size)]
+        self._mappings = None
+
+    def __getstate__(self):
+        """ The mappings are not pickled.
+        """
+        state = self.__dict__.copy()
+        state["_mappings"] = None
+        return state
+
+    def __len__(self):
+        """ Return the number of samples.
+        """
+        return len(self.rows)
+
+    def set_epoch(self, epoch):
+        """ Set the epoch from which the permutation is derived.
+
+        Parameters
+        ----------
+        epoch: int
+            the epoch number.
+        """
+        self.epoch = epoch
+
+    def __iter__(self):
+        """ Generate the samples of an epoch.
+        """
+        seed = None
+        if self.seed is not None:
+            seed = derive_seed(self.seed, self.epoch)
+        rng = get_rng(seed)
+        blocks = [self.blocks[idx] for idx in rng.permutation(
+            len(self.blocks))]
+        windows = [np.concatenate(blocks[start: start + self.window])
+                   for start in range(0, len(blocks), self.window)]
+        for idx, window in enumerate(windows):
+            for upcoming in windows[idx + 1: idx + 1 + self.prefetch_windows]:
+                self.advise(upcoming)
+            for item in rng.permutation(window):
+                yield int(item)
+
+    def advise(self, items):
+        """ Advise the operating system to read ahead the rows of some
+        samples in the memory-mapped files.
+
+        Parameters
+        ----------
+        items: array of int
+            the samples.
+        """
+        if self._mappings is None:
+            self._mappings = self._map_arrays()
+        if len(self._mappings) == 0:
+            return
+        rows = np.unique(self.rows[items])
+        # Contiguous runs of rows: [start, stop)
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = rows[np.concatenate(([0], breaks))]
+        stops = rows[np.concatenate((breaks - 1, [len(rows) - 1]))] + 1
+        for mapping, offset, row_bytes in self._mappings:
+            for start, stop in zip(starts, stops):
+                begin = offset + int(start) * row_bytes
+                end = offset + int(stop) * row_bytes
+                begin -= begin % mmap.PAGESIZE
+                try:
+                    mapping.madvise(mmap.MADV_WILLNEED, begin, end - begin)
+                except (OSError, ValueError) as exc:
+                    logger.debug("Read ahead advice failed: {0}.".format(
+                        exc))
+
+    def _map_arrays(self):
+        """ Map the '.npy' files of the dataset, if the 'madvise' call is
+        available.
+        """
+        mappings = []
+        if (self.prefetch_windows == 0 or not hasattr(mmap, "MADV_WILLNEED")
+                or not hasattr(mmap.mmap, "madvise")):
+            return mappings
+        for name in ("inputs", "outputs"):
+            arr = getattr(self.data_source, name, None)
+            if not isinstance(arr, np.memmap) or arr.filename is None:
+                continue
+            with open(arr.filename, "rb") as open_file:
+                if os.fstat(open_file.fileno()).st_size == 0:
+                    continue
+                mapping = mmap.mmap(open_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            row_bytes = int(np.prod(arr.shape[1:])) * arr.dtype.itemsize
+            mappings.append((mapping, arr.offset, row_bytes))
+        return mappings
+
+    @staticmethod
+    def get_rows(data_source):
+        """ Get the row of each sample in the arrays of a dataset.
+
+        Parameters
+        ----------
+        data_source: Dataset
+            the dataset: the 'indices' attribute of an 'ArrayDataset' gives
+            the rows, the patches of a sample sharing its row.
+
+        Returns
+        -------
+        rows: array of int
+            the row of each sample.
+        """
+        n_samples = len(data_source)
+        indices = getattr(data_source, "indices", None)
+        if indices is None:
+            return np.arange(n_samples)
+        indices = np.asarray(indices)
+        return indices[np.arange(n_samples) * len(indices) // n_samples]
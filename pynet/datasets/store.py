@@ -0,0 +1,562 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides a chunked and compressed array store, an alternative
+to the monolithic '.npy' files: the samples are grouped in chunks of a few
+rows, each chunk being compressed in its own file, so that a random access
+only reads (and decompresses) the chunk of the requested sample.
+"""
+
+
+# System import
+import os
+import json
+import uuid
+import zlib
+import lzma
+import shutil
+import struct
+import logging
+import tempfile
+
+# Third party import
+import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+META_FILE = "meta.json"
+ATTRIBUTES_FILE = "{0}.json"
+CHUNK_FILE = "c{0:06d}"
+QUANTIZATIONS = (None, "float16", "uint8")
+_HEADER = struct.Struct("<dd")
+
+
+def _zstd_compress(data, level, itemsize):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _blosc_compress(data, level, itemsize):
+    return blosc.compress(data, typesize=itemsize, clevel=level,
+                          shuffle=blosc.SHUFFLE, cname="zstd")
+
+
+# The codecs: name -> (available, default level, compress, decompress)
+CODECS = {
+    None: (True, None, lambda data, level, itemsize: data,
+           lambda data: data),
+    "zlib": (True, 6, lambda data, level, itemsize: zlib.compress(
+        data, level), zlib.decompress),
+    "lzma": (True, 6, lambda data, level, itemsize: lzma.compress(
+        data, preset=level), lzma.decompress),
+    "zstd": (zstandard is not None, 3, _zstd_compress, _zstd_decompress),
+    "blosc": (blosc is not None, 5, _blosc_compress,
+              lambda data: blosc.decompress(data))
+}
+
+
+def available_codecs():
+    """ Return the compression codecs available with the installed
+    packages.
+
+    Returns
+    -------
+    codecs: list of str
+        the codec names: 'zlib' and 'lzma' are always available, 'zstd'
+        requires the 'zstandard' package and 'blosc' the 'blosc' package.
+    """
+    return [name for name, (available, _, _, _) in CODECS.items()
+            if available and name is not None]
+
+
+def create_array(path, shape, dtype, chunk_rows=1, codec="zlib", level=None,
+                 quantize=None):
+    """ Create an empty chunked array store.
+
+    Parameters
+    ----------
+    path: str
+        the store folder, for instance 'pynet_hcp_brain_inputs.chunks'.
+    shape: tuple
+        the array shape, the samples being indexed by the first axis.
+    dtype: str or numpy.dtype
+        the data type of the decoded array.
+    chunk_rows: int, default 1
+        the number of samples per chunk.
+    codec: str, default 'zlib'
+        the compression codec: None, 'zlib', 'lzma', 'zstd' or 'blosc'
+        (see 'available_codecs').
+    level: int, default None
+        the compression level, default a codec specific level.
+    quantize: str, default None
+        the lossy encoding of floating point data: 'float16' to store half
+        precision values, 'uint8' to store 256 levels linearly spread
+        between the minimum and the maximum of each chunk.
+
+    Returns
+    -------
+    arr: ChunkedArray
+        the writable store: the missing chunks are read as zeros.
+    """
+    dtype = np.dtype(dtype)
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '{0}'.".format(codec))
+    if not CODECS[codec][0]:
+        raise ValueError("The '{0}' codec is not available: install the "
+                         "associated package.".format(codec))
+    if quantize not in QUANTIZATIONS:
+        raise ValueError("Unknown quantization '{0}'.".format(quantize))
+    if quantize is not None and dtype.kind != "f":
+        raise ValueError("Only floating point data can be quantized.")
+    if chunk_rows < 1:
+        raise ValueError("The number of rows per chunk must be a positive "
+                         "integer.")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    meta = {
+        "shape": [int(size) for size in shape], "dtype": dtype.str,
+        "chunk_rows": int(chunk_rows), "codec": codec,
+        "level": CODECS[codec][1] if level is None else int(level),
+        "quantize": quantize}
+    _atomic_write(os.path.join(path, META_FILE), json.dumps(meta).encode(),
+                  path)
+    return ChunkedArray(path, mode="r+")
+
+
+def open_array(path, mode="r"):
+    """ Open an array stored in a '.npy' file or in a chunked store.
+
+    Parameters
+    ----------
+    path: str
+        a '.npy' file opened with memory mapping or a chunked store folder.
+    mode: str, default 'r'
+        the access mode: 'r' or 'r+'.
+
+    Returns
+    -------
+    arr: numpy.memmap or ChunkedArray
+        the array.
+    """
+    if os.path.isdir(path):
+        return ChunkedArray(path, mode=mode)
+    return np.load(path, mmap_mode=mode)
+
+
+def read_attributes(path):
+    """ Read the attributes of an array, for instance the 'scale' and
+    'offset' that decode an array stored as integers.
+
+    Parameters
+    ----------
+    path: str
+        a '.npy' file, the attributes being stored in the '<path>.json'
+        file, or a chunked store folder.
+
+    Returns
+    -------
+    attributes: dict
+        the array attributes.
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, META_FILE), "rt") as open_file:
+            return json.load(open_file).get("attributes", {})
+    sidecar = ATTRIBUTES_FILE.format(path)
+    if not os.path.isfile(sidecar):
+        return {}
+    with open(sidecar, "rt") as open_file:
+        return json.load(open_file)
+
+
+def write_attributes(path, attributes):
+    """ Write the attributes of an array.
+
+    Parameters
+    ----------
+    path: str
+        a '.npy' file or a chunked store folder.
+    attributes: dict
+        the JSON serializable array attributes.
+    """
+    if os.path.isdir(path):
+        metapath = os.path.join(path, META_FILE)
+        with open(metapath, "rt") as open_file:
+            meta = json.load(open_file)
+        meta["attributes"] = attributes
+        _atomic_write(metapath, json.dumps(meta).encode(), path)
+    else:
+        _atomic_write(ATTRIBUTES_FILE.format(path),
+                      json.dumps(attributes).encode(),
+                      os.path.dirname(os.path.abspath(path)))
+
+
+def convert_array(path, destpath, dtype, block_bytes=(64 * 1024 ** 2)):
+    """ Convert an array to a storage data type, for instance float16 or
+    int16 images and uint8 masks.
+
+    Floating point data converted to an integer type are linearly mapped
+    on the range of the type: the 'scale' and 'offset' that decode the data,
+    'arr * scale + offset', are written in the array attributes. Integer
+    data are cast and must fit in the new type. The array is converted by
+    blocks of rows so that it is never loaded in memory.
+
+    The destination is written in a temporary file (or folder) that is
+    renamed at the end, so that concurrent processes converting the same
+    array never read a partially written copy. The fingerprint of the
+    source (see 'get_fingerprint') is stored in the 'source' attribute to
+    detect a modified source.
+
+    Parameters
+    ----------
+    path: str
+        the source '.npy' file or chunked store folder.
+    destpath: str
+        the destination: a chunked store with the source parameters is
+        written if the source is a store, a '.npy' file otherwise.
+    dtype: str or numpy.dtype
+        the storage data type.
+    block_bytes: int, default 64MB
+        the size of the converted blocks of rows.
+
+    Returns
+    -------
+    attributes: dict
+        the destination attributes: the 'scale', 'offset', decoded
+        'dtype' and 'source' fingerprint.
+    """
+    dtype = np.dtype(dtype)
+    fingerprint = get_fingerprint(path)
+    src = open_array(path)
+    src_attributes = read_attributes(path)
+    row_bytes = max(src.nbytes // max(len(src), 1), 1)
+    block_rows = max(int(block_bytes // row_bytes), 1)
+    blocks = [slice(start, start + block_rows)
+              for start in range(0, len(src), block_rows)]
+
+    def decoded(block):
+        arr = np.asarray(src[block])
+        if "scale" in src_attributes:
+            arr = arr * src_attributes["scale"] + src_attributes["offset"]
+        return arr
+
+    # Compute the decoding parameters
+    scale, offset = (1., 0.)
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        vmin = min((float(decoded(block).min()) for block in blocks),
+                   default=0.)
+        vmax = max((float(decoded(block).max()) for block in blocks),
+                   default=0.)
+        if src.dtype.kind == "f" or "scale" in src_attributes:
+            scale = (vmax - vmin) / (float(info.max) - float(info.min)) or 1.
+            offset = vmin - info.min * scale
+        elif vmin < info.min or vmax > info.max:
+            raise ValueError("The data range [{0}, {1}] does not fit in "
+                             "{2}.".format(vmin, vmax, dtype))
+
+    # Write the converted data in a temporary destination
+    attributes = {"scale": scale, "offset": offset,
+                  "dtype": src_attributes.get("dtype", src.dtype.str),
+                  "source": fingerprint}
+    tmppath = "{0}.{1}.tmp".format(destpath, uuid.uuid4().hex)
+    if isinstance(src, ChunkedArray):
+        dest = create_array(tmppath, src.shape, dtype,
+                            chunk_rows=src.chunk_rows, codec=src.codec,
+                            level=src.level)
+    else:
+        dest = np.lib.format.open_memmap(
+            tmppath, mode="w+", dtype=dtype, shape=src.shape)
+    try:
+        for block in blocks:
+            arr = decoded(block)
+            if scale != 1. or offset != 0.:
+                arr = np.rint((arr - offset) / scale)
+                arr = arr.clip(info.min, info.max)
+            dest[block] = arr.astype(dtype)
+        dest.flush()
+        del dest
+        if os.path.isdir(tmppath):
+            write_attributes(tmppath, attributes)
+            _replace_folder(tmppath, destpath)
+        else:
+            os.replace(tmppath, destpath)
+            write_attributes(destpath, attributes)
+    finally:
+        if os.path.isdir(tmppath):
+            shutil.rmtree(tmppath)
+        elif os.path.isfile(tmppath):
+            os.remove(tmppath)
+    return attributes
+
+
+def get_fingerprint(path):
+    """ Get the fingerprint of an array: the size and modification time of
+    a '.npy' file, or of the files of a chunked store.
+
+    Parameters
+    ----------
+    path: str
+        a '.npy' file or a chunked store folder.
+
+    Returns
+    -------
+    fingerprint: dict
+        the JSON serializable 'size' and 'mtime_ns' of the array.
+    """
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    stats = [os.stat(path) for path in paths]
+    return {"size": sum(stat.st_size for stat in stats),
+            "mtime_ns": max((stat.st_mtime_ns for stat in stats), default=0)}
+
+
+class ChunkedArray(object):
+    """ An array stored in compressed chunks of rows.
+
+    The array behaves like a read-only memory-mapped array for the data
+    loading: 'len', 'shape', 'dtype' and indexing along the first axis.
+    A chunk is written atomically, so that concurrent processes may fill
+    the array as long as they write whole chunks. The last decoded chunk
+    is kept in memory and the array can be pickled to be sent to the
+    DataLoader workers.
+    """
+    def __init__(self, path, mode="r"):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        path: str
+            the store folder created with 'create_array'.
+        mode: str, default 'r'
+            the access mode: 'r' or 'r+'.
+        """
+        if mode not in ("r", "r+"):
+            raise ValueError("Unsupported access mode '{0}'.".format(mode))
+        with open(os.path.join(path, META_FILE), "rt") as open_file:
+            meta = json.load(open_file)
+        self.path = path
+        self.mode = mode
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.chunk_rows = meta["chunk_rows"]
+        self.codec = meta["codec"]
+        self.level = meta["level"]
+        self.quantize = meta["quantize"]
+        self.n_chunks = -(-self.shape[0] // self.chunk_rows)
+        self._cached = (None, None)
+
+    def __getstate__(self):
+        """ The decoded chunk is not pickled.
+        """
+        state = self.__dict__.copy()
+        state["_cached"] = (None, None)
+        return state
+
+    def __len__(self):
+        """ Return the number of rows.
+        """
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        """ Return the number of dimensions.
+        """
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        """ Return the size of the decoded array in bytes.
+        """
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __array__(self, dtype=None):
+        """ Decode the whole array.
+        """
+        arr = self[:]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __getitem__(self, key):
+        """ Return the requested rows, the other axes being indexed after
+        decoding.
+        """
+        if not isinstance(key, tuple):
+            key = (key, )
+        rows, others = key[0], key[1:]
+        if isinstance(rows, (int, np.integer)):
+            arr = self._get_row(self._check_row(rows))
+        else:
+            indices = self._get_rows(rows)
+            arr = np.empty((len(indices), ) + self.shape[1:],
+                           dtype=self.dtype)
+            for idx, row in enumerate(indices):
+                arr[idx] = self._get_row(row)
+            others = (slice(None), ) + others
+        if len(others) > 1 or (len(others) == 1 and others[0] != slice(None)):
+            arr = arr[others]
+        return arr
+
+    def __setitem__(self, key, value):
+        """ Write a row or a range of rows: the partially written chunks are
+        decoded and rewritten.
+        """
+        if self.mode != "r+":
+            raise ValueError("The array is opened in read-only mode.")
+        if isinstance(key, (int, np.integer)):
+            start = self._check_row(key)
+            stop = start + 1
+            value = np.asarray(value)[np.newaxis]
+        elif isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+        else:
+            raise ValueError("Only a row or a contiguous range of rows can be "
+                             "written.")
+        value = np.broadcast_to(value, (stop - start, ) + self.shape[1:])
+        for chunk in range(start // self.chunk_rows,
+                           -(-stop // self.chunk_rows)):
+            chunk_start = chunk * self.chunk_rows
+            chunk_stop = min(chunk_start + self.chunk_rows, len(self))
+            if start <= chunk_start and chunk_stop <= stop:
+                data = value[chunk_start - start: chunk_stop - start]
+            else:
+                data = self._read_chunk(chunk).copy()
+                lower = max(start, chunk_start)
+                upper = min(stop, chunk_stop)
+                data[lower - chunk_start: upper - chunk_start] = value[
+                    lower - start: upper - start]
+            self._write_chunk(chunk, data)
+
+    def flush(self):
+        """ The chunks are written immediately: kept for compatibility with
+        memory-mapped arrays.
+        """
+        pass
+
+    def _check_row(self, row):
+        """ Check a row index.
+        """
+        row = int(row)
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError("Row index out of range.")
+        return row
+
+    def _get_rows(self, rows):
+        """ Get the row indices selected by a slice, a mask or a list.
+        """
+        if isinstance(rows, slice):
+            return range(*rows.indices(len(self)))
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return [self._check_row(row) for row in rows.ravel()]
+
+    def _get_row(self, row):
+        """ Decode the chunk of a row and return a copy of the row.
+        """
+        chunk = row // self.chunk_rows
+        return self._read_chunk(chunk)[row - chunk * self.chunk_rows].copy()
+
+    def _chunk_shape(self, chunk):
+        """ Return the shape of a chunk: the last chunk may be smaller.
+        """
+        n_rows = min(self.chunk_rows, len(self) - chunk * self.chunk_rows)
+        return (n_rows, ) + self.shape[1:]
+
+    def _read_chunk(self, chunk):
+        """ Read and decode a chunk.
+        """
+        if self._cached[0] == chunk:
+            return self._cached[1]
+        shape = self._chunk_shape(chunk)
+        path = os.path.join(self.path, CHUNK_FILE.format(chunk))
+        if not os.path.isfile(path):
+            return np.zeros(shape, dtype=self.dtype)
+        with open(path, "rb") as open_file:
+            content = open_file.read()
+        scale, offset = _HEADER.unpack_from(content)
+        data = CODECS[self.codec][3](content[_HEADER.size:])
+        encoded_dtype = self.dtype
+        if self.quantize is not None:
+            encoded_dtype = np.dtype(self.quantize)
+        arr = np.frombuffer(data, dtype=encoded_dtype).reshape(shape)
+        if self.quantize == "uint8":
+            decoded = arr.astype(self.dtype)
+            decoded *= scale
+            decoded += offset
+            arr = decoded
+        elif self.quantize == "float16":
+            arr = arr.astype(self.dtype)
+        arr.setflags(write=False)
+        self._cached = (chunk, arr)
+        return arr
+
+    def _write_chunk(self, chunk, data):
+        """ Encode and write a chunk.
+        """
+        data = np.asarray(data)
+        scale, offset = (1., 0.)
+        if self.quantize == "uint8" and data.size > 0:
+            offset = float(data.min())
+            scale = (float(data.max()) - offset) / 255. or 1.
+            data = np.rint((data - offset) / scale).clip(0, 255)
+        if self.quantize is not None:
+            data = data.astype(self.quantize)
+        else:
+            data = data.astype(self.dtype, copy=False)
+        data = np.ascontiguousarray(data)
+        content = _HEADER.pack(scale, offset) + CODECS[self.codec][2](
+            data.tobytes(), self.level, data.dtype.itemsize)
+        _atomic_write(os.path.join(self.path, CHUNK_FILE.format(chunk)),
+                      content, self.path)
+        if self._cached[0] == chunk:
+            self._cached = (None, None)
+
+
+def _replace_folder(tmppath, path):
+    """ Rename a folder, replacing an existing folder.
+    """
+    if os.path.isdir(path):
+        trash = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)),
+                                 suffix=".old")
+        try:
+            os.replace(path, os.path.join(trash, "old"))
+        except FileNotFoundError:
+            # Concurrently replaced
+            pass
+        os.replace(tmppath, path)
+        shutil.rmtree(trash)
+    else:
+        os.replace(tmppath, path)
+
+
+def _atomic_write(path, content, tmpdir):
+    """ Write a binary file atomically.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=tmpdir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as open_file:
+        open_file.write(content)
+    os.replace(tmppath, path)
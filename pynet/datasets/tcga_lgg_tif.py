@@ -18,9 +18,8 @@ import logging
 from collections import namedtuple
 import numpy as np
 import skimage.io as skio
-import pandas as pd
 from pynet.datasets import Fetchers
-import progressbar
+from pynet.datasets.fetcher import fetch_parallel
 import csv
 import glob
 
@@ -62,7 +61,7 @@ def get_subjects_files(datadir):
 
 
 @Fetchers.register
-def fetch_tcga_lgg_tif(datasetdir):
+def fetch_tcga_lgg_tif(datasetdir, n_jobs=1, store=None):
     """ Fetch/prepare the TCA-LGG-tif dataset for pynet.
 
     The patient average age was 47 with an almost even split between women and
@@ -76,6 +75,13 @@ def fetch_tcga_lgg_tif(datasetdir):
     ----------
     datasetdir: str
         the dataset destination folder.
+    n_jobs: int, default 1
+        the number of subjects processed in parallel. An interrupted fetch
+        resumes where it stopped.
+    store: dict, default None
+        if set, write the arrays in chunked compressed stores created with
+        these parameters (see 'pynet.datasets.store.create_array') instead
+        of '.npy' files.
 
     Returns
     -------
@@ -92,53 +98,54 @@ def fetch_tcga_lgg_tif(datasetdir):
 
     metadata_path = os.path.join(datasetdir, "kaggle_3m", "data.csv")
     desc_path = os.path.join(datasetdir, "pynet_tgca-lgg-tif.tsv")
-    input_path = os.path.join(datasetdir, "pynet_tgca-lgg-tif_inputs.npy")
-    output_path = os.path.join(datasetdir, "pynet_tgca-lgg-tif_outputs.npy")
+    extension = ".npy" if store is None else ".chunks"
+    input_path = os.path.join(
+        datasetdir, "pynet_tgca-lgg-tif_inputs" + extension)
+    output_path = os.path.join(
+        datasetdir, "pynet_tgca-lgg-tif_outputs" + extension)
 
     if not os.path.isfile(desc_path):
         # parse datasetdir
         sdata = get_subjects_files(datasetdir)
         # parse genetics csv file
         smetadata = read_metadata(metadata_path)
-        input_dataset = []
-        output_dataset = []
-        metadata = OrderedDict((key, []) for key in (
-            "participant_id", "slice_id", "center", "serie"))
-        with progressbar.ProgressBar(max_value=len(sdata),
-                                     redirect_stdout=True) as bar:
-            for cnt, (subject, subject_data) in enumerate(sdata.items()):
-                logger.debug("Processing {0}...".format(subject))
-
-                for impath in subject_data["images"]:
-                    # (height, width, (precontrast, flair, postcontrast))
-                    # -> ((precontrast, flair, postcontrast), height, width)
-                    im = skio.imread(impath).transpose(2, 0, 1)
-                    input_dataset.append(im)
-
-                    # Get subject genetics metadata
-                    metadata["participant_id"].append(subject)
-                    metadata["slice_id"].append(
-                        get_slice_id(impath))
-                    metadata["center"].append(subject_data["center"])
-                    metadata["serie"].append(subject_data["serie"])
-                    for meta_name, meta_value in smetadata[subject].items():
-                        metadata.setdefault(meta_name, []).append(meta_value)
-
-                for impath in subject_data["masks"]:
-                    im = skio.imread(impath)[np.newaxis, ...]
-                    im[im == 255] = 1
-                    assert set(im.ravel().tolist()).issubset({
-                        0, 1})
-                    output_dataset.append(im)
-
-                bar.update(cnt)
-
-            input_dataset = np.asarray(input_dataset)
-            np.save(input_path, input_dataset)
-            output_dataset = np.asarray(output_dataset)
-            np.save(output_path, output_dataset)
-
-            df = pd.DataFrame.from_dict(metadata)
-            df.to_csv(desc_path, sep="\t", index=False)
+        tasks = [(subject, subject_data, smetadata[subject])
+                 for subject, subject_data in sdata.items()]
+        fetch_parallel(
+            tasks, _process_subject,
+            {"inputs": input_path, "outputs": output_path}, desc_path,
+            n_rows=[len(task[1]["images"]) for task in tasks],
+            n_jobs=n_jobs, store=store)
     return Item(input_path=input_path, output_path=output_path,
                 metadata_path=desc_path, height=height, width=width)
+
+
+def _process_subject(task):
+    """ Load the slices and masks of a subject.
+    """
+    subject, subject_data, subject_metadata = task
+    logger.debug("Processing {0}...".format(subject))
+    inputs, outputs, metadata = [], [], []
+    for impath in subject_data["images"]:
+        # (height, width, (precontrast, flair, postcontrast))
+        # -> ((precontrast, flair, postcontrast), height, width)
+        im = skio.imread(impath).transpose(2, 0, 1)
+        inputs.append(im)
+
+        # Get subject genetics metadata
+        row = OrderedDict((
+            ("participant_id", subject),
+            ("slice_id", get_slice_id(impath)),
+            ("center", subject_data["center"]),
+            ("serie", subject_data["serie"])))
+        row.update(subject_metadata)
+        metadata.append(row)
+
+    for impath in subject_data["masks"]:
+        im = skio.imread(impath)[np.newaxis, ...]
+        im[im == 255] = 1
+        assert set(im.ravel().tolist()).issubset({
+            0, 1})
+        outputs.append(im)
+    arrays = {"inputs": np.asarray(inputs), "outputs": np.asarray(outputs)}
+    return arrays, metadata
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides helpers for distributed data-parallel training.
+"""
+
+
+# System import
+import socket
+import logging
+
+# Third party import
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+def launch(function, world_size, args=(), backend="gloo",
+           master_addr="127.0.0.1", master_port=None):
+    """ Run a function in several local processes that belong to the same
+    distributed process group.
+
+    Parameters
+    ----------
+    function: callable
+        a picklable function with signature function(rank, world_size,
+        *args), usually defined at the module level.
+    world_size: int
+        the number of processes.
+    args: tuple, default ()
+        the function extra parameters.
+    backend: str, default 'gloo'
+        the distributed backend: 'gloo' works on CPU.
+    master_addr: str, default '127.0.0.1'
+        the address of the rank 0 process.
+    master_port: int, default None
+        the port of the rank 0 process, default a free port.
+    """
+    if master_port is None:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((master_addr, 0))
+            master_port = sock.getsockname()[1]
+    init_method = "tcp://{0}:{1}".format(master_addr, master_port)
+    logger.info("Launching {0} processes on '{1}'.".format(
+        world_size, init_method))
+    mp.spawn(
+        _worker, args=(function, world_size, backend, init_method, args),
+        nprocs=world_size, join=True)
+
+
+def _worker(rank, function, world_size, backend, init_method, args):
+    """ Initialize the process group and run the function.
+    """
+    dist.init_process_group(
+        backend=backend, init_method=init_method, rank=rank,
+        world_size=world_size)
+    try:
+        function(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    """ Check if a distributed process group is initialized.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """ Return the rank of the current process, 0 if not distributed.
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """ Return the number of processes, 1 if not distributed.
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """ Check if the current process is the rank 0 process.
+    """
+    return get_rank() == 0
@@ -121,6 +121,39 @@ class History(object):
         with open(outfile, "wb") as open_file:
             pickle.dump(self, open_file)
 
+    @classmethod
+    def merge(cls, histories, name=None):
+        """ Merge several histories, for instance the histories of folds
+        trained in parallel.
+
+        Parameters
+        ----------
+        histories: list of History
+            the histories to be merged: None items are skipped.
+        name: str, default None
+            the merged history name, default the first history name.
+
+        Returns
+        -------
+        history: History
+            the merged history sorted by steps, or None if no history is
+            specified.
+        """
+        histories = [item for item in histories if item is not None]
+        if len(histories) == 0:
+            return None
+        merged = cls(name=name or histories[0].name,
+                     verbose=histories[0].verbose)
+        steps = []
+        for history in histories:
+            merged.metrics |= history.metrics
+            steps.extend(
+                (step, history.history[step]) for step in history.steps)
+        for step, values in sorted(steps, key=lambda item: item[0]):
+            merged.history[step] = values
+        merged.step = merged.steps[-1] if len(merged.steps) > 0 else None
+        return merged
+
     @classmethod
     def load(cls, file_name):
         with open(file_name, "rb") as open_file:
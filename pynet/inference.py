@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides a sliding window (tiled) inference engine for large
+images.
+"""
+
+
+# System import
+import itertools
+import logging
+
+# Third party import
+import numpy as np
+import torch
+import torch.nn.functional as func
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+class SlidingWindow(object):
+    """ Evaluate a model on overlapping patches and stitch the patch
+    predictions back together using blending weights.
+
+    Only the model outputs that have the same spatial shape as the patches
+    are stitched: the other outputs (for instance a latent distribution) are
+    averaged over the patches of each image.
+    """
+    def __init__(self, patch_size, overlap=0.5, blending="gaussian",
+                 batch_size=1, sigma_scale=0.125, output_device=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        patch_size: tuple
+            the size of the patches, usually the size of the images used
+            during the training. For networks with a fixed input size, like
+            the VoxelMorphNet, this must be the network input size.
+        overlap: float, default 0.5
+            the overlap between two consecutive patches as a fraction of the
+            patch size in [0, 1[.
+        blending: str, default 'gaussian'
+            the patch weighting scheme used to merge overlapping predictions:
+            'gaussian' (importance decreasing from the patch center),
+            'linear' (pyramidal importance) or 'constant' (simple average).
+        batch_size: int, default 1
+            the number of patches evaluated at once.
+        sigma_scale: float, default 0.125
+            the standard deviation of the gaussian blending as a fraction of
+            the patch size.
+        output_device: str or torch.device, default None
+            the device where the full size predictions are accumulated,
+            default the input device. Use 'cpu' to bound the accelerator
+            memory to the patch batch.
+        """
+        if overlap < 0 or overlap >= 1:
+            raise ValueError("The overlap must be in [0, 1[.")
+        if blending not in ("gaussian", "linear", "constant"):
+            raise ValueError("Unsupported blending '{0}'.".format(blending))
+        self.patch_size = tuple(int(size) for size in patch_size)
+        self.overlap = overlap
+        self.blending = blending
+        self.batch_size = batch_size
+        self.sigma_scale = sigma_scale
+        self.output_device = output_device
+        self._weights = None
+
+    def __call__(self, model, inputs, *args):
+        """ Evaluate the model on a mini-batch of images.
+
+        Parameters
+        ----------
+        model: nn.Module
+            the network to be evaluated.
+        inputs: Tensor (N, C, *)
+            the input images.
+        args: list of Tensor
+            extra forward parameters with one entry per image.
+
+        Returns
+        -------
+        output_items: Tensor, list or tuple
+            the stitched model outputs, with the same structure as the
+            model outputs.
+        """
+        shape = tuple(inputs.shape[2:])
+        if len(shape) != len(self.patch_size):
+            raise ValueError("The patch size {0} does not match the image "
+                             "shape {1}.".format(self.patch_size, shape))
+        inputs, shape, crop = self._pad(inputs)
+        output_device = self.output_device or inputs.device
+        weights = self.get_weights(output_device)
+        windows = [
+            (idx, slc) for idx in range(len(inputs))
+            for slc in self.get_windows(shape)]
+        logger.debug("Sliding window: {0} patches.".format(len(windows)))
+        sums, spatial, spec = (None, None, None)
+        for start in range(0, len(windows), self.batch_size):
+            chunk = windows[start: start + self.batch_size]
+            patches = torch.stack([
+                inputs[(idx, slice(None)) + slc] for idx, slc in chunk])
+            patch_args = [
+                torch.stack([arg[idx] for idx, _ in chunk]) for arg in args]
+            leaves, _spec = _flatten(model(patches, *patch_args))
+            if sums is None:
+                spec = _spec
+                spatial = [
+                    isinstance(leaf, torch.Tensor) and
+                    tuple(leaf.shape[2:]) == self.patch_size
+                    for leaf in leaves]
+                sums = [self._allocate(leaf, is_spatial, len(inputs), shape,
+                                       output_device)
+                        for leaf, is_spatial in zip(leaves, spatial)]
+                norms = torch.zeros(
+                    (len(inputs), 1) + shape, device=output_device)
+                counts = torch.zeros(len(inputs), device=output_device)
+            for cnt, (idx, slc) in enumerate(chunk):
+                slc = (idx, slice(None)) + slc
+                norms[slc] += weights
+                counts[idx] += 1
+                for leaf, acc, is_spatial in zip(leaves, sums, spatial):
+                    if acc is None:
+                        continue
+                    value = leaf[cnt].float().to(output_device)
+                    if is_spatial:
+                        acc[slc] += value * weights
+                    else:
+                        acc[idx] += value
+        outputs = []
+        for acc, is_spatial in zip(sums, spatial):
+            if acc is None:
+                outputs.append(None)
+            elif is_spatial:
+                outputs.append((acc / norms)[crop])
+            else:
+                outputs.append(
+                    acc / counts.view((-1, ) + (1, ) * (acc.ndim - 1)))
+        return _unflatten(outputs, spec)
+
+    def get_windows(self, shape):
+        """ Compute the patch locations covering an image.
+
+        Parameters
+        ----------
+        shape: tuple
+            the image spatial shape, at least as large as the patch size.
+
+        Returns
+        -------
+        windows: list of tuple of slice
+            the patch locations.
+        """
+        starts = []
+        for size, patch_size in zip(shape, self.patch_size):
+            step = max(1, int(round(patch_size * (1 - self.overlap))))
+            axis_starts = list(range(0, size - patch_size + 1, step))
+            if axis_starts[-1] != size - patch_size:
+                axis_starts.append(size - patch_size)
+            starts.append(axis_starts)
+        return [
+            tuple(slice(start, start + patch_size)
+                  for start, patch_size in zip(location, self.patch_size))
+            for location in itertools.product(*starts)]
+
+    def get_weights(self, device=None):
+        """ Compute the patch blending weights.
+
+        Parameters
+        ----------
+        device: torch.device, default None
+            the device where the weights are created.
+
+        Returns
+        -------
+        weights: Tensor (1, *patch_size)
+            the strictly positive blending weights.
+        """
+        if self._weights is None:
+            axis_weights = []
+            for size in self.patch_size:
+                center = (size - 1) / 2.
+                coords = np.arange(size)
+                if self.blending == "gaussian":
+                    sigma = max(size * self.sigma_scale, 1e-6)
+                    weights = np.exp(-0.5 * ((coords - center) / sigma) ** 2)
+                elif self.blending == "linear":
+                    weights = np.minimum(coords + 1, size - coords)
+                else:
+                    weights = np.ones(size)
+                axis_weights.append(weights / weights.max())
+            weights = axis_weights[0]
+            for item in axis_weights[1:]:
+                weights = np.multiply.outer(weights, item)
+            weights = np.maximum(weights, 1e-3)
+            self._weights = torch.from_numpy(
+                weights[np.newaxis].astype(np.float32))
+        return self._weights.to(device)
+
+    def _pad(self, inputs):
+        """ Pad the images smaller than the patch size.
+        """
+        shape = tuple(inputs.shape[2:])
+        padding = [max(0, patch_size - size)
+                   for size, patch_size in zip(shape, self.patch_size)]
+        crop = (slice(None), slice(None)) + tuple(
+            slice(0, size) for size in shape)
+        if sum(padding) > 0:
+            pad = []
+            for item in padding[::-1]:
+                pad.extend([0, item])
+            inputs = func.pad(inputs, pad)
+            shape = tuple(inputs.shape[2:])
+        return inputs, shape, crop
+
+    def _allocate(self, leaf, is_spatial, nb_images, shape, device):
+        """ Allocate the accumulator associated to one model output.
+        """
+        if not isinstance(leaf, torch.Tensor):
+            return None
+        if is_spatial:
+            return torch.zeros((nb_images, leaf.shape[1]) + shape,
+                               device=device)
+        return torch.zeros((nb_images, ) + tuple(leaf.shape[1:]),
+                           device=device)
+
+
+def _flatten(obj):
+    """ Flatten nested lists, tuples, and dicts of tensors.
+
+    Returns
+    -------
+    leaves: list
+        the flattened objects.
+    spec: object
+        the nested structure description.
+    """
+    if isinstance(obj, (list, tuple)):
+        leaves, specs = [], []
+        for item in obj:
+            item_leaves, item_spec = _flatten(item)
+            leaves.extend(item_leaves)
+            specs.append((len(item_leaves), item_spec))
+        return leaves, (type(obj), None, specs)
+    if isinstance(obj, dict):
+        leaves, specs = [], []
+        for item in obj.values():
+            item_leaves, item_spec = _flatten(item)
+            leaves.extend(item_leaves)
+            specs.append((len(item_leaves), item_spec))
+        return leaves, (type(obj), list(obj.keys()), specs)
+    return [obj], None
+
+
+def _unflatten(leaves, spec):
+    """ Rebuild a nested structure from flattened objects.
+    """
+    if spec is None:
+        return leaves[0]
+    klass, keys, specs = spec
+    items, start = [], 0
+    for nb_leaves, item_spec in specs:
+        items.append(_unflatten(leaves[start: start + nb_leaves], item_spec))
+        start += nb_leaves
+    if keys is not None:
+        return klass(zip(keys, items))
+    return klass(items)
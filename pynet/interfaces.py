@@ -113,7 +113,8 @@ class DeepLearningInterface(Base, metaclass=DeepLearningMetaRegister):
 
     def __init__(self, net_params=None, pretrained=None, resume=False,
                  add_labels=False, optimizer_name="Adam", learning_rate=1e-3,
-                 loss_name="NLLLoss", metrics=None, use_cuda=False, **kwargs):
+                 loss_name="NLLLoss", metrics=None, use_cuda=False,
+                 precision="fp32", distributed=False, **kwargs):
         """ Class initilization.
 
         Parameters
@@ -141,6 +142,12 @@ class DeepLearningInterface(Base, metaclass=DeepLearningMetaRegister):
             a list of extra metrics that will be computed.
         use_cuda: bool, default False
             wether to use GPU or CPU.
+        precision: str, default 'fp32'
+            the floating point precision used during the forward pass:
+            'fp32', 'bf16' or 'fp16' (GPU only).
+        distributed: bool, default False
+            if set, train the network with distributed data parallelism in
+            an initialized process group (see 'pynet.distributed').
         kwargs: dict
             specify directly a custom 'optimizer' or 'loss'. Can also be used
             to set specific optimizer parameters.
@@ -162,6 +169,8 @@ class DeepLearningInterface(Base, metaclass=DeepLearningMetaRegister):
             pretrained=pretrained,
             resume=resume,
             add_labels=add_labels,
+            precision=precision,
+            distributed=distributed,
             **kwargs)
 
 
@@ -13,8 +13,10 @@ Define common metrics.
 
 # Third party import
 import logging
+from collections import OrderedDict
 import torch
 import numpy as np
+import torch.distributed as dist
 import torch.nn.functional as func
 import sklearn.metrics as sk_metrics
 from pynet.utils import Metrics
@@ -31,6 +33,18 @@ def accuracy(y_pred, y):
     return accuracy
 
 
+def _accuracy_statistics(y_pred, y):
+    """ The number of correct predictions and of samples.
+    """
+    y_pred = y_pred.data.max(dim=1)[1]
+    correct = y_pred.eq(y).sum().double()
+    return torch.stack((correct, torch.ones_like(correct) * y.size()[0]))
+
+
+accuracy.statistics = _accuracy_statistics
+accuracy.reduce = lambda statistics: statistics[0] / statistics[1]
+
+
 def _dice(y_pred, y):
     """ Binary dice indice adapted to pytorch tensors.
     """
@@ -54,6 +68,30 @@ def multiclass_dice(y_pred, y):
     return dice / n_classes
 
 
+def _multiclass_dice_statistics(y_pred, y):
+    """ The intersection, prediction and target sums of each class.
+    """
+    if isinstance(y_pred, tuple):
+        y_pred = y_pred[0]
+    y_pred = func.softmax(y_pred, dim=1)
+    dims = [0] + list(range(2, y_pred.dim()))
+    return torch.cat((
+        (y_pred * y).sum(dim=dims), y_pred.sum(dim=dims),
+        y.sum(dim=dims))).double()
+
+
+def _multiclass_dice_reduce(statistics):
+    """ The dice of the summed statistics.
+    """
+    intersection, pred_sum, target_sum = statistics.reshape(3, -1)
+    dice = (2. * intersection + 1.) / (pred_sum + target_sum + 1.)
+    return dice.mean()
+
+
+multiclass_dice.statistics = _multiclass_dice_statistics
+multiclass_dice.reduce = _multiclass_dice_reduce
+
+
 @Metrics.register
 def pearson_correlation(y_pred, y):
     """ Pearson correlation.
@@ -68,6 +106,30 @@ def pearson_correlation(y_pred, y):
     return r_val
 
 
+def _pearson_correlation_statistics(y_pred, y):
+    """ The number of samples, and the sums of the values, squares and
+    products.
+    """
+    y_pred, y = y_pred.double(), y.double()
+    return torch.stack((
+        torch.ones_like(y.sum()) * y.numel(), y_pred.sum(), y.sum(),
+        (y_pred * y_pred).sum(), (y * y).sum(), (y_pred * y).sum()))
+
+
+def _pearson_correlation_reduce(statistics):
+    """ The correlation of the summed statistics.
+    """
+    n, sum_ypred, sum_y, sum_ypred2, sum_y2, sum_prod = statistics
+    r_num = sum_prod - sum_ypred * sum_y / n
+    r_den = torch.sqrt((sum_ypred2 - sum_ypred ** 2 / n) *
+                       (sum_y2 - sum_y ** 2 / n))
+    return r_num / r_den
+
+
+pearson_correlation.statistics = _pearson_correlation_statistics
+pearson_correlation.reduce = _pearson_correlation_reduce
+
+
 class BinaryClassificationMetrics(object):
     """ Computes and stores the average and current value.
     """
@@ -88,11 +150,27 @@ class BinaryClassificationMetrics(object):
         logger.debug("  class prediction: {0}".format(
             pred.detach().numpy().tolist()))
         logger.debug("  truth: {0}".format(truth.detach().numpy().tolist()))
-        metrics = {}
         tp = pred.mul(truth).sum(0).float()
         tn = (1 - pred).mul(1 - truth).sum(0).float()
         fp = pred.mul(1 - truth).sum(0).float()
         fn = (1 - pred).mul(truth).sum(0).float()
+        return self.reduce(torch.stack((tp, tn, fp, fn)))
+
+    def statistics(self, y_pred, y):
+        """ The confusion counts of a mini-batch.
+        """
+        if self.with_logit:
+            y_pred = torch.sigmoid(y_pred)
+        pred = (y_pred.reshape(-1) >= self.thr).double()
+        truth = (y.reshape(-1) >= self.thr).double()
+        return torch.stack((
+            pred.mul(truth).sum(), (1 - pred).mul(1 - truth).sum(),
+            pred.mul(1 - truth).sum(), (1 - pred).mul(truth).sum()))
+
+    def reduce(self, statistics):
+        """ The score of the confusion counts.
+        """
+        tp, tn, fp, fn = statistics
         acc = (tp + tn).sum() / (tp + tn + fp + fn).sum()
         pre = tp / (tp + fp)
         rec = tp / (tp + fn)
@@ -111,19 +189,29 @@ class BinaryClassificationMetrics(object):
 
 class SKMetrics(object):
     """ Wraping arounf scikit-learn metrics.
+
+    The scores derived from the confusion matrix are accumulated over an
+    epoch with the counts of true/false positives/negatives, the other
+    scores with the concatenated predictions and targets moved to the CPU.
     """
+    confusion_names = (
+        "false_discovery_rate", "false_negative_rate", "false_positive_rate",
+        "negative_predictive_value", "positive_predictive_value",
+        "true_negative_rate", "true_positive_rate", "accuracy")
+
     def __init__(self, name, thr=0.5, with_logit=True, **kwargs):
         self.name = name
         self.thr = thr
         self.kwargs = kwargs
         self.with_logit = with_logit
-        if name in ("false_discovery_rate", "false_negative_rate",
-                    "false_positive_rate", "negative_predictive_value",
-                    "positive_predictive_value", "true_negative_rate",
-                    "true_positive_rate", "accuracy"):
+        if name in self.confusion_names:
             self.metric = getattr(sk_metrics, "confusion_matrix")
         else:
             self.metric = getattr(sk_metrics, name)
+        # The confusion matrix options (labels, sample weights...) are
+        # only supported by scikit-learn
+        self.concatenate = (name not in self.confusion_names or
+                            len(kwargs) > 0)
 
     def __call__(self, y_pred, y):
         if self.with_logit:
@@ -138,28 +226,52 @@ class SKMetrics(object):
                              "log_loss", "brier_score_loss"):
             y_pred = (y_pred > self.thr).astype(int)
         metric = self.metric(y, y_pred, **self.kwargs)
-        if self.name in ("false_discovery_rate", "false_negative_rate",
-                         "false_positive_rate", "negative_predictive_value",
-                         "positive_predictive_value", "true_negative_rate",
-                         "true_positive_rate", "accuracy"):
-            tn, fp, fn, tp = metric.ravel()
+        if self.name in self.confusion_names:
+            metric = self._confusion_score(*metric.ravel())
+        return metric
+
+    def _confusion_score(self, tn, fp, fn, tp):
+        """ The score derived from the confusion matrix.
+        """
         if self.name == "false_discovery_rate":
-            metric = fp / (tp + fp)
+            return fp / (tp + fp)
         elif self.name == "false_negative_rate":
-            metric = fn / (tp + fn)
+            return fn / (tp + fn)
         elif self.name == "false_positive_rate":
-            metric = fp / (fp + tn)
+            return fp / (fp + tn)
         elif self.name == "negative_predictive_value":
-            metric = tn / (tn + fn)
+            return tn / (tn + fn)
         elif self.name == "positive_predictive_value":
-            metric = tp / (tp + fp)
+            return tp / (tp + fp)
         elif self.name == "true_negative_rate":
-            metric = tn / (tn + fp)
+            return tn / (tn + fp)
         elif self.name == "true_positive_rate":
-            metric = tp / (tp + fn)
-        elif self.name == "accuracy":
-            metric = (tp + tn) / (tp + fp + fn + tn)
-        return metric
+            return tp / (tp + fn)
+        return (tp + tn) / (tp + fp + fn + tn)
+
+    def statistics(self, y_pred, y):
+        """ The confusion matrix counts (tn, fp, fn, tp), or the predictions
+        and targets moved to the CPU for the scores that are not
+        decomposable.
+        """
+        if self.concatenate:
+            return (y_pred.detach().cpu(), y.detach().cpu())
+        y_pred = y_pred.detach()
+        if self.with_logit:
+            y_pred = torch.sigmoid(y_pred)
+        y_pred = (y_pred.reshape(-1) > self.thr)
+        y = (y.detach().reshape(-1) != 0)
+        return torch.stack((
+            (~y_pred & ~y).sum(), (y_pred & ~y).sum(), (~y_pred & y).sum(),
+            (y_pred & y).sum())).double()
+
+    def reduce(self, statistics):
+        """ The score of the summed counts, or of the concatenated
+        predictions and targets.
+        """
+        if self.concatenate:
+            return self(*statistics)
+        return self._confusion_score(*statistics)
 
 
 for name in ("accuracy", "true_positive", "true_negative", "false_positive",
@@ -178,3 +290,145 @@ for name in ("accuracy", "average_precision_score", "cohen_kappa_score",
 
 Metrics.register(SKMetrics("fbeta_score", beta=1), name="f1_score")
 Metrics.register(SKMetrics("fbeta_score", beta=2), name="f2_score")
+
+
+class MetricsAccumulator(object):
+    """ Accumulate the loss and metrics of the mini-batches of an epoch.
+
+    The running values are kept as tensors on the device, so that updating
+    the accumulator does not force a device to host synchronization: the
+    epoch values are only transfered when they are explicitly computed.
+    The loss is averaged with the mini-batch sizes. A metric that exposes
+    'statistics' and 'reduce' methods is computed on the whole epoch from
+    the sum of its mini-batch statistics (or their concatenation when the
+    metric 'concatenate' attribute is set): the non-decomposable metrics,
+    as the dice or the scikit-learn scores, are then exact. The other
+    metrics are averaged with the mini-batch sizes.
+    """
+    def __init__(self, device=None, distributed=False):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        device: str or torch.device, default None
+            the device where the running values are stored (default 'cpu').
+        distributed: bool, default False
+            if set, the running values are reduced over the processes of
+            the distributed group when the epoch values are computed.
+        """
+        self.device = torch.device(device or "cpu")
+        self.distributed = distributed
+        self.reset()
+
+    def reset(self):
+        """ Reset the running values.
+        """
+        self.names = []
+        self.sums = OrderedDict()
+        self.weights = OrderedDict()
+        self.metrics = OrderedDict()
+        self.statistics = OrderedDict()
+        self.collected = OrderedDict()
+
+    def update(self, values, weight=1):
+        """ Accumulate new values.
+
+        Parameters
+        ----------
+        values: dict
+            the values to be averaged: scalar tensors or numbers.
+        weight: float, default 1
+            the weight of the values, usually the number of samples in the
+            mini-batch.
+        """
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().to(self.device, torch.float64)
+            else:
+                value = torch.tensor(
+                    float(value), dtype=torch.float64, device=self.device)
+            if name not in self.sums:
+                self._add_name(name)
+                self.sums[name] = torch.zeros(
+                    (), dtype=torch.float64, device=self.device)
+                self.weights[name] = 0
+            self.sums[name] += value.reshape(()) * weight
+            self.weights[name] += weight
+
+    def update_metric(self, name, metric, y_pred, *targets, weight=1):
+        """ Accumulate a metric of a mini-batch.
+
+        Parameters
+        ----------
+        name: str
+            the metric name.
+        metric: callable
+            the metric.
+        y_pred: Tensor
+            the predictions.
+        targets: Tensor
+            the targets.
+        weight: float, default 1
+            the weight of the metric value if it is averaged, usually the
+            number of samples in the mini-batch.
+        """
+        if not hasattr(metric, "statistics"):
+            self.update({name: metric(y_pred, *targets)}, weight=weight)
+            return
+        self._add_name(name)
+        self.metrics[name] = metric
+        statistics = metric.statistics(y_pred, *targets)
+        if getattr(metric, "concatenate", False):
+            self.collected.setdefault(name, []).append(statistics)
+            return
+        statistics = statistics.detach().to(
+            self.device, torch.float64).reshape(-1)
+        if name in self.statistics:
+            self.statistics[name] += statistics
+        else:
+            self.statistics[name] = statistics.clone()
+
+    def compute(self):
+        """ Compute the epoch values with a single synchronization.
+
+        Returns
+        -------
+        values: dict
+            the epoch values.
+        """
+        if len(self.names) == 0:
+            return OrderedDict()
+        sums = list(self.sums.values())
+        weights = [torch.tensor(float(weight), dtype=torch.float64,
+                                device=self.device)
+                   for weight in self.weights.values()]
+        statistics = list(self.statistics.values())
+        state = torch.zeros(0, dtype=torch.float64, device=self.device)
+        if len(sums) > 0:
+            state = torch.stack(sums + weights)
+        state = torch.cat([state] + statistics)
+        if self.distributed and len(state) > 0:
+            dist.all_reduce(state, op=dist.ReduceOp.SUM)
+        values = {}
+        for idx, name in enumerate(self.sums):
+            values[name] = state[idx] / state[len(sums) + idx]
+        start = 2 * len(sums)
+        for name, stats in zip(self.statistics, statistics):
+            values[name] = self.metrics[name].reduce(
+                state[start: start + len(stats)])
+            start += len(stats)
+        for name, collected in self.collected.items():
+            collected = [torch.cat(tensors) for tensors in zip(*collected)]
+            if self.distributed:
+                gathered = [None] * dist.get_world_size()
+                dist.all_gather_object(
+                    gathered, [tensor.cpu() for tensor in collected])
+                collected = [torch.cat(tensors) for tensors in zip(*gathered)]
+            values[name] = self.metrics[name].reduce(collected)
+        return OrderedDict((name, float(values[name])) for name in self.names)
+
+    def _add_name(self, name):
+        """ Register a value name, in order of appearance.
+        """
+        if name not in self.names:
+            self.names.append(name)
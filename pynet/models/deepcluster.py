@@ -62,7 +62,9 @@ class DeepCluster(nn.Module):
         self.device = torch.device("cuda" if use_cuda else "cpu")
 
         self._write("DeepCluster: " + datetime.datetime.now().isoformat())
-        if len(self.data_loader.dataset.input_transforms) != 0:
+        dataset = self.data_loader.dataset
+        if (len(dataset.input_transforms) != 0 or
+                len(dataset.data_augmentation_transforms) != 0):
             raise ValueError(
                 "Data transformation/augmentation no yet supported.")
 
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+"""
+Module that provides on-disk sinks to write large arrays one mini-batch
+at a time.
+"""
+
+
+# System import
+import os
+import logging
+
+# Third party import
+import h5py
+import numpy as np
+
+
+# Global parameters
+logger = logging.getLogger("pynet")
+
+
+def get_sink(path, **kwargs):
+    """ Create a sink from a file path.
+
+    Parameters
+    ----------
+    path: str
+        the destination file: a '.npy' file generates a memory-mapped numpy
+        sink, a '.h5' or '.hdf5' file a chunked HDF5 sink.
+    kwargs: dict
+        the sink specific parameters.
+
+    Returns
+    -------
+    sink: ArraySink
+        the requested sink.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == ".npy":
+        return NumpySink(path, **kwargs)
+    elif ext in (".h5", ".hdf5"):
+        return HDF5Sink(path, **kwargs)
+    raise ValueError("Unsupported sink extension '{0}': use '.npy', '.h5' "
+                     "or '.hdf5'.".format(ext))
+
+
+class ArraySink(object):
+    """ Base class of sinks: an array with a known final shape is
+    preallocated on disk and filled one mini-batch at a time.
+    """
+    def __init__(self, path):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        path: str
+            the destination file.
+        """
+        self.path = path
+        self.data = None
+
+    def allocate(self, shape, dtype):
+        """ Preallocate the destination array.
+
+        Parameters
+        ----------
+        shape: tuple
+            the final array shape.
+        dtype: numpy dtype
+            the array data type.
+        """
+        raise NotImplementedError
+
+    def write(self, arr, offset):
+        """ Write a mini-batch.
+
+        Parameters
+        ----------
+        arr: array
+            the mini-batch data.
+        offset: int
+            the index of the first sample of the mini-batch along the first
+            axis of the destination array.
+        """
+        if self.data is None:
+            raise ValueError("The sink must be allocated first.")
+        if offset + len(arr) > len(self.data):
+            raise ValueError("Can't write {0} samples at offset {1} in an "
+                             "array of length {2}.".format(
+                                 len(arr), offset, len(self.data)))
+        self.data[offset: offset + len(arr)] = arr
+
+    def close(self):
+        """ Flush the data on disk.
+
+        Returns
+        -------
+        data: array-like
+            a read-only view of the written data, None if the sink was
+            never allocated (no data written).
+        """
+        raise NotImplementedError
+
+
+class NumpySink(ArraySink):
+    """ Write the data in a memory-mapped '.npy' file.
+    """
+    def allocate(self, shape, dtype):
+        """ Preallocate the destination array.
+        """
+        logger.debug("Allocating {0} - {1} in '{2}'.".format(
+            shape, dtype, self.path))
+        self.data = np.lib.format.open_memmap(
+            self.path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+    def close(self):
+        """ Flush the data on disk and return a read-only memory-mapped
+        array.
+        """
+        if self.data is None:
+            return None
+        self.data.flush()
+        self.data = None
+        return np.load(self.path, mmap_mode="r")
+
+
+class HDF5Sink(ArraySink):
+    """ Write the data in a chunked HDF5 dataset: one chunk per sample.
+    """
+    def __init__(self, path, name="y", compression=None):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        path: str
+            the destination file.
+        name: str, default 'y'
+            the name of the HDF5 dataset.
+        compression: str, default None
+            the HDF5 compression filter, for instance 'gzip' or 'lzf'.
+        """
+        super(HDF5Sink, self).__init__(path)
+        self.name = name
+        self.compression = compression
+        self.open_file = None
+
+    def allocate(self, shape, dtype):
+        """ Preallocate the destination array.
+        """
+        logger.debug("Allocating {0} - {1} in '{2}:{3}'.".format(
+            shape, dtype, self.path, self.name))
+        self.open_file = h5py.File(self.path, "w")
+        self.data = self.open_file.create_dataset(
+            self.name, shape=tuple(shape), dtype=dtype,
+            chunks=(1, ) + tuple(shape[1:]), compression=self.compression)
+
+    def close(self):
+        """ Flush the data on disk and return the HDF5 dataset opened in
+        read-only mode: the returned 'HDF5Array' owns the file and must be
+        closed.
+        """
+        if self.open_file is None:
+            return None
+        self.open_file.close()
+        self.open_file, self.data = (None, None)
+        return HDF5Array(self.path, self.name)
+
+
+class HDF5Array(object):
+    """ A read-only HDF5 dataset that owns its file: close it, or use it
+    as a context manager, to release the file.
+    """
+    def __init__(self, path, name):
+        """ Initialize the class.
+
+        Parameters
+        ----------
+        path: str
+            the HDF5 file.
+        name: str
+            the name of the HDF5 dataset.
+        """
+        self.open_file = h5py.File(path, "r")
+        self.data = self.open_file[name]
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __array__(self, dtype=None):
+        arr = self.data[()]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ Close the file.
+        """
+        if getattr(self, "open_file", None) is not None:
+            self.open_file.close()
+            self.open_file, self.data = (None, None)
@@ -10,6 +10,7 @@
 # System import
 import unittest
 import numpy as np
+import torch
 
 # Package import
 from pynet.augmentation import add_blur
@@ -23,6 +24,19 @@ from pynet.augmentation import flip
 from pynet.augmentation import affine
 from pynet.augmentation import deformation
 from pynet.augmentation import Transformer
+from pynet.augmentation import BatchTransformer
+from pynet.augmentation import batch_affine
+from pynet.augmentation import batch_flip
+from pynet.augmentation import batch_deformation
+from pynet.augmentation import batch_add_noise
+from pynet.augmentation import batch_add_blur
+from pynet.augmentation import batch_add_ghosting
+from pynet.augmentation import batch_add_spike
+from pynet.augmentation import batch_add_biasfield
+from pynet.augmentation import batch_add_motion
+from pynet.augmentation.transform import amplitude_spectrum
+from pynet.augmentation.transform import random_deformation_field
+from pynet.augmentation.transform import polynomial_basis
 
 
 class TestAugmentation(unittest.TestCase):
@@ -66,6 +80,154 @@ class TestAugmentation(unittest.TestCase):
         for key, (fct, kwargs) in self.transforms.items():
             y = fct(self.x, **kwargs)
 
+    def test_batch_transforms(self):
+        """ Test the batch transforms.
+        """
+        inputs = torch.rand(4, 2, 16, 12, 8)
+        outputs = torch.randint(0, 3, (4, 1, 16, 12, 8))
+        results = []
+        for _ in range(2):
+            transformer = BatchTransformer(output_label=True, seed=0)
+            transformer.register(
+                batch_affine, probability=0.5, rotation=5, translation=2,
+                zoom=0.05, order=1)
+            transformer.register(batch_flip, probability=0.5)
+            transformer.register(
+                batch_deformation, probability=1, max_displacement=2,
+                order=1)
+            results.append(transformer(inputs, outputs))
+        for y, y_ref in zip(*results):
+            self.assertTrue(torch.equal(y, y_ref))
+        y_inputs, y_outputs = results[0]
+        self.assertEqual(y_inputs.shape, inputs.shape)
+        self.assertEqual(y_outputs.dtype, outputs.dtype)
+        self.assertTrue(set(torch.unique(y_outputs).tolist()) <= {0, 1, 2})
+
+        y, = batch_affine(
+            [inputs], rotation=0, translation=0, zoom=0, order=1)
+        self.assertTrue(torch.allclose(y, inputs, atol=1e-5))
+        y, = batch_flip([inputs], axis=1)
+        self.assertTrue(torch.equal(y, inputs.flip(3)))
+        y, = batch_deformation([inputs], max_displacement=0)
+        self.assertTrue(torch.allclose(y, inputs, atol=1e-5))
+        y, = batch_affine([inputs[:, :, 0]], order=3)
+        self.assertEqual(y.shape, inputs[:, :, 0].shape)
+
+    def test_batch_intensity_transforms(self):
+        """ Test the batch intensity transforms.
+        """
+        x = np.random.rand(2, 1, 12, 10, 8)
+        inputs = torch.from_numpy(x)
+        y, = batch_add_blur([inputs], sigma=(1.5, 1.5))
+        self.assertTrue(np.allclose(
+            y[1, 0].numpy(), add_blur(x[1, 0], sigma=(1.5, 1.5)),
+            atol=1e-6))
+        y, = batch_add_ghosting(
+            [inputs], axis=2, n_ghosts=(3, 4), intensity=(0.6, 0.6))
+        self.assertTrue(np.allclose(y[1, 0].numpy(), add_ghosting(
+            x[1, 0], axis=2, n_ghosts=(3, 4), intensity=(0.6, 0.6))))
+        y, = batch_add_biasfield([inputs], coefficients=(0.2, 0.2))
+        self.assertTrue(np.allclose(
+            y[1, 0].numpy(), add_biasfield(x[1, 0], coefficients=(0.2, 0.2)),
+            atol=1e-5))
+        y, = batch_add_motion([inputs], rotation=0, translation=0)
+        self.assertTrue(torch.allclose(y, inputs, atol=1e-5))
+        for transform, kwargs in (
+                (batch_add_noise, {"snr": 5., "noise_type": "rician"}),
+                (batch_add_spike, {"n_spikes": 2}),
+                (batch_add_motion, {"n_transforms": 3})):
+            y, = transform([inputs.float()], **kwargs)
+            self.assertEqual(y.shape, inputs.shape)
+            self.assertEqual(y.dtype, torch.float32)
+        transformer = BatchTransformer(seed=0)
+        transformer.register(batch_add_biasfield, order=2, apply_to=["input"])
+        transformer.register(batch_add_motion, axis=0, apply_to=["input"])
+        y_inputs, y_outputs = transformer(inputs, inputs[:, :, 0])
+        self.assertEqual(y_inputs.shape, inputs.shape)
+        self.assertTrue(torch.equal(y_outputs, inputs[:, :, 0]))
+
+    def test_affine_fusion(self):
+        """ Test the fusion of consecutive affine transforms.
+        """
+        x = np.random.rand(24, 20, 16)
+        results = []
+        for fuse_affine in (True, False):
+            transformer = Transformer(
+                with_channel=False, fuse_affine=fuse_affine)
+            transformer.register(
+                affine, rotation=0, translation=(3, 3), zoom=0, order=1)
+            transformer.register(flip, axis=0)
+            transformer.register(
+                affine, rotation=0, translation=(-2, -2), zoom=0, order=1)
+            transformer.seed = 0
+            results.append(transformer(x))
+        # The intermediate resamplings pad the data with zeros
+        self.assertTrue(np.allclose(
+            results[0][5:, 2:-1, 2:-1], results[1][5:, 2:-1, 2:-1]))
+        self.assertTrue(np.allclose(
+            results[0][5:, :-1, :-1], x[::-1][:-5, 1:, 1:]))
+
+    def test_threaded_transforms(self):
+        """ Test the transforms applied in a thread pool.
+        """
+        x = np.random.rand(2, 16, 12, 8)
+        results = []
+        for executor in (None, 2):
+            transformer = Transformer(executor=executor)
+            transformer.register(
+                affine, rotation=5, translation=2, zoom=0.05, order=1)
+            transformer.register(add_noise, snr=5., noise_type="gaussian")
+            transformer.register(flip, probability=0.5)
+            transformer.seed = 3
+            results.append(
+                [transformer(x)] + transformer.map([x, x, x[:1]]))
+        for y, y_ref in zip(*results):
+            self.assertTrue(np.array_equal(y, y_ref))
+        self.assertFalse(np.array_equal(results[0][1], results[0][2]))
+        seeds = [5, 6]
+        self.assertTrue(np.array_equal(
+            transformer.map([x, x], seeds=seeds)[1],
+            transformer.map([x], seeds=seeds[1:])[0]))
+        self.assertRaises(ValueError, transformer.map, [x], seeds=seeds)
+
+    def test_deformation_field(self):
+        """ Test the cached deformation field generator.
+        """
+        shape = (32, 24, 16)
+        self.assertIs(amplitude_spectrum(shape), amplitude_spectrum(shape))
+        for downsampling in (1, 4):
+            flow = random_deformation_field(
+                shape, max_displacement=3, downsampling=downsampling,
+                seed=0)
+            self.assertEqual(flow.shape, (3, ) + shape)
+            self.assertEqual(flow.dtype, np.float32)
+            self.assertTrue(np.all(flow.max(axis=(1, 2, 3)) <= 3 + 1e-5))
+            self.assertTrue(np.array_equal(flow, random_deformation_field(
+                shape, max_displacement=3, downsampling=downsampling,
+                seed=0)))
+        y = deformation(np.random.rand(*shape), downsampling=2, seed=1)
+        self.assertEqual(y.shape, shape)
+
+    def test_biasfield(self):
+        """ Test the cached bias field basis.
+        """
+        shape = (9, 8, 6)
+        self.assertIs(polynomial_basis(shape, 2), polynomial_basis(shape, 2))
+        terms, factors = polynomial_basis(shape, 2)
+        self.assertEqual(terms.sum(), 10)
+        self.assertEqual([arr.shape for arr in factors],
+                         [(3, size) for size in shape])
+        coords = [np.arange(-size / 2., size / 2.) for size in shape]
+        grids = np.meshgrid(*[arr / arr.max() for arr in coords],
+                            indexing="ij")
+        field = sum(grids[0] ** x * grids[1] ** y * grids[2] ** z
+                    for x in range(3) for y in range(3) for z in range(3)
+                    if x + y + z <= 2)
+        x = np.random.rand(*shape)
+        self.assertTrue(np.allclose(
+            add_biasfield(x, coefficients=(0.1, 0.1), order=2),
+            x * np.exp(0.1 * field), rtol=1e-5))
+
 
 if __name__ == "__main__":
     from pynet.utils import setup_logging
@@ -8,14 +8,74 @@
 ##########################################################################
 
 # System import
+import os
+import tempfile
 import unittest
+import unittest.mock as mock
+import numpy as np
+import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as func
 
 # Package import
 from pynet.interfaces import DeepLearningInterface
+from pynet import metrics
+from pynet.metrics import MetricsAccumulator
+from pynet.sinks import get_sink
 from pynet.datasets import DataManager, fetch_cifar
+from pynet.datasets.patch import RandomPatchSampler
+from pynet.distributed import launch
+
+
+class Net(nn.Module):
+    """ A small classification network.
+    """
+    def __init__(self):
+        super(Net, self).__init__()
+        self.conv = nn.Conv2d(1, 4, 3)
+        self.fc = nn.Linear(4 * 6 * 6, 2)
+
+    def forward(self, x):
+        x = func.relu(self.conv(x))
+        return self.fc(x.view(len(x), -1))
+
+
+class EpochRecorder(object):
+    """ An observer that records the epochs.
+    """
+    def __init__(self):
+        self.epochs = []
+
+    def __call__(self, signal):
+        self.epochs.append((signal.signal, signal.fold, signal.epoch))
+
+
+def distributed_training(rank, world_size, outdir):
+    """ Train a model in one process of a distributed group.
+    """
+    rng = np.random.RandomState(0)
+    manager = DataManager.from_numpy(
+        train_inputs=rng.rand(20, 1, 8, 8).astype(np.float32),
+        train_labels=rng.randint(0, 2, 20),
+        validation_inputs=rng.rand(6, 1, 8, 8).astype(np.float32),
+        validation_labels=rng.randint(0, 2, 6),
+        batch_size=4)
+    torch.manual_seed(rank)
+    cl = DeepLearningInterface(
+        model=Net(),
+        optimizer_name="SGD",
+        learning_rate=0.01,
+        loss_name="CrossEntropyLoss",
+        metrics=["accuracy"],
+        distributed=True)
+    train_history, valid_history = cl.training(
+        manager=manager, nb_epochs=2,
+        checkpointdir=os.path.join(outdir, "checkpoints"))
+    np.save(os.path.join(outdir, "weights_{0}.npy".format(rank)),
+            cl.model.fc.weight.detach().numpy())
+    np.save(os.path.join(outdir, "loss_{0}.npy".format(rank)),
+            train_history["loss"][1])
 
 
 class TestCore(unittest.TestCase):
@@ -78,6 +138,271 @@ class TestCore(unittest.TestCase):
             with_validation=True)
 
 
+class TestTraining(unittest.TestCase):
+    """ Test the training options of pynet on in-memory data.
+    """
+    def setUp(self):
+        """ Setup test.
+        """
+        rng = np.random.RandomState(0)
+        self.manager = DataManager.from_numpy(
+            train_inputs=rng.rand(20, 1, 8, 8).astype(np.float32),
+            train_labels=rng.randint(0, 2, 20),
+            validation_inputs=rng.rand(6, 1, 8, 8).astype(np.float32),
+            validation_labels=rng.randint(0, 2, 6),
+            test_inputs=rng.rand(6, 1, 8, 8).astype(np.float32),
+            test_labels=rng.randint(0, 2, 6),
+            batch_size=4)
+        self.net = Net
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        pass
+
+    def get_interface(self, **kwargs):
+        """ Create a classification interface.
+        """
+        torch.manual_seed(0)
+        return DeepLearningInterface(
+            model=self.net(),
+            optimizer_name="SGD",
+            learning_rate=0.01,
+            loss_name="CrossEntropyLoss",
+            metrics=["accuracy"],
+            **kwargs)
+
+    def test_precision(self):
+        """ Test the mixed precision training.
+        """
+        with self.assertRaises(ValueError):
+            self.get_interface(precision="fp8")
+        with self.assertRaises(ValueError):
+            self.get_interface(precision="fp16")
+        cl = self.get_interface(precision="bf16")
+        train_history, valid_history = cl.training(
+            manager=self.manager, nb_epochs=2, with_validation=True)
+        self.assertEqual(len(train_history.steps), 2)
+        y, X, y_true, loss, values = cl.testing(self.manager)
+        self.assertEqual(y.dtype, np.float32)
+        self.assertEqual(y.shape, (6, 2))
+
+    def test_accumulation(self):
+        """ Test the gradient accumulation and micro-batching.
+        """
+        rng = np.random.RandomState(0)
+        inputs = rng.rand(16, 1, 8, 8).astype(np.float32)
+        labels = rng.randint(0, 2, 16)
+        weights = []
+        for batch_size, kwargs in ((8, {}),
+                                   (4, {"accumulation_steps": 2}),
+                                   (8, {"micro_batch_size": 3})):
+            manager = DataManager.from_numpy(
+                train_inputs=inputs, train_labels=labels,
+                batch_size=batch_size, sampler=None)
+            loader = manager.get_dataloader(train=True).train
+            cl = self.get_interface()
+            cl.train(loader, **kwargs)
+            weights.append(cl.model.fc.weight.detach().numpy())
+        for arr in weights[1:]:
+            self.assertTrue(np.allclose(weights[0], arr, atol=1e-6))
+
+        # A logical batch with a short last mini-batch
+        weights = []
+        for batch_size, kwargs in ((10, {}),
+                                   (4, {"accumulation_steps": 3}),
+                                   (4, {"accumulation_steps": 3,
+                                        "micro_batch_size": 3})):
+            manager = DataManager.from_numpy(
+                train_inputs=inputs[:10], train_labels=labels[:10],
+                batch_size=batch_size, sampler=None)
+            loader = manager.get_dataloader(train=True).train
+            cl = self.get_interface()
+            cl.train(loader, **kwargs)
+            weights.append(cl.model.fc.weight.detach().numpy())
+        for arr in weights[1:]:
+            self.assertTrue(np.allclose(weights[0], arr, atol=1e-6))
+
+        # The workers of a patch queue yield more mini-batches than the
+        # loader length: the last window is still applied
+        manager = DataManager.from_numpy(
+            train_inputs=inputs[:6, :, :4].repeat(4, axis=2),
+            train_labels=labels[:6], batch_size=2, seed=0,
+            patch_sampler=RandomPatchSampler((8, 8)),
+            patch_queue_kwargs={"patches_per_volume": 1})
+        manager.data_loader_kwargs["num_workers"] = 2
+        loader = manager.get_dataloader(train=True).train
+        self.assertEqual(len(loader), 3)
+        self.assertEqual(len(list(loader)), 4)
+        cl = self.get_interface()
+        with mock.patch.object(cl, "_update_weights",
+                               wraps=cl._update_weights) as mock_update:
+            cl.train(loader, accumulation_steps=3)
+        self.assertEqual([call[0][0] for call in mock_update.call_args_list],
+                         [5, 1])
+        for param in cl.model.parameters():
+            self.assertFalse(param.grad is not None and param.grad.any())
+
+    def test_accumulator(self):
+        """ Test the sample-weighted loss and metrics accumulation.
+        """
+        accumulator = MetricsAccumulator()
+        accumulator.update({"loss": torch.tensor(1.), "acc": 0.5}, weight=3)
+        accumulator.update({"loss": torch.tensor(4.), "acc": 1}, weight=1)
+        values = accumulator.compute()
+        self.assertAlmostEqual(values["loss"], 1.75)
+        self.assertAlmostEqual(values["acc"], 0.625)
+        cl = self.get_interface()
+        loader = self.manager.get_dataloader(test=True).test
+        y, loss, values = cl.test(loader)
+        inputs = torch.from_numpy(np.concatenate(
+            [dataitem.inputs.numpy() for dataitem in loader]))
+        labels = torch.from_numpy(np.concatenate(
+            [dataitem.labels.numpy() for dataitem in loader]))
+        with torch.no_grad():
+            ref_loss = float(cl.loss(cl.model(inputs), labels))
+        self.assertAlmostEqual(loss, ref_loss, places=5)
+        self.assertNotIsInstance(
+            metrics.accuracy(cl.model(inputs), labels), torch.Tensor)
+
+    def test_epoch_metrics(self):
+        """ Test the epoch values of the non-decomposable metrics.
+        """
+        torch.manual_seed(0)
+        y_pred = torch.randn(10, 3, 4, 4)
+        y = func.one_hot(torch.randint(0, 3, (10, 4, 4)), 3).permute(
+            0, 3, 1, 2).float()
+        logits = torch.randn(10)
+        targets = torch.tensor([0, 1, 1, 0, 1, 0, 0, 1, 1, 0]).float()
+        values = torch.randn(10)
+        checks = (
+            ("multiclass_dice", metrics.multiclass_dice, y_pred, y),
+            ("accuracy", metrics.accuracy, y_pred[:, :, 0, 0],
+             y[:, :, 0, 0].argmax(dim=1)),
+            ("pearson", metrics.pearson_correlation, values,
+             values + torch.randn(10)),
+            ("binary_precision", metrics.BinaryClassificationMetrics(
+                "precision"), logits, targets),
+            ("sk_roc_auc_score", metrics.SKMetrics("roc_auc_score"),
+             logits, targets),
+            ("sk_false_discovery_rate", metrics.SKMetrics(
+                "false_discovery_rate"), logits, targets),
+            ("sk_accuracy", metrics.SKMetrics("accuracy"), logits, targets))
+        accumulator = MetricsAccumulator()
+        for name, metric, pred, target in checks:
+            for start, stop in ((0, 3), (3, 10)):
+                accumulator.update_metric(
+                    name, metric, pred[start: stop], target[start: stop],
+                    weight=(stop - start))
+        accumulator.update({"loss": 1.}, weight=10)
+        values = accumulator.compute()
+        self.assertEqual(list(values), [name for name, _, _, _ in checks] +
+                         ["loss"])
+        for name, metric, pred, target in checks:
+            self.assertAlmostEqual(
+                values[name], float(metric(pred, target)), places=5)
+        self.assertEqual(
+            len(accumulator.statistics["sk_false_discovery_rate"]), 4)
+        self.assertNotIn("sk_accuracy", accumulator.collected)
+        for tensor in accumulator.collected["sk_roc_auc_score"][0]:
+            self.assertEqual(tensor.device.type, "cpu")
+
+    def test_streaming(self):
+        """ Test the streaming evaluation.
+        """
+        cl = self.get_interface()
+        loader = self.manager.get_dataloader(test=True).test
+        predictitems = list(cl.iter_test(loader, with_logit=True))
+        self.assertEqual(len(predictitems), len(loader))
+        self.assertTrue(torch.is_grad_enabled())
+        y, X, y_true, loss, values = cl.testing(self.manager, with_logit=True)
+        self.assertTrue(np.allclose(
+            y, np.concatenate([item.y for item in predictitems])))
+        self.assertTrue(np.allclose(
+            X, self.manager["test"].inputs))
+        self.assertTrue(np.allclose(
+            y_true, self.manager["test"].labels))
+        self.assertIn("accuracy", values)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ("y.npy", "y.h5"):
+                y_sink, X_sink, y_true_sink, loss_sink, _ = cl.testing(
+                    self.manager, with_logit=True,
+                    sink=os.path.join(tmpdir, name))
+                self.assertTrue(np.allclose(y, y_sink[:]))
+                self.assertAlmostEqual(loss, loss_sink, places=5)
+                # The inputs and targets are not accumulated
+                self.assertIsNone(X_sink)
+                self.assertIsNone(y_true_sink)
+                if name.endswith(".h5"):
+                    self.assertEqual(y_sink.shape, y.shape)
+                    self.assertTrue(np.allclose(y, np.asarray(y_sink)))
+                    open_file = y_sink.open_file
+                    with y_sink:
+                        pass
+                    self.assertFalse(open_file.id.valid)
+
+    def test_empty_sinks(self):
+        """ Test the sinks that are closed without data.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ("y.npy", "y.h5"):
+                sink = get_sink(os.path.join(tmpdir, name))
+                self.assertIsNone(sink.close())
+                self.assertFalse(os.path.isfile(os.path.join(tmpdir, name)))
+
+    def test_parallel_folds(self):
+        """ Test the folds trained in parallel.
+        """
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_path = os.path.join(tmpdir, "inputs.npy")
+            metadata_path = os.path.join(tmpdir, "metadata.tsv")
+            np.save(input_path, rng.rand(24, 1, 8, 8).astype(np.float32))
+            pd.DataFrame({"label": rng.randint(0, 2, 24)}).to_csv(
+                metadata_path, sep="\t", index=False)
+            manager = DataManager(
+                input_path=input_path, metadata_path=metadata_path,
+                labels=["label"], number_of_folds=3, batch_size=4,
+                test_size=0.25)
+            checkpointdir = os.path.join(tmpdir, "checkpoints")
+            cl = self.get_interface()
+            recorder = EpochRecorder()
+            for signal in ("before_epoch", "after_epoch"):
+                cl.add_observer(signal, recorder)
+            train_history, valid_history = cl.training(
+                manager=manager, nb_epochs=2, checkpointdir=checkpointdir,
+                n_jobs=2)
+            self.assertEqual(
+                sorted(recorder.epochs),
+                sorted((signal, fold, epoch) for fold in range(3)
+                       for epoch in range(2)
+                       for signal in ("before_epoch", "after_epoch")))
+            for history in (train_history, valid_history):
+                self.assertEqual(
+                    history.steps,
+                    [(fold, epoch) for fold in range(3) for epoch in range(2)])
+            for fold in range(3):
+                self.assertTrue(os.path.isfile(os.path.join(
+                    checkpointdir, "fold_{0}".format(fold),
+                    "model_{0}_epoch_1.pth".format(fold))))
+
+    def test_distributed(self):
+        """ Test the distributed data parallel training.
+        """
+        with self.assertRaises(ValueError):
+            self.get_interface(distributed=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            launch(distributed_training, world_size=2, args=(tmpdir, ))
+            weights = [np.load(os.path.join(
+                tmpdir, "weights_{0}.npy".format(rank))) for rank in range(2)]
+            losses = [np.load(os.path.join(
+                tmpdir, "loss_{0}.npy".format(rank))) for rank in range(2)]
+            self.assertTrue(np.allclose(weights[0], weights[1]))
+            self.assertTrue(np.allclose(losses[0], losses[1]))
+            self.assertTrue(os.path.isfile(os.path.join(
+                tmpdir, "checkpoints", "model_0_epoch_1.pth")))
+
+
 if __name__ == "__main__":
     from pynet.utils import setup_logging
     setup_logging(level="debug")
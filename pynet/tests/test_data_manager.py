@@ -11,14 +11,38 @@
 import unittest
 import copy
 import sys
+import os
+import pickle
+import tempfile
 import numpy as np
 import pandas as pd
+import torch
 import unittest.mock as mock
 from unittest.mock import patch
+from torch.utils.data import DataLoader
 
 
 # Package import
-from pynet.datasets.core import DataManager, ArrayDataset
+from pynet.datasets.core import (
+    DataManager, ArrayDataset, PrefetchLoader, BatchCollate, DataItem)
+from pynet.datasets.cache import SharedMemoryCache
+from pynet.datasets.store import convert_array
+from pynet.datasets.materialize import (
+    materialize_augmentation, MaterializedArrayDataset)
+from pynet.augmentation import Transformer, flip
+from pynet.augmentation import add_noise as add_gaussian_noise
+
+
+def scale(arr):
+    """ A deterministic transform.
+    """
+    return arr * 2
+
+
+def add_noise(arr):
+    """ A random transform.
+    """
+    return arr + np.random.rand(*arr.shape)
 
 
 class TestDataManager(unittest.TestCase):
@@ -274,6 +298,262 @@ class TestDataManager(unittest.TestCase):
                     self.assertTrue(np.allclose(
                         arr.shape[-2:], kwargs["patch_size"]))
 
+    def test_prefetch(self):
+        """ Test the prefetch loader behaviour.
+        """
+        manager = DataManager.from_numpy(
+            train_inputs=self.input_arr, train_outputs=self.output_arr,
+            batch_size=3, sampler=None)
+        loader = manager.get_dataloader(train=True).train
+        prefetch_loader = manager.get_dataloader(
+            train=True, prefetch=2).train
+        self.assertEqual(len(prefetch_loader), len(loader))
+        for _ in range(2):
+            dataitems = list(prefetch_loader)
+            self.assertEqual(len(dataitems), len(loader))
+            for dataitem, refitem in zip(dataitems, loader):
+                self.assertTrue(np.allclose(dataitem.inputs, refitem.inputs))
+                self.assertTrue(np.allclose(
+                    dataitem.outputs, refitem.outputs))
+        for dataitem in prefetch_loader:
+            break
+
+        def failing_collate_fn(list_samples):
+            raise RuntimeError("collate error")
+
+        loader.collate_fn = failing_collate_fn
+        with self.assertRaisesRegex(RuntimeError, "collate error"):
+            list(PrefetchLoader(loader))
+
+    def test_cache(self):
+        """ Test the shared-memory cache.
+        """
+        cache = SharedMemoryCache(max_bytes=3 * 1024, slot_bytes=1024)
+        arrays = [np.full((2, 8), key, dtype=np.float32) for key in range(4)]
+        for key in range(3):
+            self.assertTrue(cache.put(key, arrays[key], None))
+        self.assertFalse(cache.put(10, np.zeros(1024)))
+        cache.get(0)
+        cache.put(3, arrays[3], None)
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(1))
+        for key in (0, 2, 3):
+            _arr, _none = cache.get(key)
+            self.assertTrue(np.array_equal(_arr, arrays[key]))
+            self.assertIsNone(_none)
+        cache.close()
+
+        manager = DataManager.from_numpy(
+            train_inputs=self.input_arr, train_outputs=self.output_arr,
+            batch_size=2, sampler=None, input_transforms=[scale],
+            output_transforms=[scale],
+            data_augmentation_transforms=[add_noise],
+            cache_size=(10 * 1024 ** 2))
+        dataset = manager["train"][0]
+        for context in ("fork", "spawn"):
+            for _ in range(2):
+                loader = DataLoader(
+                    dataset, batch_size=2, num_workers=2,
+                    collate_fn=manager.collate_fn,
+                    multiprocessing_context=context)
+                for cnt, dataitem in enumerate(loader):
+                    self.assertTrue(np.allclose(
+                        dataitem.inputs, 2 * self.input_arr[2 * cnt:
+                                                            2 * cnt + 2],
+                        atol=1))
+                    self.assertFalse(np.allclose(
+                        dataitem.inputs,
+                        2 * self.input_arr[2 * cnt: 2 * cnt + 2]))
+        self.assertEqual(len(dataset.cache), 10)
+        self.assertEqual(dataset.cache.stats, {"hits": 30, "misses": 10})
+        dataset.cache.close()
+
+    def test_buffered_collate(self):
+        """ Test the collate in preallocated buffers.
+        """
+        labels = np.arange(10) % 3
+        manager = DataManager.from_numpy(
+            train_inputs=self.input_arr, train_outputs=self.output_arr,
+            train_labels=labels, batch_size=4, sampler=None)
+        buffered_manager = DataManager.from_numpy(
+            train_inputs=self.input_arr, train_outputs=self.output_arr,
+            train_labels=labels, batch_size=4, sampler=None,
+            buffered_collate=True)
+        loader = manager.get_dataloader(train=True).train
+        buffered_loader = buffered_manager.get_dataloader(train=True).train
+        self.assertIsInstance(buffered_loader.collate_fn, BatchCollate)
+        pointers = []
+        for dataitem, refitem in zip(buffered_loader, loader):
+            for key in ("inputs", "outputs", "labels"):
+                arr, refarr = getattr(dataitem, key), getattr(refitem, key)
+                self.assertEqual(arr.dtype, refarr.dtype)
+                self.assertTrue(torch.equal(arr, refarr))
+            pointers.append(dataitem.inputs.data_ptr())
+        self.assertEqual(pointers[0], pointers[2])
+        self.assertNotEqual(pointers[0], pointers[1])
+
+        collate_fn = BatchCollate(nb_buffers=1)
+        for shape in ((2, 2), (3, 2)):
+            dataitem = collate_fn([
+                DataItem(inputs=np.ones(shape), outputs=None, labels=None)
+                for _ in range(2)])
+            self.assertEqual(tuple(dataitem.inputs.shape), (2, ) + shape)
+            self.assertIsNone(dataitem.outputs)
+        with self.assertRaises(RuntimeError):
+            collate_fn([
+                DataItem(inputs=np.ones(shape), outputs=None, labels=None)
+                for shape in ((2, 2), (3, 2))])
+
+    def test_batch_augmentation(self):
+        """ Test the augmentation of the collated mini-batches.
+        """
+        def transform(inputs, outputs):
+            return inputs + 1, outputs
+
+        manager = DataManager.from_numpy(
+            train_inputs=self.input_arr, train_outputs=self.output_arr,
+            validation_inputs=self.input_arr, batch_size=3, sampler=None,
+            batch_augmentation=transform)
+        loaders = manager.get_dataloader(train=True, validation=True)
+        for loader, offset in ((loaders.train, 1), (loaders.validation, 0)):
+            self.assertEqual(len(loader), 4)
+            inputs = np.concatenate([item.inputs for item in loader])
+            self.assertTrue(np.allclose(inputs, self.input_arr + offset))
+
+    def test_seeds(self):
+        """ Test the reproducible data augmentation.
+        """
+        transformer = Transformer()
+        transformer.register(flip, probability=0.5)
+        transformer.register(
+            add_gaussian_noise, sigma=0.1, apply_to=["input"])
+        inputs = np.random.rand(10, 1, 4, 4)
+        manager = DataManager.from_numpy(
+            train_inputs=inputs, train_outputs=inputs, batch_size=2,
+            sampler=None, data_augmentation_transforms=[transformer],
+            seed=0)
+        dataset = manager["train"][0]
+        data = []
+        for num_workers, epoch in ((0, 0), (2, 0), (0, 1)):
+            dataset.set_epoch(epoch)
+            loader = DataLoader(
+                dataset, batch_size=2, num_workers=num_workers,
+                collate_fn=manager.collate_fn)
+            data.append(torch.cat([
+                torch.cat((item.inputs, item.outputs), dim=1)
+                for item in loader]))
+        self.assertTrue(torch.equal(data[0], data[1]))
+        self.assertFalse(torch.equal(data[0], data[2]))
+        for arr in data:
+            # Same spatial transforms, noise on the inputs only
+            self.assertTrue(np.allclose(arr[:, 0], arr[:, 1], atol=0.5))
+            self.assertFalse(torch.equal(arr[:, 0], arr[:, 1]))
+        for item in dataset:
+            self.assertTrue(np.allclose(
+                item.inputs, item.outputs, atol=0.5))
+
+    def test_storage_dtypes(self):
+        """ Test the arrays stored as scaled integers.
+        """
+        inputs = np.random.rand(10, 1, 4, 4) * 100 - 20
+        outputs = (inputs > 30).astype(int)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_path = os.path.join(tmpdir, "inputs.npy")
+            output_path = os.path.join(tmpdir, "outputs.npy")
+            metadata_path = os.path.join(tmpdir, "metadata.tsv")
+            np.save(input_path, inputs)
+            np.save(output_path, outputs)
+            pd.DataFrame({"index": range(10)}).to_csv(
+                metadata_path, sep="\t", index=False)
+            for buffered_collate, transforms in (
+                    (False, None), (True, None), (False, [scale])):
+                manager = DataManager(
+                    input_path=input_path, output_path=output_path,
+                    metadata_path=metadata_path, number_of_folds=2,
+                    batch_size=5, sampler=None, test_size=0,
+                    input_transforms=transforms,
+                    buffered_collate=buffered_collate,
+                    storage_dtypes={"inputs": "int16", "outputs": "uint8"})
+                self.assertTrue(os.path.isfile(
+                    os.path.join(tmpdir, "inputs_int16.npy")))
+                self.assertEqual(manager.inputs.dtype, np.int16)
+                self.assertEqual(manager.outputs.dtype, np.uint8)
+                self.assertEqual(list(manager.decoding), ["inputs"])
+                dataset = manager["train"][0]
+                loader = manager.get_dataloader(train=True).train
+                batch = torch.cat([item.inputs for item in loader]).numpy()
+                factor = 1 if transforms is None else 2
+                self.assertEqual(batch.dtype, np.float32)
+                self.assertTrue(np.allclose(
+                    batch, inputs[dataset.indices] * factor, atol=2e-3))
+                batch = torch.cat([item.outputs for item in loader]).numpy()
+                self.assertTrue(np.array_equal(
+                    batch, outputs[dataset.indices]))
+
+            # A modified source is converted again
+            with mock.patch("pynet.datasets.core.convert_array",
+                            wraps=convert_array) as mock_convert:
+                DataManager(
+                    input_path=input_path, metadata_path=metadata_path,
+                    number_of_folds=2, test_size=0,
+                    storage_dtypes={"inputs": "int16"})
+                self.assertFalse(mock_convert.called)
+                np.save(input_path, inputs[::-1])
+                manager = DataManager(
+                    input_path=input_path, metadata_path=metadata_path,
+                    number_of_folds=2, test_size=0,
+                    storage_dtypes={"inputs": "int16"})
+                self.assertEqual(mock_convert.call_count, 1)
+            _, factor, offset = manager.decoding["inputs"]
+            self.assertTrue(np.allclose(
+                manager.inputs[0] * factor + offset, inputs[-1], atol=2e-3))
+            self.assertFalse(any(
+                name.endswith(".tmp") for name in os.listdir(tmpdir)))
+
+    def test_materialize(self):
+        """ Test the offline data augmentation.
+        """
+        transformer = Transformer()
+        transformer.register(
+            add_gaussian_noise, sigma=0.1, apply_to=["input"])
+        labels = np.arange(10)
+        manager = DataManager.from_numpy(
+            train_inputs=self.input_arr, train_outputs=self.output_arr,
+            train_labels=labels, batch_size=2, sampler=None,
+            input_transforms=[scale],
+            data_augmentation_transforms=[transformer])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for n_jobs in (1, 2):
+                table = materialize_augmentation(
+                    manager, os.path.join(tmpdir, str(n_jobs)), n_copies=3,
+                    shard_size=4, n_jobs=n_jobs, seed=0)
+            self.assertEqual(len(table), 30)
+            self.assertEqual(table["shard"].max(), 7)
+            for name in ("inputs_00003.npy", "outputs_00007.npy"):
+                self.assertTrue(np.array_equal(
+                    np.load(os.path.join(tmpdir, "1", name)),
+                    np.load(os.path.join(tmpdir, "2", name))))
+
+            dataset = MaterializedArrayDataset(
+                os.path.join(tmpdir, "2"), labels=labels, seed=1)
+            self.assertEqual(len(dataset), 10)
+            copies = set()
+            for epoch in range(5):
+                dataset.set_epoch(epoch)
+                for index in range(10):
+                    item = dataset[index]
+                    self.assertTrue(np.allclose(
+                        item.inputs, 2 * self.input_arr[index], atol=1))
+                    self.assertTrue(np.array_equal(
+                        item.outputs, self.output_arr[index]))
+                    self.assertEqual(item.labels, index)
+                    if index == 0:
+                        copies.add(item.inputs.tobytes())
+            self.assertGreater(len(copies), 1)
+            self.assertTrue(np.array_equal(
+                pickle.loads(pickle.dumps(dataset))[3].inputs,
+                dataset[3].inputs))
+
 
 if __name__ == "__main__":
     from pynet.utils import setup_logging
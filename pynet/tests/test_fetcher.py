@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import unittest
+import tempfile
+import unittest.mock as mock
+import numpy as np
+
+# Package import
+from pynet.datasets.fetcher import LocalStore
+from pynet.datasets.fetcher import ContentCache
+from pynet.datasets.fetcher import file_digest
+from pynet.datasets.fetcher import fetch_parallel
+from pynet.datasets.store import open_array
+
+
+def process(task):
+    """ Load the raw file of a subject and split it in two rows.
+    """
+    path, fail = task
+    if fail:
+        raise RuntimeError("Interrupted fetch.")
+    data = np.load(path)
+    with open(path + ".log", "at") as open_file:
+        open_file.write("processed\n")
+    arrays = {"inputs": data[:, np.newaxis],
+              "outputs": (data > 0.5)[:, np.newaxis]}
+    metadata = [{"participant_id": os.path.basename(path), "row": row}
+                for row in range(len(data))]
+    return arrays, metadata
+
+
+class TestFetcher(unittest.TestCase):
+    """ Test the fetcher framework.
+    """
+    def setUp(self):
+        """ Setup test.
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storedir = os.path.join(self.tmpdir.name, "store")
+        os.mkdir(self.storedir)
+        self.data = [np.random.rand(2, 5, 4) for _ in range(5)]
+        for idx, data in enumerate(self.data):
+            np.save(os.path.join(self.storedir, "sub{0}.npy".format(idx)),
+                    data)
+        np.save(os.path.join(self.storedir, "copy.npy"), self.data[0])
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        self.tmpdir.cleanup()
+
+    def test_cache(self):
+        """ Test the content-addressed cache.
+        """
+        cache = ContentCache(os.path.join(self.tmpdir.name, "cache"),
+                             LocalStore(self.storedir))
+        path = cache.get("sub0.npy")
+        self.assertTrue(path.endswith(".npy"))
+        self.assertTrue(np.array_equal(np.load(path), self.data[0]))
+        self.assertEqual(cache.get("copy.npy"), path)
+        self.assertEqual(cache.get("sub0.npy", file_digest(path)), path)
+        self.assertNotEqual(cache.get("sub1.npy"), path)
+        self.assertRaises(ValueError, cache.get, "sub2.npy", "0" * 64)
+        self.assertEqual(
+            os.listdir(os.path.join(self.tmpdir.name, "cache", "tmp")), [])
+
+    def test_fetch_parallel(self):
+        """ Test the parallel and resumable fetch.
+        """
+        cache = ContentCache(os.path.join(self.tmpdir.name, "cache"),
+                             LocalStore(self.storedir))
+        raw_paths = [cache.get("sub{0}.npy".format(idx))
+                     for idx in range(len(self.data))]
+        expected = np.concatenate(self.data)[:, np.newaxis]
+        for n_jobs in (1, 2):
+            destdir = os.path.join(self.tmpdir.name, "dest{0}".format(n_jobs))
+            os.mkdir(destdir)
+            paths = {"inputs": os.path.join(destdir, "inputs.npy"),
+                     "outputs": os.path.join(destdir, "outputs.npy")}
+            desc_path = os.path.join(destdir, "desc.tsv")
+            tasks = [(path, idx == 3) for idx, path in enumerate(raw_paths)]
+            self.assertRaises(
+                RuntimeError, fetch_parallel, tasks, process, paths,
+                desc_path, n_rows=([2] * len(tasks)), n_jobs=n_jobs)
+            self.assertTrue(os.path.isfile(desc_path + ".progress"))
+            self.assertFalse(os.path.isfile(desc_path))
+            for path in raw_paths:
+                if os.path.isfile(path + ".log"):
+                    os.remove(path + ".log")
+            tasks = [(path, False) for path in raw_paths]
+            df = fetch_parallel(tasks, process, paths, desc_path,
+                                n_rows=([2] * len(tasks)), n_jobs=n_jobs)
+            self.assertTrue(os.path.isfile(raw_paths[3] + ".log"))
+            self.assertFalse(os.path.isfile(raw_paths[0] + ".log"))
+            os.remove(raw_paths[3] + ".log")
+            self.assertFalse(os.path.isfile(desc_path + ".progress"))
+            self.assertTrue(np.array_equal(np.load(paths["inputs"]), expected))
+            self.assertTrue(np.array_equal(
+                np.load(paths["outputs"]), expected > 0.5))
+            self.assertEqual(df["row"].tolist(), [0, 1] * len(tasks))
+            self.assertEqual(len(open(desc_path).readlines()), 11)
+
+    def test_fetch_chunks(self):
+        """ Test the parallel fetch in chunked stores.
+        """
+        raw_paths = [os.path.join(self.storedir, "sub{0}.npy".format(idx))
+                     for idx in range(len(self.data))]
+        tasks = [(raw_paths[idx % len(raw_paths)], False)
+                 for idx in range(12)]
+        expected = np.concatenate(
+            [self.data[idx % len(self.data)] for idx in range(12)])
+        for chunk_rows, aligned in ((4, False), (2, True)):
+            destdir = os.path.join(
+                self.tmpdir.name, "chunks{0}".format(chunk_rows))
+            os.mkdir(destdir)
+            paths = {"inputs": os.path.join(destdir, "inputs.chunks"),
+                     "outputs": os.path.join(destdir, "outputs.chunks")}
+            with mock.patch("pynet.datasets.fetcher.logger") as mock_logger:
+                fetch_parallel(
+                    tasks, process, paths, os.path.join(destdir, "desc.tsv"),
+                    n_rows=([2] * len(tasks)), n_jobs=4,
+                    store={"chunk_rows": chunk_rows})
+            self.assertEqual(mock_logger.warning.called, not aligned)
+            self.assertTrue(np.array_equal(
+                np.asarray(open_array(paths["inputs"])),
+                expected[:, np.newaxis]))
+        for path in raw_paths:
+            os.remove(path + ".log")
+
+
+if __name__ == "__main__":
+    from pynet.utils import setup_logging
+    setup_logging(level="debug")
+    unittest.main()
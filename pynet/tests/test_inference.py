@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import unittest
+import torch
+import torch.nn as nn
+
+# Package import
+import pynet
+from pynet.inference import SlidingWindow
+
+
+class TestInference(unittest.TestCase):
+    """ Test the sliding window inference.
+    """
+    def setUp(self):
+        """ Setup test.
+        """
+        self.networks = pynet.get_tools()["networks"]
+        self.x3 = torch.randn(2, 1, 40, 36, 20)
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        pass
+
+    def test_pointwise(self):
+        """ Test the stitching with a pointwise model.
+        """
+        net = nn.Conv3d(1, 3, kernel_size=1)
+        with torch.no_grad():
+            ref = net(self.x3)
+            for blending in ("gaussian", "linear", "constant"):
+                window = SlidingWindow(
+                    patch_size=(16, 16, 16), overlap=0.25, blending=blending,
+                    batch_size=3)
+                y = window(net, self.x3)
+                self.assertEqual(y.shape, ref.shape)
+                self.assertTrue(torch.allclose(y, ref, atol=1e-5))
+
+    def test_windows(self):
+        """ Test the patch locations.
+        """
+        window = SlidingWindow(patch_size=(16, 16), overlap=0.5)
+        windows = window.get_windows((40, 16))
+        starts = [slc[0].start for slc in windows]
+        self.assertEqual(starts, [0, 8, 16, 24])
+        with self.assertRaises(ValueError):
+            SlidingWindow(patch_size=(16, 16), overlap=1)
+
+    def test_unet(self):
+        """ Test the UNet full volume reconstruction.
+        """
+        params = {
+            "num_classes": 2,
+            "in_channels": 1,
+            "depth": 2,
+            "start_filts": 4,
+            "up_mode": "upsample",
+            "merge_mode": "concat",
+            "batchnorm": False,
+            "input_shape": (16, 16, 16)
+        }
+        net = self.networks["UNet"](dim="3d", **params)
+        window = SlidingWindow(patch_size=(16, 16, 16), batch_size=4)
+        with torch.no_grad():
+            y = window(net, self.x3)
+        self.assertEqual(tuple(y.shape), (2, 2, 40, 36, 20))
+
+    def test_voxelmorphnet(self):
+        """ Test the VoxelMorphNet full volume reconstruction.
+        """
+        params = {
+            "vol_size": (16, 16, 16),
+            "enc_nf": [4, 8, 8, 8],
+            "dec_nf": [8, 8, 8, 8, 8, 4, 4],
+            "full_size": True
+        }
+        net = self.networks["VoxelMorphNet"](**params)
+        window = SlidingWindow(patch_size=(16, 16, 16), batch_size=2)
+        with torch.no_grad():
+            warp, layer_outputs = window(
+                net, torch.cat((self.x3, self.x3), dim=1))
+        self.assertEqual(tuple(warp.shape), (2, 1, 40, 36, 20))
+        self.assertEqual(
+            tuple(layer_outputs["flow"].shape), (2, 3, 40, 36, 20))
+
+
+if __name__ == "__main__":
+    from pynet.utils import setup_logging
+    setup_logging(level="debug")
+    unittest.main()
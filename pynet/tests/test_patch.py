@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import unittest
+import tempfile
+import unittest.mock as mock
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+# Package import
+from pynet.datasets.core import DataManager, ArrayDataset, PatchQueue
+from pynet.datasets import patch
+from pynet.datasets.patch import (
+    get_index_map, index_outputs, RandomPatchSampler, LabelPatchSampler)
+
+
+class TestPatch(unittest.TestCase):
+    """ Test the patch samplers and the patch queue.
+    """
+    def setUp(self):
+        """ Setup test.
+        """
+        self.inputs = np.random.rand(6, 2, 16, 16).astype(np.float32)
+        self.outputs = np.zeros((6, 1, 16, 16), dtype=np.float32)
+        self.outputs[:, 0, 10:12, 3:5] = 1
+        self.outputs[:, 0, 0, 15] = 2
+        self.inputs[:, 0] = np.arange(6)[:, np.newaxis, np.newaxis]
+
+    def test_index_map(self):
+        """ Test the voxels of each label.
+        """
+        index_map = get_index_map(self.outputs[0])
+        self.assertEqual(sorted(index_map), [0, 1, 2])
+        self.assertEqual(len(index_map[1]), 4)
+        self.assertEqual(list(index_map[2]), [15])
+        self.assertEqual(sum(len(val) for val in index_map.values()), 256)
+        self.assertEqual(index_map[0].dtype, np.uint32)
+        self.assertEqual(patch.get_index_dtype((2 ** 11, ) * 3), np.int64)
+        one_hot = np.stack((self.outputs[0, 0] == 0, self.outputs[0, 0] == 1,
+                            self.outputs[0, 0] == 2)).astype(np.float32)
+        for label, voxels in get_index_map(one_hot).items():
+            self.assertTrue(np.array_equal(voxels, index_map[label]))
+
+    def test_random(self):
+        """ Test the uniform patches.
+        """
+        sampler = RandomPatchSampler((5, 7))
+        offsets = sampler((16, 16), 100, seed=0)
+        self.assertEqual(offsets.shape, (100, 2))
+        self.assertTrue(np.all(offsets >= 0))
+        self.assertTrue(np.all(offsets <= [11, 9]))
+        self.assertTrue(np.array_equal(offsets, sampler((16, 16), 100,
+                                                        seed=0)))
+        patch = sampler.extract(self.inputs[0], offsets[0])
+        self.assertEqual(patch.shape, (2, 5, 7))
+        self.assertRaises(ValueError, sampler, (4, 16), 1)
+        self.assertRaises(ValueError, sampler, (16, 16, 16), 1)
+
+    def test_label(self):
+        """ Test the patches centered on the labels.
+        """
+        index_map = get_index_map(self.outputs[0])
+        sampler = LabelPatchSampler((4, 4), label_probabilities={2: 1})
+        offsets = sampler((16, 16), 10, index_map, seed=0)
+        self.assertTrue(np.all(offsets == [0, 12]))
+        sampler = LabelPatchSampler((3, 3), label_probabilities={1: 1, 3: 1})
+        for offset in sampler((16, 16), 10, index_map, seed=0):
+            patch = sampler.extract(self.outputs[0], offset)
+            self.assertEqual(patch[0, 1, 1], 1)
+        sampler = LabelPatchSampler((3, 3), foreground_probability=1)
+        for offset in sampler((16, 16), 10, index_map, seed=0):
+            patch = sampler.extract(self.outputs[0], offset)
+            self.assertGreater(patch.max(), 0)
+        sampler = LabelPatchSampler((3, 3), label_probabilities={4: 1})
+        self.assertEqual(len(sampler((16, 16), 10, index_map)), 10)
+        self.assertRaises(ValueError, sampler, (16, 16), 1)
+        self.assertRaises(ValueError, LabelPatchSampler, (3, 3))
+        self.assertRaises(ValueError, LabelPatchSampler, (3, 3),
+                          foreground_probability=2)
+
+    def test_queue(self):
+        """ Test the patch queue.
+        """
+        dataset = ArrayDataset(self.inputs, np.arange(6), outputs=self.outputs,
+                               seed=0)
+        sampler = LabelPatchSampler((4, 4), foreground_probability=0.5)
+        queue = PatchQueue(dataset, sampler, patches_per_volume=3,
+                           max_volumes=2)
+        self.assertEqual(len(queue), 18)
+        items = list(queue)
+        self.assertEqual(len(items), 18)
+        self.assertEqual(items[0].inputs.shape, (2, 4, 4))
+        self.assertEqual(items[0].outputs.shape, (1, 4, 4))
+        volumes = [int(item.inputs[0, 0, 0]) for item in items]
+        self.assertEqual(sorted(volumes), sorted(list(range(6)) * 3))
+        self.assertEqual(len(set(volumes[:6])), 2)
+        self.assertTrue(all(np.array_equal(item1.inputs, item2.inputs)
+                            for item1, item2 in zip(items, queue)))
+        queue.set_epoch(1)
+        self.assertEqual(dataset.epoch, 1)
+        self.assertFalse(all(np.array_equal(item1.inputs, item2.inputs)
+                             for item1, item2 in zip(items, queue)))
+
+        # Each worker loads its own volumes
+        worker_volumes = []
+        for worker_id in range(2):
+            with mock.patch("pynet.datasets.core.get_worker_info",
+                            return_value=SimpleNamespace(
+                                id=worker_id, num_workers=2)):
+                worker_volumes.append(set(
+                    int(item.inputs[0, 0, 0]) for item in queue))
+        self.assertEqual(len(worker_volumes[0]), 3)
+        self.assertEqual(worker_volumes[0] | worker_volumes[1], set(range(6)))
+
+        dataset = ArrayDataset(self.inputs, np.arange(6), add_input=True)
+        queue = PatchQueue(dataset, RandomPatchSampler((4, 4)))
+        item = next(iter(queue))
+        self.assertIsNone(dataset.outputs)
+        self.assertTrue(np.array_equal(item.inputs, item.outputs))
+
+    def test_grid_patches(self):
+        """ Test the regular patches of a dataset.
+        """
+        dataset = ArrayDataset(self.inputs, np.arange(6), patch_size=(8, 8),
+                               add_input=True, patch_cache_size=1)
+        self.assertEqual(len(dataset), 24)
+        for item in np.random.permutation(24):
+            image_idx, patch_idx = divmod(int(item), 4)
+            row, col = divmod(patch_idx, 2)
+            expected = self.inputs[image_idx, :, row * 8: (row + 1) * 8,
+                                   col * 8: (col + 1) * 8]
+            data = dataset[int(item)]
+            self.assertTrue(np.array_equal(data.inputs, expected))
+            self.assertTrue(np.array_equal(data.outputs, expected))
+
+    def test_data_manager(self):
+        """ Test the patch-based training loader.
+        """
+        manager = DataManager.from_numpy(
+            train_inputs=self.inputs, train_outputs=self.outputs,
+            batch_size=4, seed=0,
+            patch_sampler=RandomPatchSampler((4, 4)),
+            patch_queue_kwargs={"patches_per_volume": 2})
+        loader = manager.get_dataloader(train=True).train
+        batches = list(loader)
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(tuple(batches[0].inputs.shape), (4, 2, 4, 4))
+        self.assertEqual(tuple(batches[0].outputs.shape), (4, 1, 4, 4))
+        self.assertRaises(ValueError, manager.get_dataloader, train=True,
+                          distributed=True)
+
+    def test_index(self):
+        """ Test the incremental index of the outputs.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "outputs.npy.index")
+            self.outputs[3, 0, 5, 5] = 3
+            with mock.patch("pynet.datasets.patch.get_index_map",
+                            wraps=get_index_map) as mock_index:
+                index_maps = index_outputs(self.outputs, path, rows=[1, 3])
+                self.assertEqual(mock_index.call_count, 2)
+                self.assertIn(3, index_maps)
+                self.assertNotIn(0, index_maps)
+                index_maps = index_outputs(self.outputs, path)
+                self.assertEqual(mock_index.call_count, 6)
+                index_outputs(self.outputs, path)
+                self.assertEqual(mock_index.call_count, 6)
+                # Only the modified row is indexed again
+                fingerprint = {"size": 1, "mtime_ns": 1}
+                index_outputs(self.outputs, path, fingerprint=fingerprint)
+                self.assertEqual(mock_index.call_count, 6)
+                self.outputs[4, 0, 6, 6] = 3
+                index_outputs(self.outputs, path, fingerprint=fingerprint)
+                self.assertEqual(mock_index.call_count, 6)
+                index_maps = index_outputs(self.outputs, path, fingerprint={
+                    "size": 1, "mtime_ns": 2})
+                self.assertEqual(mock_index.call_count, 7)
+                self.assertIn(3, index_maps[4])
+                index_outputs(self.outputs[:, :, :8], path)
+                self.assertEqual(mock_index.call_count, 13)
+            index_maps = index_outputs(self.outputs, path)
+            self.assertEqual(len(os.listdir(path)), 7)
+            for row in range(6):
+                expected = get_index_map(self.outputs[row])
+                index_map = index_maps[row]
+                self.assertEqual(sorted(index_map), sorted(expected))
+                for label, voxels in expected.items():
+                    self.assertTrue(np.array_equal(index_map[label], voxels))
+            self.assertRaises(ValueError, index_maps.__getitem__, 6)
+
+            # The foreground sampling does not decode the background
+            index_map = index_maps[3]
+            self.assertEqual(index_map.count(0), 16 * 16 - 6)
+            self.assertEqual(index_map.count(4), 0)
+            sampler = LabelPatchSampler((4, 4), foreground_probability=1)
+            sampler((16, 16), 10, index_map, seed=0)
+            self.assertEqual(sorted(index_map._voxels), [1, 2, 3])
+            self.assertEqual(index_map[1].dtype, np.uint32)
+            self.assertRaises(ValueError, index_outputs, self.inputs[:, 1:],
+                              os.path.join(tmpdir, "inputs.npy.index"))
+
+            # The queue draws the same patches from the index
+            dataset = ArrayDataset(self.inputs, np.arange(1, 5),
+                                   outputs=self.outputs, seed=0)
+            sampler = LabelPatchSampler((4, 4), label_probabilities={
+                1: 1, 2: 1, 3: 1})
+            items = list(PatchQueue(dataset, sampler))
+            queue = PatchQueue(dataset, sampler, index_maps=index_maps)
+            with mock.patch("pynet.datasets.core.get_index_map") as mock_map:
+                for item1, item2 in zip(items, queue):
+                    self.assertTrue(np.array_equal(item1.inputs,
+                                                   item2.inputs))
+                    self.assertTrue(np.array_equal(item1.outputs,
+                                                   item2.outputs))
+                self.assertFalse(mock_map.called)
+
+            # The volumes are scanned when the transforms move the voxels
+            dataset = ArrayDataset(
+                self.inputs, np.arange(1, 5), outputs=self.outputs,
+                output_transforms=[lambda arr: arr[:, ::-1]], seed=0)
+            queue = PatchQueue(dataset, sampler, index_maps=index_maps)
+            with mock.patch("pynet.datasets.core.get_index_map",
+                            wraps=get_index_map) as mock_map:
+                for item in queue:
+                    self.assertGreater(item.outputs.max(), 0)
+                self.assertEqual(mock_map.call_count, 4)
+
+    def test_data_manager_index(self):
+        """ Test the index of the data manager outputs.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_path = os.path.join(tmpdir, "inputs.npy")
+            output_path = os.path.join(tmpdir, "outputs.npy")
+            metadata_path = os.path.join(tmpdir, "metadata.tsv")
+            np.save(input_path, self.inputs)
+            np.save(output_path, self.outputs.astype(np.uint8))
+            pd.DataFrame({"index": range(6)}).to_csv(
+                metadata_path, sep="\t", index=False)
+            manager = DataManager(
+                input_path, metadata_path, output_path=output_path,
+                number_of_folds=2, batch_size=2, test_size=0, seed=0,
+                patch_sampler=LabelPatchSampler(
+                    (4, 4), foreground_probability=1),
+                patch_index=True)
+            self.assertTrue(os.path.isfile(os.path.join(
+                patch.INDEX_DIR.format(output_path), "r000005.npz")))
+            loader = manager.get_dataloader(train=True).train
+            self.assertIs(loader.dataset.index_maps, manager.index_maps)
+            for batch in loader:
+                outputs = batch.outputs.numpy().reshape(2, -1)
+                self.assertTrue(np.all(outputs.max(axis=1) > 0))
+
+            # A re-saved outputs file is indexed again
+            self.outputs[2, 0] = 0
+            self.outputs[2, 0, 1:3, 1:3] = 3
+            np.save(output_path, self.outputs.astype(np.uint8))
+            manager = DataManager(
+                input_path, metadata_path, output_path=output_path,
+                number_of_folds=2, batch_size=2, test_size=0, seed=0,
+                patch_sampler=LabelPatchSampler(
+                    (4, 4), foreground_probability=1),
+                patch_index=True)
+            self.assertEqual(sorted(manager.index_maps[2]), [0, 3])
+
+
+if __name__ == "__main__":
+    from pynet.utils import setup_logging
+    setup_logging(level="debug")
+    unittest.main()
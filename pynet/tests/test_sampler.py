@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import pickle
+import unittest
+import tempfile
+import unittest.mock as mock
+import numpy as np
+import pandas as pd
+import torch
+
+# Package import
+from pynet.datasets.core import DataManager, ArrayDataset
+from pynet.datasets.sampler import BlockShuffleSampler
+
+
+class TestSampler(unittest.TestCase):
+    """ Test the locality-aware sampler.
+    """
+    def setUp(self):
+        """ Setup test.
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmpdir.name, "inputs.npy")
+        self.metadata_path = os.path.join(self.tmpdir.name, "metadata.tsv")
+        inputs = np.arange(50, dtype=np.float32)[:, np.newaxis, np.newaxis]
+        np.save(self.input_path, np.repeat(inputs, 1024, axis=2))
+        pd.DataFrame({"index": range(50)}).to_csv(
+            self.metadata_path, sep="\t", index=False)
+        self.indices = np.random.permutation(40) + 5
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        self.tmpdir.cleanup()
+
+    def test_blocks(self):
+        """ Test the blocks and windows shuffling.
+        """
+        dataset = ArrayDataset(
+            np.load(self.input_path, mmap_mode="r"), self.indices)
+        sampler = BlockShuffleSampler(dataset, block_size=8, window=1)
+        items = list(sampler)
+        self.assertEqual(sorted(items), list(range(40)))
+        for start in range(0, 40, 8):
+            rows = np.sort(self.indices[items[start: start + 8]])
+            self.assertEqual(rows[-1] - rows[0], 7)
+            self.assertEqual(rows[0] % 8, 5)
+        sampler = BlockShuffleSampler(dataset, block_size=8, window=2)
+        items = list(sampler)
+        self.assertEqual(sorted(items), list(range(40)))
+        rows = np.sort(self.indices[items[:16]])
+        self.assertEqual(len(set((rows - 5) // 8)), 2)
+        self.assertRaises(ValueError, BlockShuffleSampler, dataset,
+                          block_size=0)
+
+        sampler = BlockShuffleSampler(dataset, block_size=4, seed=0)
+        epochs = []
+        for epoch in (0, 0, 1):
+            sampler.set_epoch(epoch)
+            epochs.append(list(sampler))
+        self.assertEqual(epochs[0], epochs[1])
+        self.assertNotEqual(epochs[0], epochs[2])
+        sampler = pickle.loads(pickle.dumps(sampler))
+        self.assertEqual(list(sampler), epochs[2])
+
+        dataset = ArrayDataset(
+            np.load(self.input_path, mmap_mode="r"), self.indices,
+            patch_size=(256, ))
+        rows = BlockShuffleSampler.get_rows(dataset)
+        self.assertEqual(len(rows), 160)
+        self.assertTrue(np.array_equal(rows, np.repeat(self.indices, 4)))
+
+    def test_advise(self):
+        """ Test the read ahead advices.
+        """
+        dataset = ArrayDataset(
+            np.load(self.input_path, mmap_mode="r"), self.indices)
+        sampler = BlockShuffleSampler(dataset, block_size=4, window=2)
+        with mock.patch.object(BlockShuffleSampler, "advise") as advise:
+            self.assertEqual(len(list(sampler)), 40)
+        self.assertEqual(advise.call_count, 4)
+        self.assertEqual([len(call[0][0]) for call in advise.call_args_list],
+                         [8] * 4)
+        list(sampler)
+        self.assertEqual(len(sampler._mappings), 1)
+        sampler.advise(np.arange(40))
+        sampler = BlockShuffleSampler(dataset, prefetch_windows=0)
+        list(sampler)
+        self.assertEqual(sampler._mappings, None)
+
+    def test_data_manager(self):
+        """ Test the sampler selection in the data manager.
+        """
+        manager = DataManager(
+            input_path=self.input_path, metadata_path=self.metadata_path,
+            number_of_folds=2, batch_size=5, test_size=0,
+            sampler="block_random",
+            sampler_kwargs={"block_size": 5, "window": 1, "seed": 0})
+        loader = manager.get_dataloader(train=True).train
+        self.assertIsInstance(loader.sampler, BlockShuffleSampler)
+        dataset = manager["train"][0]
+        rows = []
+        for dataitem in loader:
+            batch_rows = dataitem.inputs[:, 0, 0].long().sort()[0]
+            self.assertEqual(int(batch_rows[-1] - batch_rows[0]), 4)
+            rows.extend(batch_rows.tolist())
+        self.assertEqual(sorted(rows), sorted(dataset.indices.tolist()))
+
+
+if __name__ == "__main__":
+    from pynet.utils import setup_logging
+    setup_logging(level="debug")
+    unittest.main()
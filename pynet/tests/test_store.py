@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2020
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import pickle
+import unittest
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# Package import
+from pynet.datasets.core import DataManager
+from pynet.datasets.fetcher import fetch_parallel
+from pynet.datasets.store import create_array
+from pynet.datasets.store import open_array
+from pynet.datasets.store import available_codecs
+from pynet.datasets.store import ChunkedArray
+from pynet.datasets.store import convert_array
+from pynet.datasets.store import read_attributes
+from pynet.datasets.store import get_fingerprint
+
+
+def process(task):
+    """ Generate the rows of a subject.
+    """
+    arrays = {"inputs": np.full((1, 2, 3, 4), task, dtype=np.float32)}
+    return arrays, [{"participant_id": task}]
+
+
+class TestStore(unittest.TestCase):
+    """ Test the chunked array store.
+    """
+    def setUp(self):
+        """ Setup test.
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.arr = np.random.rand(7, 2, 6, 5).astype(np.float32)
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        self.tmpdir.cleanup()
+
+    def test_codecs(self):
+        """ Test the lossless codecs and the indexing.
+        """
+        self.assertTrue({"zlib", "lzma"}.issubset(available_codecs()))
+        for codec in [None] + available_codecs():
+            path = os.path.join(self.tmpdir.name, "{0}.chunks".format(codec))
+            store = create_array(path, self.arr.shape, self.arr.dtype,
+                                 chunk_rows=3, codec=codec)
+            store[:] = self.arr
+            store = open_array(path)
+            self.assertIsInstance(store, ChunkedArray)
+            self.assertEqual(len(store), 7)
+            self.assertEqual(store.shape, self.arr.shape)
+            self.assertTrue(np.array_equal(np.asarray(store), self.arr))
+            self.assertTrue(np.array_equal(store[4], self.arr[4]))
+            self.assertTrue(np.array_equal(store[-1, 1], self.arr[-1, 1]))
+            self.assertTrue(np.array_equal(
+                store[[5, 0], :, 2], self.arr[[5, 0], :, 2]))
+            self.assertTrue(np.array_equal(store[2:6], self.arr[2:6]))
+            self.assertRaises(ValueError, store.__setitem__, 0, 0)
+            self.assertRaises(IndexError, store.__getitem__, 7)
+        store = pickle.loads(pickle.dumps(store))
+        self.assertTrue(np.array_equal(store[6], self.arr[6]))
+        self.assertRaises(ValueError, create_array, path, (1, ), np.int64,
+                          quantize="uint8")
+
+    def test_partial_writes(self):
+        """ Test writes that do not cover whole chunks.
+        """
+        path = os.path.join(self.tmpdir.name, "partial.chunks")
+        store = create_array(path, self.arr.shape, np.float64, chunk_rows=3)
+        self.assertTrue(np.array_equal(store[5], np.zeros((2, 6, 5))))
+        store[1:5] = self.arr[1:5]
+        store[6] = self.arr[6]
+        expected = self.arr.copy()
+        expected[[0, 5]] = 0
+        self.assertEqual(store[:].dtype, np.float64)
+        self.assertTrue(np.array_equal(store[:], expected))
+        self.assertEqual(len(os.listdir(path)), 4)
+
+    def test_quantize(self):
+        """ Test the lossy encodings.
+        """
+        for quantize, tolerance in (("float16", 1e-3), ("uint8", 1. / 255)):
+            path = os.path.join(self.tmpdir.name, quantize)
+            store = create_array(path, self.arr.shape, self.arr.dtype,
+                                 chunk_rows=2, quantize=quantize)
+            store[:] = self.arr
+            self.assertEqual(store[:].dtype, np.float32)
+            self.assertTrue(np.allclose(store[:], self.arr, atol=tolerance))
+            self.assertFalse(np.array_equal(store[:], self.arr))
+
+    def test_convert(self):
+        """ Test the conversion to a storage data type.
+        """
+        for name in ("arr.npy", "arr.chunks"):
+            path = os.path.join(self.tmpdir.name, name)
+            if name.endswith(".npy"):
+                np.save(path, self.arr)
+            else:
+                create_array(path, self.arr.shape, self.arr.dtype,
+                             chunk_rows=2)[:] = self.arr
+            destpath = path.replace("arr", "arr_int16")
+            attributes = convert_array(path, destpath, "int16",
+                                       block_bytes=500)
+            self.assertEqual(read_attributes(destpath), attributes)
+            self.assertEqual(attributes["dtype"], "<f4")
+            dest = open_array(destpath)
+            self.assertEqual(type(dest), type(open_array(path)))
+            self.assertEqual(dest.dtype, np.int16)
+            decoded = (np.asarray(dest) * attributes["scale"] +
+                       attributes["offset"])
+            self.assertTrue(np.allclose(decoded, self.arr, atol=1e-4))
+            self.assertEqual(attributes["source"], get_fingerprint(path))
+
+            # Concurrent conversions replace the copy atomically
+            context = multiprocessing.get_context("fork")
+            processes = [context.Process(
+                target=convert_array, args=(path, destpath, "int16"))
+                for _ in range(3)]
+            for process in processes:
+                process.start()
+            for _ in range(5):
+                self.assertTrue(np.array_equal(
+                    np.asarray(open_array(destpath)), np.asarray(dest)))
+            for process in processes:
+                process.join()
+                self.assertEqual(process.exitcode, 0)
+            self.assertTrue(np.array_equal(
+                np.asarray(open_array(destpath)), np.asarray(dest)))
+            self.assertFalse(any(
+                name.endswith((".tmp", ".old"))
+                for name in os.listdir(self.tmpdir.name)))
+        path = os.path.join(self.tmpdir.name, "labels.npy")
+        np.save(path, np.arange(300))
+        self.assertRaises(ValueError, convert_array, path, path + "2",
+                          "uint8")
+        attributes = convert_array(path, path + "2", "int16")
+        self.assertEqual((attributes["scale"], attributes["offset"]),
+                         (1., 0.))
+
+    def test_data_manager(self):
+        """ Test the data loading and the fetcher writing a store.
+        """
+        paths = {"inputs": os.path.join(self.tmpdir.name, "inputs.chunks")}
+        desc_path = os.path.join(self.tmpdir.name, "desc.tsv")
+        fetch_parallel(list(range(10)), process, paths, desc_path,
+                       store={"codec": "lzma"})
+        manager = DataManager(
+            input_path=paths["inputs"], metadata_path=desc_path,
+            number_of_folds=2, batch_size=4, test_size=0.2)
+        self.assertIsInstance(manager.inputs, ChunkedArray)
+        values = []
+        loaders = manager.get_dataloader(train=True, test=True)
+        for loader in loaders.train, loaders.test:
+            for dataitem in loader:
+                self.assertEqual(tuple(dataitem.inputs.shape[1:]), (2, 3, 4))
+                values.extend(dataitem.inputs[:, 0, 0, 0].tolist())
+        self.assertEqual(len(values), 6)
+        self.assertEqual(len(set(values)), 6)
+        self.assertTrue(set(values).issubset(range(10)))
+        self.assertEqual(
+            pd.read_csv(desc_path, sep="\t")["participant_id"].tolist(),
+            list(range(10)))
+
+
+if __name__ == "__main__":
+    from pynet.utils import setup_logging
+    setup_logging(level="debug")
+    unittest.main()
@@ -8,7 +8,9 @@
 ##########################################################################
 
 # System import
+import os
 import unittest
+import tempfile
 import numpy as np
 import pandas as pd
 import unittest.mock as mock
@@ -152,57 +154,41 @@ class TestTcgaLggFetcher(unittest.TestCase):
         fp = './kaggle_3m/TCGA_HT_A61B_19991127/TCGA_HT_A61B_19991127_81.tif'
         self.assertEqual(get_slice_id(fp), 81)
 
-    @mock.patch("pandas.DataFrame.from_dict")
-    @mock.patch("pandas.DataFrame.to_csv")
-    @mock.patch("numpy.save")
     @mock.patch("skimage.io.imread")
     @mock.patch("pynet.datasets.tcga_lgg_tif.read_metadata")
     @mock.patch("pynet.datasets.tcga_lgg_tif.get_subjects_files")
-    @mock.patch("os.path.isfile")
-    @mock.patch("os.path.isdir")
-    def test_not_existing_tsv_file(self, mock_isdir, mock_isfile,
-                                   mock_getsubjectsfiles, mock_readmetadata,
-                                   mock_imread, mock_save, mock_tocsv,
-                                   mock_fromdict):
+    def test_not_existing_tsv_file(self, mock_getsubjectsfiles,
+                                   mock_readmetadata, mock_imread):
         """ Test the global behaviour.
         """
-
-        def check_arrays(save_path, array):
-            self.assertTrue(("inputs" in save_path)
-                            or ("outputs" in save_path))
-            if "inputs" in save_path:
-                self.assertEqual(array.shape, (2, 3, self.height, self.width))
-            elif "outputs" in save_path:
-                self.assertEqual(array.shape, (2, 1, self.height, self.width))
-
-        def check_metadata(input_dict):
-            self.assertDictEqual(input_dict, self.final_metadata)
-            return self.dataframe
-
-        def check_tocsv(desc, sep, index):
-            self.assertEqual(desc, self.desc_path)
-            self.assertEqual(sep, "\t")
-            self.assertEqual(index, False)
-
-        mock_isdir.return_value = True
-        mock_isfile.return_value = False
         mock_getsubjectsfiles.return_value = self.subjects_data
         mock_readmetadata.return_value = self.csv_metadata
         mock_imread.side_effect = [self.flair1,
                                    self.flair2,
                                    self.mask1,
                                    self.mask2]
-        mock_save.side_effect = check_arrays
-        mock_fromdict.side_effect = check_metadata
-        mock_tocsv.side_effect = check_tocsv
-        res = fetch_tcga_lgg_tif(self.datasetdir)
-        self.assertEqual(
-            res.input_path, self.input_path)
-        self.assertEqual(
-            res.output_path, self.output_path)
-        self.assertEqual(res.metadata_path, self.desc_path)
-        self.assertEqual(res.height, self.height)
-        self.assertEqual(res.width, self.width)
+        with tempfile.TemporaryDirectory() as datasetdir:
+            res = fetch_tcga_lgg_tif(datasetdir)
+            self.assertEqual(res.input_path, os.path.join(
+                datasetdir, os.path.basename(self.input_path)))
+            self.assertEqual(res.output_path, os.path.join(
+                datasetdir, os.path.basename(self.output_path)))
+            self.assertEqual(res.metadata_path, os.path.join(
+                datasetdir, os.path.basename(self.desc_path)))
+            self.assertEqual(res.height, self.height)
+            self.assertEqual(res.width, self.width)
+            inputs = np.load(res.input_path)
+            outputs = np.load(res.output_path)
+            self.assertEqual(inputs.shape, (2, 3, self.height, self.width))
+            self.assertTrue(np.array_equal(
+                inputs[1], self.flair2.transpose(2, 0, 1)))
+            self.assertEqual(outputs.shape, (2, 1, self.height, self.width))
+            self.assertEqual(outputs.sum(), 1)
+            df = pd.read_csv(res.metadata_path, sep="\t", dtype=str)
+            self.assertDictEqual(
+                df.to_dict(orient="list"),
+                dict((key, [str(val) for val in values])
+                     for key, values in self.final_metadata.items()))
 
 
 if __name__ == "__main__":